@@ -0,0 +1,45 @@
+"""
+Measures mentions handled per second by ChannelBot against the fake mattermost server.
+
+Run from the repository root: python -m benchmarks.bench_channel_bot
+"""
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from movement_bot.channel_bot import ChannelBot
+from movement_bot.exercises import ExerciseRegistry
+from movement_bot.workout_handler import WorkoutMessageHandler
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+MESSAGES = ['done easy', 'done medium', 'done hard', 'stats', 'list']
+
+
+def run(workers, mentions=500, users=50, latency=0.005):
+    server = FakeMattermost(latency=latency)
+    registry = ExerciseRegistry(EXERCISE_FILE, 1, 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = WorkoutMessageHandler(registry, os.path.join(tmp, 'workouts.csv'))
+        handler.open_session()
+        bot = ChannelBot(url=None, token=None, channel_name='test', team_name='test', help_text='help',
+                         message_handler=handler, driver=FakeDriver(server), workers=workers,
+                         post_rate=10000, post_burst=1000)
+        bot.start_listening()
+
+        senders = [server.add_user('user{}'.format(i)) for i in range(users)]
+        start = time.perf_counter()
+        for _ in range(mentions):
+            server.queue_mention(random.choice(senders), random.choice(MESSAGES))
+        server.wait_for_posts(mentions)
+        duration = time.perf_counter() - start
+
+    print("workers={:3d}: {:6d} mentions in {:6.2f}s -> {:8.1f} mentions/s, user cache: {}".format(
+        workers, mentions, duration, mentions / duration, bot.user_cache.stats()))
+
+
+if __name__ == '__main__':
+    for w in (1, 8, 32):
+        run(w)
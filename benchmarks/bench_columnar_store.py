@@ -0,0 +1,81 @@
+"""
+Aggregates a synthetic history of ten million workouts stored in the columnar format.
+
+Run from the repository root: python -m benchmarks.bench_columnar_store [workouts]
+The history is generated with numpy if it is installed, which is also needed for fast aggregation.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from array import array
+
+from movement_bot.columnar_store import COLUMNS, META_FILE, ColumnarHistory, _column_file
+from movement_bot.statistics_generator import DIFFICULTIES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+USERS = 2000
+EXERCISES = 60
+EXERCISES_PER_WORKOUT = 6
+
+
+def generate(directory, rows):
+    """ Writes random columns directly, converting millions of csv rows would dominate the benchmark. """
+    entries = rows * EXERCISES_PER_WORKOUT
+    if numpy is not None:
+        rng = numpy.random.default_rng(1)
+        columns = {
+            'user': rng.integers(0, USERS, rows, dtype='i4'),
+            'time': numpy.sort(rng.integers(1500000000, 1800000000, rows, dtype='i8')) * 1000000,
+            'difficulty': rng.integers(0, 3, rows, dtype='i1'),
+            'offsets': numpy.arange(rows + 1, dtype='i8') * EXERCISES_PER_WORKOUT,
+            'exercise': rng.integers(0, EXERCISES, entries, dtype='i4'),
+            'count': rng.integers(5, 60, entries, dtype='i4'),
+        }
+    else:
+        rng = random.Random(1)
+        columns = {
+            'user': array('i', (rng.randrange(USERS) for _ in range(rows))),
+            'time': array('q', sorted(rng.randrange(1500000000, 1800000000) * 1000000 for _ in range(rows))),
+            'difficulty': array('b', (rng.randrange(3) for _ in range(rows))),
+            'offsets': array('q', range(0, (rows + 1) * EXERCISES_PER_WORKOUT, EXERCISES_PER_WORKOUT)),
+            'exercise': array('i', (rng.randrange(EXERCISES) for _ in range(entries))),
+            'count': array('i', (rng.randrange(5, 60) for _ in range(entries))),
+        }
+
+    for column in COLUMNS:
+        with open(_column_file(directory, column), 'wb') as f:
+            f.write(columns[column].tobytes())
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump({
+            'rows': rows,
+            'entries': entries,
+            'byteorder': sys.byteorder,
+            'users': ['user{}'.format(i) for i in range(USERS)],
+            'user_names': ['user{}'.format(i) for i in range(USERS)],
+            'exercises': ['exercise{}'.format(i) for i in range(EXERCISES)],
+            'difficulties': DIFFICULTIES,
+        }, f)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else (10000000 if numpy is not None else 1000000)
+    with tempfile.TemporaryDirectory() as tmp:
+        generate(tmp, rows)
+
+        start = time.perf_counter()
+        history = ColumnarHistory(tmp)
+        totals = history.totals_per_exercise()
+        per_user = history.workouts_per_user()
+        duration = time.perf_counter() - start
+        history.close()
+
+    print("{} workouts ({}numpy): aggregated per exercise and user in {:.3f}s".format(
+        rows, '' if numpy is not None else 'no ', duration))
+    assert sum(per_user.values()) == rows and len(totals) == EXERCISES
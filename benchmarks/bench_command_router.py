@@ -0,0 +1,57 @@
+"""
+Compares dispatching messages with CommandRouter to the former chain of re.match calls.
+
+Run from the repository root: python -m benchmarks.bench_command_router
+"""
+import re
+import timeit
+
+from movement_bot.command_router import CommandRouter
+
+USERNAME = 'movebot'
+CORPUS = [
+    '@movebot done easy', '@movebot done medium', '@movebot done hard', 'done hard', '@movebot  done hard ',
+    '@movebot stats', '@movebot stats alice', '@movebot list', '@movebot help', '@movebot what?',
+    '@movebot done extreme', '@movebot stats bob ',
+] * 100
+
+
+def chain(username, message):
+    """ The dispatch as done by ChannelBot and WorkoutMessageHandler before. """
+    if re.match(r'(@' + username + r')?\s*help\s*', message):
+        return 'help'
+    if re.match(r'(@' + username + r')?\s*list\s*$', message):
+        return 'list'
+    elif re.match(r'(@' + username + r')?\s*stats\s*$', message):
+        return 'stats'
+    else:
+        done_match = re.match(r'(@' + username + r')?\s*done (?P<diff>easy|medium|hard)\s*$', message)
+        stats_match = re.match(r'(@' + username + r')?\s*stats (?P<user_name>[a-zA-Z0-9]+)\s*$', message)
+        if done_match:
+            return 'done', done_match.group('diff')
+        elif stats_match:
+            return 'stats', stats_match.group('user_name')
+        return 'unknown'
+
+
+def build_router():
+    router = CommandRouter(USERNAME)
+    router.register(r'help\s*', lambda: 'help')
+    router.register(r'list\s*$', lambda: 'list')
+    router.register(r'stats\s*$', lambda: 'stats')
+    router.register(r'done (?P<diff>easy|medium|hard)\s*$', lambda diff: ('done', diff))
+    router.register(r'stats (?P<user_name>[a-zA-Z0-9]+)\s*$', lambda user_name: ('stats', user_name))
+    router.set_default(lambda: 'unknown')
+    router.compile()
+    return router
+
+
+if __name__ == '__main__':
+    router = build_router()
+    assert [chain(USERNAME, m) for m in CORPUS] == [router.dispatch(m) for m in CORPUS]
+
+    runs = 20
+    t_chain = min(timeit.repeat(lambda: [chain(USERNAME, m) for m in CORPUS], number=1, repeat=runs))
+    t_router = min(timeit.repeat(lambda: [router.dispatch(m) for m in CORPUS], number=1, repeat=runs))
+    print("re.match chain: {:6.2f} us/message".format(t_chain / len(CORPUS) * 1e6))
+    print("CommandRouter:  {:6.2f} us/message".format(t_router / len(CORPUS) * 1e6))
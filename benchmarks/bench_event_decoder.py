@@ -0,0 +1,139 @@
+"""
+Compares the CPU time per websocket event of the former handling (parse every frame, then data.post and data.mentions
+of every post) with the EventDecoder, using json and - if installed - orjson.
+
+By default a stream is generated in the format mattermost sends, with a typical mix of event types on a busy server.
+A recorded stream (one raw frame per line) can be replayed instead:
+
+    python -m benchmarks.bench_event_decoder --file events.txt --user-id <bot user id>
+
+Run from the repository root: python -m benchmarks.bench_event_decoder
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+
+from movement_bot import event_decoder
+from movement_bot.event_decoder import EventDecoder
+
+BOT_ID = 'b' * 26
+# share of frames per event type
+MIX = [
+    ('typing', 35),
+    ('status_change', 15),
+    ('channel_viewed', 15),
+    ('reaction_added', 5),
+    ('posted', 25),
+    ('mention', 5),
+]
+
+
+def _id(rng):
+    return uuid.UUID(int=rng.getrandbits(128)).hex[:26]
+
+
+def generate_stream(count, seed=1) -> [str]:
+    rng = random.Random(seed)
+    users = [_id(rng) for _ in range(200)]
+    channels = [_id(rng) for _ in range(20)]
+    kinds = [k for k, share in MIX for _ in range(share)]
+
+    frames = []
+    for seq in range(count):
+        kind = rng.choice(kinds)
+        user_id, channel_id = rng.choice(users), rng.choice(channels)
+        broadcast = {'omit_users': None, 'user_id': '', 'channel_id': channel_id, 'team_id': ''}
+        if kind == 'typing':
+            event = {'event': 'typing', 'data': {'parent_id': '', 'user_id': user_id},
+                     'broadcast': dict(broadcast, omit_users={user_id: True})}
+        elif kind == 'status_change':
+            event = {'event': 'status_change', 'data': {'status': rng.choice(['online', 'away']), 'user_id': user_id},
+                     'broadcast': dict(broadcast, channel_id='', user_id=user_id)}
+        elif kind == 'channel_viewed':
+            event = {'event': 'channel_viewed', 'data': {'channel_id': channel_id},
+                     'broadcast': dict(broadcast, channel_id='', user_id=user_id)}
+        elif kind == 'reaction_added':
+            reaction = {'user_id': user_id, 'post_id': _id(rng), 'emoji_name': '+1', 'create_at': 1700000000000 + seq}
+            event = {'event': 'reaction_added', 'data': {'reaction': json.dumps(reaction)}, 'broadcast': broadcast}
+        else:
+            mention = kind == 'mention'
+            message = ('@bot done easy' if mention else
+                       ' '.join(rng.choice(['lunch', 'deploy', 'coffee', 'review', 'meeting', 'ok']) for _ in range(12)))
+            post = {
+                'id': _id(rng), 'create_at': 1700000000000 + seq, 'update_at': 1700000000000 + seq, 'edit_at': 0,
+                'delete_at': 0, 'is_pinned': False, 'user_id': user_id, 'channel_id': channel_id, 'root_id': '',
+                'original_id': '', 'message': message, 'type': '', 'props': {}, 'hashtags': '', 'pending_post_id': '',
+                'reply_count': 0, 'metadata': {},
+            }
+            data = {'channel_display_name': 'Town Square', 'channel_name': 'town-square', 'channel_type': 'O',
+                    'post': json.dumps(post), 'sender_name': '@user', 'set_online': True, 'team_id': _id(rng)}
+            if mention:
+                data['mentions'] = json.dumps([BOT_ID])
+            event = {'event': 'posted', 'data': data, 'broadcast': broadcast}
+        event['seq'] = seq
+        frames.append(json.dumps(event))
+    return frames
+
+
+def parse_all(frames, user_id) -> int:
+    """ The former handling of the websocket handlers. """
+    mentions = 0
+    for frame in frames:
+        event = json.loads(frame)
+        if 'event' in event and event['event'] == 'posted':
+            mentioned = json.loads(event['data']['mentions']) if 'mentions' in event['data'] else []
+            post = json.loads(event['data']['post'])
+            if user_id in mentioned and post['message']:
+                mentions += 1
+    return mentions
+
+
+def decode_all(frames, user_id) -> int:
+    decoder = EventDecoder(user_id)
+    mentions = 0
+    for frame in frames:
+        event = decoder.decode(frame)
+        if event and event['event'] == 'posted' and user_id in event['data'].get('mentions', []):
+            mentions += 1
+    return mentions
+
+
+def measure(label, function, frames, user_id, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        mentions = function(frames, user_id)
+        cpu = time.process_time() - start
+        best = cpu if best is None else min(best, cpu)
+    print("{:<24} {:7.2f} us/event, {} mentions".format(label, best / len(frames) * 1e6, mentions))
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', help='recorded stream, one frame per line')
+    parser.add_argument('--user-id', default=BOT_ID, help='user id of the bot in the recorded stream')
+    parser.add_argument('--events', type=int, default=50000, help='number of generated events')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'r') as f:
+            frames = [line.rstrip('\n') for line in f if line.strip()]
+    else:
+        frames = generate_stream(args.events)
+
+    baseline = measure('json, parse all', parse_all, frames, args.user_id)
+
+    loads = event_decoder.loads
+    event_decoder.loads = json.loads
+    decoded = measure('json, prefiltered', decode_all, frames, args.user_id)
+    event_decoder.loads = loads
+    print("CPU per event: {:.0%} of parsing all".format(decoded / baseline))
+
+    if event_decoder.orjson:
+        decoded = measure('orjson, prefiltered', decode_all, frames, args.user_id)
+        print("CPU per event: {:.0%} of parsing all".format(decoded / baseline))
+    else:
+        print("orjson is not installed")
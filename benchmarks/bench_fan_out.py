@@ -0,0 +1,26 @@
+"""
+Broadcasts messages to an increasing number of subscribers via DirectMessageFanOut against the fake mattermost server.
+
+Run from the repository root: python -m benchmarks.bench_fan_out
+"""
+import time
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from movement_bot.fan_out import DirectMessageFanOut
+
+
+def run(subscribers, parallelism=64):
+    server = FakeMattermost(latency=0.005)
+    fan_out = DirectMessageFanOut(FakeDriver(server), server.bot['id'], parallelism=parallelism)
+    user_ids = [server.add_user('user{}'.format(i))['id'] for i in range(subscribers)]
+
+    for broadcast in ('cold', 'warm'):
+        start = time.perf_counter()
+        failures = fan_out.broadcast(user_ids, 'Los jetzt - beweg dich!')
+        duration = time.perf_counter() - start
+        print("subscribers={:5d} ({}): {:6.3f}s, failures={}".format(subscribers, broadcast, duration, len(failures)))
+
+
+if __name__ == '__main__':
+    for n in (10, 100, 1000, 3000):
+        run(n)
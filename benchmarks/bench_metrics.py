@@ -0,0 +1,46 @@
+"""
+Measures the overhead of the metrics instrumentation on command dispatch and REST calls, with metrics disabled (the
+default) and enabled, and shows the export of a MetricsServer.
+
+Run from the repository root: python -m benchmarks.bench_metrics
+"""
+import timeit
+import urllib.request
+
+from benchmarks.bench_command_router import CORPUS, build_router
+from movement_bot.metrics import REGISTRY, MetricsServer, rest_call
+
+
+def dispatch_all(router):
+    for message in CORPUS:
+        router.dispatch(message)
+
+
+def call_all():
+    for message in CORPUS:
+        rest_call('create_post', len, message)
+
+
+def measure(label, statement):
+    seconds = min(timeit.repeat(statement, number=20, repeat=5)) / 20 / len(CORPUS)
+    print("{:<32} {:8.2f} us".format(label, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    router = build_router()
+
+    REGISTRY.enabled = False
+    measure('dispatch, metrics disabled', lambda: dispatch_all(router))
+    measure('rest call, metrics disabled', call_all)
+
+    REGISTRY.enabled = True
+    measure('dispatch, metrics enabled', lambda: dispatch_all(router))
+    measure('rest call, metrics enabled', call_all)
+
+    server = MetricsServer(port=0)
+    server.start()
+    with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.port)) as response:
+        exported = response.read().decode('utf-8')
+    print("\nexported {} lines, e.g.:".format(len(exported.splitlines())))
+    print("\n".join(l for l in exported.splitlines() if 'command="done"' in l and '_count' in l))
+    server.stop()
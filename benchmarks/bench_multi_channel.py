@@ -0,0 +1,89 @@
+"""
+Compares memory, threads and connections of one ChannelBot serving many channels to one ChannelBot per channel.
+
+The channels are built by bot.py's WorkoutChannel from a config file section per channel, so they watch their exercise
+file and journal their workouts like the bot does. Every setup is measured in a new process, which counts the threads
+shared by all channels as well.
+
+Run from the repository root: python -m benchmarks.bench_multi_channel
+"""
+import configparser
+import multiprocessing
+import os
+import tempfile
+import threading
+import tracemalloc
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from bot import C_CHANNEL_SEC_PREFIX, C_SEC, WorkoutChannel
+from movement_bot.channel_bot import ChannelBot
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+
+
+def create_config(tmp, channels) -> (configparser.ConfigParser, [str]):
+    conf = configparser.ConfigParser()
+    conf[C_SEC] = {
+        'server': 'localhost', 'port': '8065', 'token': 'token', 'team_name': 'test', 'channel_name': 'channel0',
+        'exercise_file': EXERCISE_FILE, 'bot_active_from': '0', 'bot_active_to': '23', 'bot_active_on_weekend': 'True',
+        'exercise_between_min': '60', 'exercise_between_max': '60', 'exercise_strength_count': '1',
+        'exercise_mobility_count': '1', 'csv_workouts': os.path.join(tmp, 'workouts0.csv'),
+        'journal_workouts': os.path.join(tmp, 'workouts0.journal'),
+    }
+    sections = [C_SEC]
+    for i in range(1, channels):
+        section = '{}{}'.format(C_CHANNEL_SEC_PREFIX, i)
+        conf[section] = {
+            'channel_name': 'channel{}'.format(i),
+            'csv_workouts': os.path.join(tmp, 'workouts{}.csv'.format(i)),
+            'journal_workouts': os.path.join(tmp, 'workouts{}.journal'.format(i)),
+        }
+        sections.append(section)
+    return conf, sections
+
+
+def create_bot(server, channel: WorkoutChannel):
+    return ChannelBot(url=None, token=None, channel_name=channel.channel_name, team_name=channel.team_name,
+                      help_text='help', message_handler=channel.workout_message_handler, driver=FakeDriver(server))
+
+
+def shared(server, channels: [WorkoutChannel]):
+    bot = create_bot(server, channels[0])
+    for channel in channels[1:]:
+        bot.add_channel(channel.team_name, channel.channel_name, channel.workout_message_handler)
+    return [bot]
+
+
+def separate(server, channels: [WorkoutChannel]):
+    return [create_bot(server, channel) for channel in channels]
+
+
+def measure(setup, channels) -> (int, int, int):
+    server = FakeMattermost(latency=0)
+    threads = threading.active_count()
+    with tempfile.TemporaryDirectory() as tmp:
+        conf, sections = create_config(tmp, channels)
+        tracemalloc.start()
+        workout_channels = [WorkoutChannel(conf, s) for s in sections]
+        bots = setup(server, workout_channels)
+        # the journal writer is started by the first write
+        for channel in workout_channels:
+            channel.workout_message_handler.journal.checkpoint().result()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return memory, threading.active_count() - threads, len(bots)
+
+
+def run(setup, channels):
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        memory, threads, websockets = pool.apply(measure, (setup, channels))
+
+    # every bot holds one websocket and one HTTP connection pool
+    print("{:8} channels={:4d}: memory={:8.1f} KiB, threads={:5d}, websockets={:4d}".format(
+        setup.__name__, channels, memory / 1024, threads, websockets))
+
+
+if __name__ == '__main__':
+    for n in (1, 10, 100, 300):
+        run(shared, n)
+        run(separate, n)
@@ -0,0 +1,36 @@
+"""
+Sends a burst of answers through PostSender against a rate limited fake mattermost server and reports throughput and
+latency percentiles.
+
+Run from the repository root: python -m benchmarks.bench_post_sender
+"""
+import time
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from movement_bot.post_sender import PostSender
+
+
+def run(posts=300, threads=10, coalesce=False):
+    server = FakeMattermost(latency=0.01, rate_limit=50)
+    driver = FakeDriver(server)
+    sender = PostSender(driver.posts.create_post, rate=40, burst=40, workers=8, backoff=0.2, coalesce_window=0.2)
+
+    start = time.perf_counter()
+    futures = []
+    for i in range(posts):
+        options = {'channel_id': 'channel-test', 'root_id': 'thread-{}'.format(i % threads), 'message': str(i)}
+        futures.append(sender.send(options, coalesce=coalesce))
+    for f in futures:
+        f.exception()
+    duration = time.perf_counter() - start
+
+    stats = sender.stats()
+    print("coalesce={!s:5}: {} answers in {:5.2f}s ({:6.1f}/s) as {} posts, failed={}, retries={}, 429s={}, "
+          "p50={:.3f}s p90={:.3f}s p99={:.3f}s".format(
+              coalesce, posts, duration, posts / duration, len(server.posts), stats['failed'], stats['retries'],
+              server.rejected, stats['p50'], stats['p90'], stats['p99']))
+
+
+if __name__ == '__main__':
+    run(coalesce=False)
+    run(coalesce=True)
@@ -0,0 +1,66 @@
+"""
+Drops the websocket connection of ChannelBot repeatedly while mentions arrive and checks that every mention is answered
+exactly once, thanks to the backfill of missed posts and deduplication by post id.
+
+Run from the repository root: python -m benchmarks.bench_reconnect
+"""
+import collections
+import threading
+import time
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from movement_bot.channel_bot import ChannelBot
+
+
+class EchoHandler:
+    """ Answers every mention in its thread. """
+
+    def register_commands(self, router):
+        router.set_default(lambda message: message.answer('ok'))
+
+
+def run(mentions=1000, drop_every=0.2, downtime=0.1, rate=500):
+    server = FakeMattermost(latency=0.001)
+    bot = ChannelBot(url=None, token=None, channel_name='test', team_name='test', help_text='help',
+                     message_handler=EchoHandler(), driver=FakeDriver(server), post_rate=10000, post_burst=1000,
+                     reconnect_min=0.02, reconnect_max=0.2, backfill_page_size=50)
+    bot.start_listening()
+    user = server.add_user('alice')
+    # the bot has to see a post before, as it would in practice
+    time.sleep(0.1)
+    server.queue_mention(user, 'warm up')
+    server.wait_for_posts(1)
+
+    sending = True
+
+    def drop():
+        while sending:
+            time.sleep(drop_every)
+            server.drop_connection(downtime)
+
+    dropper = threading.Thread(target=drop)
+    dropper.start()
+
+    sent = []
+    start = time.perf_counter()
+    for i in range(mentions):
+        sent.append(server.queue_mention(user, 'mention {}'.format(i))['id'])
+        time.sleep(1 / rate)
+    sending = False
+    dropper.join()
+
+    complete = server.wait_for_posts(mentions + 1, timeout=30)
+    time.sleep(0.5)
+    duration = time.perf_counter() - start
+
+    answers = collections.Counter(p.get('root_id') for p in server.posts)
+    lost = sum(1 for post_id in sent if answers[post_id] == 0)
+    duplicated = sum(1 for post_id in sent if answers[post_id] > 1)
+    print("{} mentions, {} connection drops in {:.1f}s: {} lost, {} answered twice, complete: {}".format(
+        mentions, server.drops, duration, lost, duplicated, complete))
+    print("health: {}".format(bot.health()))
+    bot.stop_listening()
+
+
+if __name__ == '__main__':
+    run()
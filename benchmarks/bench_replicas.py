@@ -0,0 +1,197 @@
+"""
+Runs several ChannelBot replicas coordinated by a shared ReplicaCoordinator against the fake mattermost server. Users
+send done/stats mentions while the leader announces workouts; midway the leader crashes (stops listening and renewing
+its lease without handing it over).
+
+Checked afterwards:
+- every mention is answered exactly once, also those sent to the crashed replica's users
+- workouts are announced once, on the schedule planned by the leader, and a new leader goes on with it
+- mentions claimed by the crashed replica but not handled are taken over once their claims expire
+- every recorded workout is stored exactly once
+
+Run from the repository root: python -m benchmarks.bench_replicas
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+from movement_bot.channel_bot import ChannelBot
+from movement_bot.exercises import ExerciseRegistry
+from movement_bot.replicas import ReplicaCoordinator
+from movement_bot.workout_handler import WorkoutMessageHandler
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+COMMANDS = ['done easy', 'done medium', 'done hard', 'stats']
+
+
+class Replica:
+
+    def __init__(self, server, index, db_file, csv_file, lease_ttl, announce_every):
+        self.coordinator = ReplicaCoordinator(db_file, 'replica-{}'.format(index), lease_ttl=lease_ttl,
+                                              claim_timeout=2 * lease_ttl)
+        self.handler = WorkoutMessageHandler(ExerciseRegistry(EXERCISE_FILE, 1, 1, seed=index), csv_file,
+                                             coordinator=self.coordinator, channel='test')
+        self.bot = ChannelBot(url=None, token=None, channel_name='test', team_name='test', help_text='help',
+                              message_handler=self.handler, driver=FakeDriver(server), post_rate=100000,
+                              post_burst=10000, coalesce_window=0, coordinator=self.coordinator)
+        self.announce_every = announce_every
+        self.announcements = []  # time.monotonic() of the announcements of this replica
+        self.recorded = set()  # (session, user id) of workouts recorded by this replica
+        self.lost_claims = []  # mentions claimed after the crash
+        self.running = True
+
+        record = self.coordinator.record_workout
+
+        def recording(channel, entry, max_open):
+            recorded = record(channel, entry, max_open)
+            if recorded:
+                self.recorded.add((entry['session'], entry['user_id']))
+            return recorded
+        self.coordinator.record_workout = recording
+
+    def start(self):
+        self.coordinator.start()
+        self.bot.start_listening()
+        self._thread = threading.Thread(target=self._schedule)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _schedule(self):
+        # like WorkoutChannel.start_workout with a schedule firing every announce_every seconds
+        next_fire = datetime.datetime.now(datetime.timezone.utc)
+        while self.running:
+            time.sleep(max(0.0, (next_fire - datetime.datetime.now(datetime.timezone.utc)).total_seconds()))
+            if not self.running:
+                break
+            now = datetime.datetime.now(datetime.timezone.utc)
+            later = self.coordinator.follow_plan('test', now)
+            if later is not None:
+                next_fire = later
+                continue
+
+            self.announcements.append(time.monotonic())
+            session = self.handler.open_session()
+            post = self.bot.send_message_to_channel('workout {}'.format(session.version)).result()
+            self.handler.bind_session(session, post['id'])
+            next_fire = now + datetime.timedelta(seconds=self.announce_every)
+            self.coordinator.plan_fire('test', next_fire)
+
+    def crash(self):
+        """
+        Stops everything but keeps the lease, so the others have to wait for it to expire. Mentions arriving during the
+        last 0.1s are claimed but neither handled nor completed, as if the replica died while handling them.
+        """
+        self.running = False
+        self._thread.join()
+        self.coordinator._stopped.set()
+        self.bot._handle_bot_message = lambda *mention: self.coordinator.claim(mention[4]) and self.lost_claims.append(
+            mention[4])
+        threading.Timer(0.1, self.bot.stop_listening).start()
+
+    def stop(self):
+        self.running = False
+        self.coordinator.stop()
+        self.bot.stop_listening()
+
+
+def run(replicas=3, duration=6.0, rate=200, users=100, lease_ttl=1.0, latency=0.002, seed=1, announce_every=0.3):
+    server = FakeMattermost(latency=latency)
+    senders = [server.add_user('user{}'.format(i)) for i in range(users)]
+    rng = random.Random(seed)
+    errors = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file, csv_file = os.path.join(tmp, 'replicas.sqlite'), os.path.join(tmp, 'workouts.csv')
+        bots = [Replica(server, i, db_file, csv_file, lease_ttl, announce_every) for i in range(replicas)]
+        for replica in bots:
+            replica.start()
+        time.sleep(0.5)
+
+        sent = []
+        crashed = None
+        crashed_at = None
+        start = time.monotonic()
+        for i in range(int(duration * rate)):
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if crashed is None and time.monotonic() - start > duration / 3:
+                crashed = next(r for r in bots if r.coordinator.is_leader)
+                crashed.crash()
+                crashed_at = time.monotonic()
+            sent.append(server.queue_mention(rng.choice(senders), rng.choice(COMMANDS))['id'])
+
+        # mentions of the crashed replica's users are taken over after twice the lease period
+        deadline = time.monotonic() + 10 * lease_ttl
+        while len(server.answered) < len(sent) and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        survivors = [r for r in bots if r is not crashed]
+        leader = next((r for r in survivors if r.coordinator.is_leader), None)
+        if leader is None:
+            errors.append("no replica took over the leader lease")
+        else:
+            failover = min((t for t in leader.announcements if t > crashed_at), default=None)
+            # close all sessions, storing their workouts
+            for r in survivors:
+                r.running = False
+            time.sleep(0.5)
+            for _ in range(leader.handler.sessions.max_open):
+                leader.handler.open_session()
+            stored = leader.handler.workout_store.get_workouts()
+
+        answers = Counter(p['root_id'] for p in server.posts if p.get('root_id'))
+        for replica in survivors:
+            replica.stop()
+
+    announcements = sorted(t for r in bots for t in r.announcements)
+    twice = sum(1 for a, b in zip(announcements, announcements[1:]) if b - a < announce_every / 2)
+    if twice:
+        errors.append("{} workouts announced by two replicas".format(twice))
+
+    lost = sum(1 for post_id in sent if post_id not in answers)
+    duplicated = sum(1 for post_id in sent if answers[post_id] > 1)
+    if lost or duplicated:
+        errors.append("{} mentions not answered, {} answered more than once".format(lost, duplicated))
+
+    if leader is not None:
+        keys = Counter((r['session'], r['user_id']) for r in stored)
+        recorded = set().union(*(r.recorded for r in bots))
+        if any(count > 1 for count in keys.values()):
+            errors.append("{} workouts stored more than once".format(sum(1 for c in keys.values() if c > 1)))
+        if set(keys) != recorded:
+            errors.append("{} recorded workouts not stored, {} unexpected".format(
+                len(recorded - set(keys)), len(set(keys) - recorded)))
+        if leader.coordinator.pending_workouts('test'):
+            errors.append("workouts left in the database")
+
+    for replica in bots:
+        print("{}: {} announcements, {} workouts recorded{}".format(
+            replica.coordinator.replica_id, len(replica.announcements), len(replica.recorded),
+            " (crashed, {} unhandled claims)".format(len(replica.lost_claims)) if replica is crashed else
+            " (leader)" if replica is leader else ""))
+    if leader is not None:
+        print("new leader announced {}".format(
+            "{:.1f}s after the crash".format(failover - crashed_at) if failover else "nothing"))
+        print("{} mentions, {} workouts stored: {}".format(len(sent), len(stored),
+                                                          "ok" if not errors else "{} errors".format(len(errors))))
+    for error in errors:
+        print("  " + error)
+    return not errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--duration', type=float, default=6.0, help='seconds mentions are sent')
+    parser.add_argument('--rate', type=float, default=200, help='mentions per second')
+    parser.add_argument('--lease-ttl', type=float, default=1.0, help='seconds of the leader lease')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.replicas, args.duration, args.rate, lease_ttl=args.lease_ttl) else 1)
@@ -0,0 +1,148 @@
+"""
+Breaks down the time from starting the bot to its first websocket event, without and with startup cache.
+
+Every start runs in a fresh interpreter, so imports are measured as on a real start. The first (cold) start resolves
+the bot's ids from the fake server and fills the cache, the second (warm) one takes them from the cache. The fake
+server delays every request by --latency seconds, like the round trip to a real server.
+
+    imports         modules of the bot
+    exercises       loading the exercise catalogue
+    workouts        loading the workout csv file (--rows rows) and aggregating the statistics
+    driver import   importing the mattermost driver (if installed), which the bot does when creating its ChannelBot
+    identity        user and channel ids, from the server or the cache
+    first event     connecting the websocket until the first event arrives
+
+Run from the repository root: python -m benchmarks.bench_startup
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+PHASES = ['imports', 'exercises', 'workouts', 'driver import', 'identity', 'first event']
+MODES = ['cold', 'warm']
+
+
+def write_workouts(csv_file, rows):
+    day = datetime.datetime(2020, 1, 1, 9)
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user_id', 'user_name', 'datetime', 'difficulty', 'workout', 'session'])
+        for i in range(rows):
+            # 50 users, 10 workouts a day
+            time_of_day = day + datetime.timedelta(days=i // 500, minutes=45 * (i // 50 % 10))
+            writer.writerow(['user-{}'.format(i % 50), 'user{}'.format(i % 50), str(time_of_day),
+                             ['easy', 'medium', 'hard'][i % 3], 'Pushups:10|Squats:20', 'session-{}'.format(i // 50)])
+
+
+def start(args) -> dict:
+    """ Starts a bot like bot.py does. :return: seconds per phase """
+    timings = dict()
+    mark = time.perf_counter()
+
+    def phase(name):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[name] = now - mark
+        mark = now
+
+    from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+    from movement_bot.channel_bot import ChannelBot
+    from movement_bot.exercises import ExerciseRegistry
+    from movement_bot.scheduler import Scheduler
+    from movement_bot.startup_cache import StartupCache
+    from movement_bot.workout_handler import WorkoutMessageHandler
+    phase('imports')
+
+    registry = ExerciseRegistry(EXERCISE_FILE, 1, 1)
+    phase('exercises')
+
+    handler = WorkoutMessageHandler(registry, args.csv)
+    phase('workouts')
+
+    installed = import_driver()
+    phase('driver import')
+
+    server = FakeMattermost(latency=args.latency)
+    bot = ChannelBot(url='fake', token='token', channel_name='test', team_name='test', help_text='help',
+                     message_handler=handler, driver=FakeDriver(server),
+                     startup_cache=StartupCache(args.cache) if args.cache else None)
+    phase('identity')
+
+    first_event = threading.Event()
+    websocket_handler = bot.websocket_handler
+
+    async def handle(event_json):
+        first_event.set()
+        await websocket_handler(event_json)
+    bot.websocket_handler = handle
+    bot.start_listening()
+    first_event.wait()
+    phase('first event')
+
+    # the validation of cached ids, which runs after the first event
+    bot._executor.shutdown(wait=True)
+    timings['driver installed'] = installed
+    return timings
+
+
+def import_driver() -> bool:
+    try:
+        import mattermostdriver
+    except ImportError:
+        return False
+    return True
+
+
+def run_start(args, cache):
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--start', '--csv', args.csv,
+                             '--latency', str(args.latency)] + (['--cache', cache] if cache else []),
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000, help='rows of the workout file')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every request to the server takes')
+    parser.add_argument('--repeat', type=int, default=3, help='starts per mode, the fastest one is shown')
+    parser.add_argument('--start', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--csv', help=argparse.SUPPRESS)
+    parser.add_argument('--cache', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.start:
+        print(json.dumps(start(args)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args.csv = os.path.join(tmp, 'workouts.csv')
+        write_workouts(args.csv, args.rows)
+        cache = os.path.join(tmp, 'startup.json')
+
+        results = dict()
+        for mode in MODES:
+            runs = []
+            for _ in range(args.repeat):
+                if mode == 'cold' and os.path.exists(cache):
+                    os.remove(cache)
+                runs.append(run_start(args, cache))
+            results[mode] = min(runs, key=lambda r: sum(r[p] for p in PHASES))
+
+    print(("{:<14}" + "{:>10}" * len(MODES)).format('ms', *MODES))
+    for name in PHASES + ['total']:
+        print(("{:<14}" + "{:>10.1f}" * len(MODES)).format(name, *(
+            sum(results[m][p] for p in ([name] if name in PHASES else PHASES)) * 1000 for m in MODES)))
+    if not results['warm']['driver installed']:
+        print("mattermostdriver is not installed, the driver import takes no time")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Generates 100k workout sets with ExerciseRegistry, one at a time as before and in a batch.
+
+Run from the repository root: python -m benchmarks.bench_workout_generation
+"""
+import os
+import random
+import time
+
+from movement_bot.exercises import ExerciseRegistry
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json')
+SETS = 100000
+
+
+def create_set_as_before(registry: ExerciseRegistry) -> dict:
+    """ The former create_new_workout_set, rebuilding the Exercise tuples for every workout. """
+    workout_set = dict()
+    for diff in registry.Difficulty:
+        res = []
+        for type, k in ((registry.STRENGTH, 3), (registry.MOBILITY, 3)):
+            exercises = list(map(lambda e: registry.Exercise(**e), registry._catalogue.exercises[diff.value[1]][type]))
+            for e in random.sample(exercises, k=k):
+                res.append((e.name, int(random.randint(e.min, e.max)), e.unit))
+        workout_set[diff.value[1]] = res
+    return workout_set
+
+
+if __name__ == '__main__':
+    registry = ExerciseRegistry(EXERCISE_FILE, 3, 3, seed=42)
+
+    start = time.perf_counter()
+    for _ in range(SETS):
+        create_set_as_before(registry)
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sets = registry.create_workout_sets(SETS)
+    batch = time.perf_counter() - start
+
+    assert sets == ExerciseRegistry(EXERCISE_FILE, 3, 3, seed=42).create_workout_sets(SETS)
+    print("one at a time: {:6.2f}s ({:6.2f} us/set)".format(before, before / SETS * 1e6))
+    print("batch:         {:6.2f}s ({:6.2f} us/set)".format(batch, batch / SETS * 1e6))
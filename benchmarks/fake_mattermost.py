@@ -0,0 +1,250 @@
+"""
+In-process fake of the parts of the mattermost server API used by the bots.
+
+FakeDriver mimics the interface of mattermostdriver.Driver. Every REST call sleeps for a configurable latency to
+simulate the round trip to a real server. Optionally the server answers with 429 like mattermost's rate limiter if
+more than `rate_limit` requests arrive per second.
+
+Every websocket connection receives all events, like the connections of several bot replicas. Events queued while no
+client is connected are delivered to the first one connecting. All connections can be dropped with drop_connection().
+Events not delivered yet are lost then, and connecting fails until the downtime is over - the posts are still in the
+channel history.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import time
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or dict()
+
+
+class FakeHTTPError(Exception):
+
+    def __init__(self, status_code, headers=None):
+        super().__init__('HTTP {}'.format(status_code))
+        self.response = FakeResponse(status_code, headers)
+
+
+class FakeMattermost:
+    """ Server state shared by all drivers. """
+
+    def __init__(self, latency=0.005, bot_name='bot', rate_limit=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rejected = 0
+        self._window = (0, 0)  # (second, requests)
+        self.bot = {'id': 'bot-id', 'username': bot_name}
+        self.users = {self.bot['id']: self.bot}
+        self.posts = []
+        self.events = []  # events queued while no client is connected
+        self._connections = dict()  # connection id -> events not delivered yet
+        self.history = dict()  # channel id -> [post]
+        self.answered = dict()  # root id -> time.perf_counter() of the first answer
+        self.connections = 0
+        self.drops = 0
+        self._down_until = 0
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._posts_changed = threading.Condition(self._lock)
+
+    def request(self):
+        time.sleep(self.latency)
+        if self.rate_limit:
+            with self._lock:
+                second, count = self._window
+                now = int(time.monotonic())
+                count = count + 1 if second == now else 1
+                self._window = (now, count)
+                if count > self.rate_limit:
+                    self.rejected += 1
+                    raise FakeHTTPError(429)
+
+    def add_user(self, name) -> dict:
+        user = {'id': 'user-' + name, 'username': name}
+        self.users[user['id']] = user
+        return user
+
+    def add_post(self, options) -> dict:
+        post = dict(options, id='post-{}'.format(next(self._ids)), user_id=self.bot['id'],
+                    create_at=int(time.time() * 1000))
+        with self._lock:
+            self.posts.append(post)
+            self.history.setdefault(post['channel_id'], []).append(post)
+            if post.get('root_id'):
+                self.answered.setdefault(post['root_id'], time.perf_counter())
+            self._posts_changed.notify_all()
+        return post
+
+    def wait_for_posts(self, count, timeout=60) -> bool:
+        with self._lock:
+            return self._posts_changed.wait_for(lambda: len(self.posts) >= count, timeout)
+
+    def queue_mention(self, user, message, channel_id='channel-test'):
+        post = {
+            'id': 'post-{}'.format(next(self._ids)),
+            'user_id': user['id'],
+            'channel_id': channel_id,
+            'message': '@{} {}'.format(self.bot['username'], message),
+            'create_at': int(time.time() * 1000),
+        }
+        event = json.dumps({
+            'event': 'posted',
+            'data': {'post': json.dumps(post), 'mentions': json.dumps([self.bot['id']])},
+        })
+        with self._lock:
+            self.history.setdefault(channel_id, []).append(post)
+            # posts are only pushed to connected clients
+            if time.monotonic() >= self._down_until:
+                for events in self._connections.values() or [self.events]:
+                    events.append(event)
+        return post
+
+    def drop_connection(self, downtime=0.0):
+        """ Closes all websocket connections, losing undelivered events. Connecting fails for `downtime` seconds. """
+        with self._lock:
+            self.drops += 1
+            self.events = []
+            self._connections = dict()
+            self._down_until = time.monotonic() + downtime
+
+    def connect(self) -> int:
+        """ :return: id of the new connection """
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                raise ConnectionRefusedError('server is down')
+            self.connections += 1
+            self._connections[self.connections], self.events = self.events, []
+            return self.connections
+
+    def close(self, connection):
+        with self._lock:
+            self._connections.pop(connection, None)
+
+    def is_connected(self, connection) -> bool:
+        return connection in self._connections
+
+    def posts_after(self, channel_id, params) -> dict:
+        """ Answers a request for the posts of a channel like mattermost's /channels/{id}/posts. """
+        with self._lock:
+            history = list(self.history.get(channel_id, []))
+
+        if 'after' in params:
+            ids = [p['id'] for p in history]
+            start = ids.index(params['after']) + 1 if params['after'] in ids else len(history)
+            per_page = params.get('per_page', 60)
+            start += params.get('page', 0) * per_page
+            posts = history[start:start + per_page]
+        elif 'since' in params:
+            # not paginated
+            posts = [p for p in history if p['create_at'] >= params['since']]
+        else:
+            # pages of the latest posts
+            per_page = params.get('per_page', 60)
+            end = len(history) - params.get('page', 0) * per_page
+            posts = history[max(0, end - per_page):max(0, end)]
+
+        return {
+            'order': [p['id'] for p in reversed(posts)],
+            'posts': {p['id']: p for p in posts},
+        }
+
+    def pop_events(self, connection) -> [str]:
+        with self._lock:
+            events = self._connections.get(connection)
+            if events:
+                self._connections[connection] = []
+            return events or []
+
+
+class _Users:
+
+    def __init__(self, server: FakeMattermost):
+        self._server = server
+
+    def get_user(self, user_id):
+        self._server.request()
+        return self._server.users[user_id]
+
+    def get_user_by_username(self, username):
+        self._server.request()
+        return next(u for u in self._server.users.values() if u['username'] == username)
+
+    def get_users_by_ids(self, options):
+        self._server.request()
+        return [self._server.users[user_id] for user_id in options if user_id in self._server.users]
+
+
+class _Posts:
+
+    def __init__(self, server: FakeMattermost):
+        self._server = server
+
+    def create_post(self, options):
+        self._server.request()
+        return self._server.add_post(options)
+
+    def get_posts_for_channel(self, channel_id, params=None):
+        self._server.request()
+        return self._server.posts_after(channel_id, params or dict())
+
+
+class _Channels:
+
+    def __init__(self, server: FakeMattermost):
+        self._server = server
+
+    def get_channel_by_name_and_team_name(self, team_name, channel_name):
+        self._server.request()
+        return {'id': 'channel-' + channel_name, 'name': channel_name, 'team_name': team_name}
+
+    def create_direct_message_channel(self, options):
+        self._server.request()
+        name = '__'.join(sorted(options))
+        return {'id': 'channel-' + name, 'name': name, 'type': 'D'}
+
+
+class _Client:
+
+    def __init__(self):
+        self.token = ''
+
+
+class FakeDriver:
+
+    def __init__(self, server: FakeMattermost):
+        self.server = server
+        self.client = _Client()
+        self.users = _Users(server)
+        self.posts = _Posts(server)
+        self.channels = _Channels(server)
+        self._alive = False
+
+    def login(self):
+        self.server.request()
+        return self.server.bot
+
+    def init_websocket(self, event_handler):
+        # the handshake takes a round trip
+        self.server.request()
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self._emit(event_handler, self.server.connect()))
+        return loop
+
+    def disconnect(self):
+        self._alive = False
+
+    async def _emit(self, event_handler, connection):
+        self._alive = True
+        await event_handler(json.dumps({'event': 'hello', 'seq': 0, 'data': {}}))
+        while self._alive and self.server.is_connected(connection):
+            for event in self.server.pop_events(connection):
+                await event_handler(event)
+            await asyncio.sleep(0.001)
+        self.server.close(connection)
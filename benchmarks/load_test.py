@@ -0,0 +1,214 @@
+"""
+Load test of the bots against the in-process fake mattermost server.
+
+Simulated users send a seeded random mix of commands; the latency of a command is the time from posting it until the
+first answer in its thread. Every target runs in its own process, so the peak memory (max RSS) belongs to it alone.
+
+    channel         ChannelBot with a WorkoutMessageHandler, sending done/stats/list
+    subscription    SubscriptionBot, sending subscribe/unsubscribe/help, followed by one broadcast
+    handler         WorkoutMessageHandler called directly from a thread pool, without bot and server
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --target channel --users 5000 --messages 20000 --rate 1000
+"""
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_mattermost import FakeMattermost, FakeDriver
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+TARGETS = ['channel', 'subscription', 'handler']
+WORKOUT_COMMANDS = ['done easy', 'done medium', 'done hard', 'stats', 'list']
+SUBSCRIPTION_COMMANDS = ['subscribe', 'subscribe', 'unsubscribe', 'help']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, len(values) * p // 100)] if values else 0.0
+
+
+def report(target, args, latencies, duration, extra=''):
+    print("{:<13} users={} messages={}: {:8.1f} msg/s, p50 {:7.2f} ms, p99 {:7.2f} ms, max RSS {:6.1f} MiB{}".format(
+        target, args.users, len(latencies), len(latencies) / duration, percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, extra))
+
+
+def send_mentions(server, users, commands, args, channel_id='channel-test') -> {str: float}:
+    """
+    Posts args.messages mentions by random users, at args.rate per second or as fast as possible.
+    :return: {post id: time.perf_counter() when it was posted}
+    """
+    rng = random.Random(args.seed)
+    sent = dict()
+    start = time.perf_counter()
+    for i in range(args.messages):
+        if args.rate:
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sent_at = time.perf_counter()
+        post = server.queue_mention(rng.choice(users), rng.choice(commands), channel_id)
+        sent[post['id']] = sent_at
+    return sent
+
+
+def wait_for_answers(server, sent, timeout) -> [float]:
+    deadline = time.monotonic() + timeout
+    while len(server.answered) < len(sent) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    answered = server.answered
+    missing = sum(1 for post_id in sent if post_id not in answered)
+    if missing:
+        print("{} messages were not answered within {}s".format(missing, timeout))
+    return [answered[post_id] - sent_at for post_id, sent_at in sent.items() if post_id in answered]
+
+
+def run_channel(args):
+    from movement_bot.channel_bot import ChannelBot
+    from movement_bot.exercises import ExerciseRegistry
+    from movement_bot.workout_handler import WorkoutMessageHandler
+
+    server = FakeMattermost(latency=args.latency)
+    registry = ExerciseRegistry(EXERCISE_FILE, 1, 1, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = WorkoutMessageHandler(registry, os.path.join(tmp, 'workouts.csv'))
+        handler.open_session()
+        bot = ChannelBot(url=None, token=None, channel_name='test', team_name='test', help_text='help',
+                         message_handler=handler, driver=FakeDriver(server), post_rate=100000, post_burst=10000,
+                         coalesce_window=0)
+        bot.start_listening()
+        users = [server.add_user('user{}'.format(i)) for i in range(args.users)]
+
+        # a new workout every second
+        running = True
+
+        def rotate_workouts():
+            while running:
+                time.sleep(1)
+                handler.open_session()
+
+        rotation = threading.Thread(target=rotate_workouts)
+        rotation.daemon = True
+        rotation.start()
+
+        start = time.perf_counter()
+        sent = send_mentions(server, users, WORKOUT_COMMANDS, args)
+        latencies = wait_for_answers(server, sent, args.timeout)
+        duration = time.perf_counter() - start
+        running = False
+
+    report('channel', args, latencies, duration, ", user cache hit rate {:.0%}".format(
+        bot.user_cache.stats()['hit_rate']))
+
+
+def run_subscription(args):
+    from movement_bot.subscription_bot import SubscriptionBot
+
+    server = FakeMattermost(latency=args.latency)
+    with tempfile.TemporaryDirectory() as tmp:
+        bot = SubscriptionBot('bot', None, driver=FakeDriver(server), fan_out_parallelism=64,
+                              subscription_file=os.path.join(tmp, 'subscriptions'))
+        bot.start_listening()
+        users = [server.add_user('user{}'.format(i)) for i in range(args.users)]
+
+        start = time.perf_counter()
+        sent = send_mentions(server, users, SUBSCRIPTION_COMMANDS, args)
+        latencies = wait_for_answers(server, sent, args.timeout)
+        duration = time.perf_counter() - start
+
+        broadcast_start = time.perf_counter()
+        failures = bot.send_messages_to_subscribers('Los jetzt - beweg dich!')
+        broadcast = time.perf_counter() - broadcast_start
+
+    report('subscription', args, latencies, duration, ", broadcast to {} subscribers in {:.2f}s ({} failed)".format(
+        len(bot.subscriptions), broadcast, len(failures)))
+
+
+class _HandlerBot:
+    """ Bot interface needed by WorkoutMessageHandler, answering without any server. """
+
+    def __init__(self, users):
+        self.username = 'bot'
+        self._users = users
+        self.answers = 0
+
+    def get_username(self, user_id):
+        return self._users[user_id]
+
+    def answer_message_in_channel(self, channel_id, post_id, message, coalesce=False):
+        self.answers += 1
+
+
+def run_handler(args):
+    from movement_bot.exercises import ExerciseRegistry
+    from movement_bot.workout_handler import WorkoutMessageHandler
+
+    rng = random.Random(args.seed)
+    registry = ExerciseRegistry(EXERCISE_FILE, 1, 1, seed=args.seed)
+    users = {'user-{}'.format(i): 'user{}'.format(i) for i in range(args.users)}
+    bot = _HandlerBot(users)
+    messages = [(rng.choice(list(users)), '@bot ' + rng.choice(WORKOUT_COMMANDS)) for _ in range(args.messages)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = WorkoutMessageHandler(registry, os.path.join(tmp, 'workouts.csv'))
+        handler.open_session()
+
+        def handle(i):
+            user_id, text = messages[i]
+            start = time.perf_counter()
+            handler.handle_message(user_id, None, text, 'post-{}'.format(i), 'channel-test', bot)
+            if i % 1000 == 999:
+                # a new workout every 1000 messages
+                handler.open_session()
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            latencies = list(executor.map(handle, range(len(messages))))
+        duration = time.perf_counter() - start
+
+    report('handler', args, latencies, duration, ", {} workouts stored".format(len(handler.workout_store)))
+
+
+RUNNERS = {
+    'channel': run_channel,
+    'subscription': run_subscription,
+    'handler': run_handler,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=TARGETS + ['all'], default='all')
+    parser.add_argument('--users', type=int, default=2000, help='number of simulated users')
+    parser.add_argument('--messages', type=int, default=5000, help='number of commands sent')
+    parser.add_argument('--rate', type=float, default=0, help='commands per second, 0 sends as fast as possible')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds every REST call of the fake server takes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for answers')
+    args = parser.parse_args()
+
+    if args.target != 'all':
+        RUNNERS[args.target](args)
+        return
+
+    for target in TARGETS:
+        # a fresh process per target, for independent memory measurements
+        subprocess.run([sys.executable, '-m', 'benchmarks.load_test', '--target', target] + [
+            '--{}={}'.format(k, v) for k, v in vars(args).items() if k != 'target'
+        ], check=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Stress test of workout sessions: one thread opens new sessions (as the scheduler does) as fast as possible, while
+worker threads send 'done' both as top-level posts and as answers in the threads of current and older announcements.
+
+Afterwards all sessions are closed and the stored workouts are checked:
+- every completed (session, user) is stored exactly once, none is lost
+- every stored workout is the one of its session's workout set
+- answers in a thread are credited to its session only, none if the session was closed already
+
+Run from the repository root: python -m benchmarks.stress_sessions
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from movement_bot.exercises import ExerciseRegistry
+from movement_bot.workout_handler import WorkoutMessageHandler
+
+EXERCISE_FILE = os.path.join(os.path.dirname(__file__), '..', 'exercises.json.example')
+DIFFICULTIES = ['easy', 'medium', 'hard']
+
+
+class _Bot:
+    username = 'bot'
+
+    def get_username(self, user_id):
+        return user_id.replace('user-', 'user')
+
+    def answer_message_in_channel(self, channel_id, post_id, message, coalesce=False):
+        pass
+
+
+def run(duration=3.0, workers=8, users=50, open_sessions=3, seed=1):
+    registry = ExerciseRegistry(EXERCISE_FILE, 1, 1, seed=seed)
+    bot = _Bot()
+    errors = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = WorkoutMessageHandler(registry, os.path.join(tmp, 'workouts.csv'),
+                                        os.path.join(tmp, 'workouts.journal'), open_sessions=open_sessions)
+
+        # every completed workout is journaled - record which thread it was sent in
+        sessions = dict()  # workout set id -> Session
+        announcements = []  # post ids of all announcements
+        credited = []  # (thread post id, entry)
+        context = threading.local()
+        record = handler.journal.record
+
+        def recording(entry):
+            thread = getattr(context, 'thread', None)
+            if thread is not None:
+                credited.append((thread, entry))
+            return record(entry)
+        handler.journal.record = recording
+
+        running = True
+
+        def rotate():
+            while running:
+                session = handler.open_session()
+                sessions[session.workout_set.id] = session
+                post_id = 'announcement-{}'.format(session.version)
+                handler.bind_session(session, post_id)
+                announcements.append(post_id)
+                time.sleep(random.uniform(0, 0.002))
+
+        def complete(worker):
+            rng = random.Random(seed + worker)
+            while running:
+                if not announcements:
+                    continue
+                in_thread = rng.random() < 0.5
+                thread = rng.choice(announcements) if in_thread else 'post-{}'.format(rng.random())
+                context.thread = thread
+                user_id = 'user-{}'.format(rng.randrange(users))
+                handler.handle_message(user_id, None, '@bot done ' + rng.choice(DIFFICULTIES), thread, 'channel', bot,
+                                       in_thread)
+                context.thread = None
+
+        threads = [threading.Thread(target=rotate)] + [threading.Thread(target=complete, args=(w,))
+                                                        for w in range(workers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(duration)
+        running = False
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        # close all sessions, storing all workouts
+        for _ in range(open_sessions):
+            session = handler.open_session()
+            sessions[session.workout_set.id] = session
+        stored = handler.workout_store.get_workouts()
+
+    expected = {(e['session'], e['user_id']) for _, e in credited}
+    keys = [(r['session'], r['user_id']) for r in stored]
+    if len(keys) != len(set(keys)):
+        errors.append("{} workouts stored more than once".format(len(keys) - len(set(keys))))
+    if set(keys) != expected:
+        errors.append("{} workouts lost, {} unexpected".format(len(expected - set(keys)), len(set(keys) - expected)))
+
+    for row in stored:
+        workout = sessions[row['session']].workout_set.workout[row['difficulty']]
+        if row['workout'] != "|".join("{}:{}".format(e[0], e[1]) for e in workout):
+            errors.append("workout of session {} does not match its workout set".format(row['session']))
+
+    by_post = {s.post_id: s for s in sessions.values() if s.post_id}
+    for thread, entry in credited:
+        announced = by_post.get(thread)
+        credited_to = sessions[entry['session']]
+        if announced and credited_to is not announced:
+            errors.append("answer in thread of session {} credited to session {}".format(
+                announced.version, credited_to.version))
+
+    print("{} workouts completed in {:.1f}s ({:.0f}/s) across {} sessions, {} stored: {}".format(
+        len(credited), elapsed, len(credited) / elapsed, len(sessions), len(stored),
+        "ok" if not errors else "{} errors".format(len(errors))))
+    for error in errors[:10]:
+        print("  " + error)
+    return not errors
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run() else 1)
@@ -1,18 +1,24 @@
 import datetime
+import os
 import sys
 import time
-import random
 import configparser
 from enum import Enum
 
 from requests import HTTPError
 from movement_bot.channel_bot import ChannelBot
 from movement_bot.exercises import ExerciseRegistry
+from movement_bot.metrics import MetricsServer
+from movement_bot.replicas import ReplicaCoordinator
+from movement_bot.scheduler import ActiveWindow, Scheduler, WorkoutSchedule
+from movement_bot.startup_cache import StartupCache
 from movement_bot.workout_handler import WorkoutMessageHandler
 
 
 CONFIG_FILE = 'bot.conf'
 C_SEC = 'bot'
+# prefix of sections configuring further channels, e.g. [channel:team-b]
+C_CHANNEL_SEC_PREFIX = 'channel:'
 
 
 class ConfigKey(Enum):
@@ -30,18 +36,77 @@ class ConfigKey(Enum):
     EXERCISE_STRENGTH_COUNT = "exercise_strength_count"
     EXERCISE_MOBILITY_COUNT = "exercise_mobility_count"
     CSV_WORKOUTS = "csv_workouts"
+    JOURNAL_WORKOUTS = "journal_workouts"
+    TIMEZONE = "timezone"
+    HOLIDAYS = "holidays"
+    METRICS_PORT = "metrics_port"
+    OPEN_SESSIONS = "open_sessions"
+    REPLICA_DB = "replica_db"
+    STARTUP_CACHE = "startup_cache"
 
 
-def conf_get(conf: configparser.ConfigParser, key: ConfigKey):
-    return conf.get(C_SEC, key.value)
+# keys which may be omitted in the config file
+OPTIONAL_KEYS = {
+    ConfigKey.JOURNAL_WORKOUTS,
+    ConfigKey.TIMEZONE,
+    ConfigKey.HOLIDAYS,
+    ConfigKey.METRICS_PORT,
+    ConfigKey.OPEN_SESSIONS,
+    ConfigKey.REPLICA_DB,
+    ConfigKey.STARTUP_CACHE,
+}
 
 
-def conf_getint(conf: configparser.ConfigParser, key: ConfigKey):
-    return conf.getint(C_SEC, key.value)
+# keys which can't be overridden in channel sections
+CONNECTION_KEYS = {
+    ConfigKey.SERVER,
+    ConfigKey.PORT,
+    ConfigKey.TOKEN,
+    ConfigKey.METRICS_PORT,
+    ConfigKey.REPLICA_DB,
+    ConfigKey.STARTUP_CACHE,
+}
 
 
-def conf_getboolean(conf: configparser.ConfigParser, key: ConfigKey):
-    return conf.getboolean(C_SEC, key.value)
+# files of a channel, which must not be shared with other channels
+CHANNEL_FILE_KEYS = [
+    ConfigKey.CSV_WORKOUTS,
+    ConfigKey.JOURNAL_WORKOUTS,
+]
+
+
+def conf_section(conf: configparser.ConfigParser, section: str, key: ConfigKey) -> str:
+    """ Returns the section to read the key from - channel sections fall back to the bot section. """
+    if key in CONNECTION_KEYS or not conf.has_option(section, key.value):
+        return C_SEC
+    return section
+
+
+def conf_get(conf: configparser.ConfigParser, key: ConfigKey, section=C_SEC):
+    return conf.get(conf_section(conf, section, key), key.value, fallback=None)
+
+
+def check_channel_files(conf: configparser.ConfigParser, sections: [str]):
+    """ Raises a ValueError if channels share a workout or journal file, e.g. by falling back to the bot section. """
+    used = dict()  # absolute path -> section
+    for section in sections:
+        for key in CHANNEL_FILE_KEYS:
+            path = conf_get(conf, key, section)
+            if not path:
+                continue
+            path = os.path.abspath(path)
+            if path in used:
+                raise ValueError("[{}] and [{}] both use {} - set {} in every channel section".format(
+                    used[path], section, path, key.value))
+            used[path] = section
+
+
+def conf_getint(conf: configparser.ConfigParser, key: ConfigKey, section=C_SEC):
+    return conf.getint(conf_section(conf, section, key), key.value)
+
+
+def conf_getboolean(conf: configparser.ConfigParser, key: ConfigKey, section=C_SEC):
+    return conf.getboolean(conf_section(conf, section, key), key.value)
 
 
 HELP_TEXT = """
@@ -49,27 +114,111 @@ HELP_TEXT = """
 | : ----- | :------ |
 | **help** | I think you know what this one does... |
 | **list** | List currently available exercises the workouts are created from. |
-| **done** (**easy**,**medium**,**hard**) | Tell the bot about your accomplished workout. Currently just one workout per "session" is remembered - final one wins.|
-| **stats** [*username*] | Show all-workout statistics (in progress). If a valid username is given, show stats for the particular user.|
+| **done** (**easy**,**medium**,**hard**) | Tell the bot about your accomplished workout. Answer in the thread of an earlier workout to complete that one. Just one workout per "session" is remembered - final one wins.|
+| **current** | Show the current workout again. |
+| **next** | Show the time of the next workout. |
+| **stats** [*username*] | Show all-workout statistics. If a valid username is given, show stats for the particular user.|
+| **stats** (**week**,**month**) | Show the leaderboard of the current week or month. |
+| **stats streaks** | Show current and longest streaks of consecutive workout days. |
+| **stats sessions** | Show the participation in the last workout sessions. |
+| **stats exercises** | Show the total reps/seconds per exercise. |
+| **stats since** *YYYY-MM-DD* | Show all-workout statistics since the given day. |
 """
 
 
+class WorkoutChannel:
+    """ Exercises, workouts and schedule of a single channel. """
+
+    def __init__(self, conf: configparser.ConfigParser, section: str, coordinator: ReplicaCoordinator = None):
+        self.section = section
+        self.coordinator = coordinator
+        self.team_name = conf_get(conf, ConfigKey.TEAM_NAME, section)
+        self.channel_name = conf_get(conf, ConfigKey.CHANNEL_NAME, section)
+        self.channel_id = None
+
+        self.exercise_reg = ExerciseRegistry(
+            conf_get(conf, ConfigKey.EXERCISE_FILE, section),
+            conf_getint(conf, ConfigKey.EXERCISE_STRENGTH_COUNT, section),
+            conf_getint(conf, ConfigKey.EXERCISE_MOBILITY_COUNT, section)
+        )
+        # changes of the exercise file are picked up without restart
+        self.exercise_reg.watch()
+
+        holidays = conf_get(conf, ConfigKey.HOLIDAYS, section) or ''
+        window = ActiveWindow(
+            conf_getint(conf, ConfigKey.BOT_ACTIVE_FROM, section),
+            conf_getint(conf, ConfigKey.BOT_ACTIVE_TO, section),
+            conf_getboolean(conf, ConfigKey.BOT_ACTIVE_ON_WEEKEND, section),
+            conf_get(conf, ConfigKey.TIMEZONE, section),
+            [datetime.date.fromisoformat(d.strip()) for d in holidays.split(',') if d.strip()]
+        )
+
+        self.workout_message_handler = WorkoutMessageHandler(
+            self.exercise_reg,
+            conf_get(conf, ConfigKey.CSV_WORKOUTS, section),
+            conf_get(conf, ConfigKey.JOURNAL_WORKOUTS, section),
+            int(conf_get(conf, ConfigKey.OPEN_SESSIONS, section) or 3),
+            coordinator,
+            section,
+            # streaks continue across weekends and holidays without workouts
+            window.is_active_day
+        )
+
+        self.schedule = WorkoutSchedule(
+            section,
+            window,
+            conf_getint(conf, ConfigKey.EXERCISE_BETWEEN_MIN, section),
+            conf_getint(conf, ConfigKey.EXERCISE_BETWEEN_MAX, section),
+            self.start_workout
+        )
+        self.workout_message_handler.schedule = self.schedule
+        self.bot = None
+
+    def start_workout(self):
+        if self.coordinator:
+            # the schedules of all replicas follow the workouts planned by the leader
+            later = self.coordinator.follow_plan(self.section, datetime.datetime.now(datetime.timezone.utc))
+            if later is not None:
+                return later
+
+        session = self.workout_message_handler.open_session()
+
+        w_message = self.exercise_reg.create_training_message_for_workout_set(session.workout_set)
+        posted = self.bot.send_message_to_channel(w_message, self.channel_id)
+
+        def bind_session(future):
+            # answers in the thread of the announcement are credited to this session
+            if future.exception() is None:
+                self.workout_message_handler.bind_session(session, future.result()['id'])
+        posted.add_done_callback(bind_session)
+        if self.coordinator:
+            self.coordinator.plan_fire(self.section, self.schedule.next_fire)
+
+        next_fire = self.schedule.window.local(self.schedule.next_fire)
+        print("{} - {}: Next workout at {}...".format(time.strftime("%H:%M"), self.channel_name,
+                                                      next_fire.strftime("%Y-%m-%d %H:%M")))
+
+
 if __name__ == '__main__':
     c = configparser.ConfigParser()
     c.read(CONFIG_FILE)
     for k in ConfigKey:
-        assert conf_get(c, k)
-    
-    exercise_reg = ExerciseRegistry(
-        conf_get(c, ConfigKey.EXERCISE_FILE),
-        conf_getint(c, ConfigKey.EXERCISE_STRENGTH_COUNT),
-        conf_getint(c, ConfigKey.EXERCISE_MOBILITY_COUNT)
-    )
-
-    workout_message_handler = WorkoutMessageHandler(
-        exercise_reg,
-        conf_get(c, ConfigKey.CSV_WORKOUTS)
-    )
+        assert k in OPTIONAL_KEYS or conf_get(c, k)
+
+    # replicas of the bot coordinate through a shared database
+    coordinator = ReplicaCoordinator(conf_get(c, ConfigKey.REPLICA_DB)) if conf_get(c, ConfigKey.REPLICA_DB) else None
+    if coordinator:
+        coordinator.start()
+
+    sections = [C_SEC] + [s for s in c.sections() if s.startswith(C_CHANNEL_SEC_PREFIX)]
+    check_channel_files(c, sections)
+    channels = [WorkoutChannel(c, s, coordinator) for s in sections]
+
+    if conf_get(c, ConfigKey.METRICS_PORT):
+        MetricsServer(conf_getint(c, ConfigKey.METRICS_PORT)).start()
+
+    # ids resolved by the last start
+    startup_cache = StartupCache(conf_get(c, ConfigKey.STARTUP_CACHE)) if conf_get(c, ConfigKey.STARTUP_CACHE) else None
 
     bot = None
     try:
@@ -77,39 +226,36 @@ if __name__ == '__main__':
             url=conf_get(c, ConfigKey.SERVER),
             port=conf_getint(c, ConfigKey.PORT),
             token=conf_get(c, ConfigKey.TOKEN),
-            team_name=conf_get(c, ConfigKey.TEAM_NAME),
-            channel_name=conf_get(c, ConfigKey.CHANNEL_NAME),
+            team_name=channels[0].team_name,
+            channel_name=channels[0].channel_name,
             help_text=HELP_TEXT,
-            message_handler=workout_message_handler,
-            debug=False
+            message_handler=channels[0].workout_message_handler,
+            debug=False,
+            coordinator=coordinator,
+            startup_cache=startup_cache
         )
+        channels[0].channel_id = bot.channel_id
+        for channel in channels[1:]:
+            channel.channel_id = bot.add_channel(channel.team_name, channel.channel_name, channel.workout_message_handler)
         bot.start_listening()
+
+        # workouts are scheduled on the websocket loop
+        scheduler = Scheduler()
+        for channel in channels:
+            channel.bot = bot
+            scheduler.add(channel.schedule)
+        bot.run_coroutine(scheduler.run())
     except HTTPError as e:
         print("An error occured during bot initialisation:")
         print(e)
         sys.exit()
 
-    active_from = conf_getint(c, ConfigKey.BOT_ACTIVE_FROM)
-    active_to = conf_getint(c, ConfigKey.BOT_ACTIVE_TO)
-    active_on_weekend = conf_getboolean(c, ConfigKey.BOT_ACTIVE_ON_WEEKEND)
-
-    wait_min = conf_getint(c, ConfigKey.EXERCISE_BETWEEN_MIN)
-    wait_max = conf_getint(c, ConfigKey.EXERCISE_BETWEEN_MAX)
-
-    while True:
-        try:
-            current_hour = int(time.strftime("%H"))
-            is_week_day = (datetime.datetime.today().weekday() < 5)  # mon = 0, ..., sat = 5, sun = 6
-            if (active_from <= current_hour <= active_to) and (is_week_day or active_on_weekend):
-                workout_message_handler.store_completed_workouts()
-                exercise_reg.create_new_workout_set()
-
-                w_message = exercise_reg.create_training_message_for_current_workout_set()
-                bot.send_message_to_channel(w_message)
-
-            wait_minutes = random.randint(wait_min, wait_max)
-            print("{} - Next workout in {} minutes...".format(time.strftime("%H:%M"), wait_minutes))
-            time.sleep(wait_minutes * 60)
-        except KeyboardInterrupt as i:
-            print("Stopping bot...")
-            sys.exit()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt as i:
+        print("Stopping bot...")
+        scheduler.stop()
+        if coordinator:
+            coordinator.stop()
+        sys.exit()
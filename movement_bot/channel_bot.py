@@ -1,96 +1,427 @@
 import asyncio
 import json
+import random
 import re
 import threading
-from mattermostdriver import Driver
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from movement_bot.command_router import CommandRouter, Message
+from movement_bot.event_decoder import EventDecoder
+from movement_bot.metrics import BACKFILLED_POSTS, CACHE_HIT_RATE, QUEUE_DEPTH, RECONNECTS, WEBSOCKET_CONNECTED, \
+    rest_call
+from movement_bot.post_sender import PostSender
+from movement_bot.replicas import ReplicaCoordinator
+from movement_bot.startup_cache import StartupCache
+from movement_bot.user_cache import UserCache
 
 
 class ChannelBot:
-    """ A mattermost bot acting in a specified channel. """
+    """
+    A mattermost bot acting in one or more channels.
+
+    Further channels can be added with their own message handler. All channels share the websocket connection, the
+    HTTP connections, the user cache and the send queue; mentions are routed to the handler of the channel they were
+    posted in. Mentions in other channels (e.g. direct messages) are handled by the first channel's handler.
+
+    Mentions are put into bounded queues by the websocket handler. Every queue is processed by its own worker, which
+    runs the (blocking) message handling in a thread pool, so the websocket loop never waits for REST calls. Mentions
+    are assigned to queues by sender, therefore messages of a single user are handled in order.
+
+    The websocket connection is supervised: if it closes or fails, the bot reconnects with jittered exponential backoff.
+    Websocket frames are prefiltered by an EventDecoder, so events of other types and posts not mentioning the bot are
+    never parsed. Whenever a connection is re-established, posts in the bot's channels since the last event are fetched
+    page by page and missed mentions are handled like live ones. Mentions are deduplicated by post id, so none is
+    handled twice. A heartbeat reconnects if no event arrived for `heartbeat_timeout` seconds.
+
+    With a ReplicaCoordinator several replicas of the bot share the mentions: a replica handles the mentions of the
+    users it owns right away, those of other users only if their owner didn't claim them within `takeover_delay`, or
+    didn't complete its claim before it expired.
+
+    With a StartupCache the ids of the bot's user and channels resolved by an earlier start are used without asking
+    the server, so a restarted bot connects the websocket right away. They are resolved again in the background once
+    listening; if they changed, the cache is updated and the outdated ids are logged - they're used from the next start.
+    """
+    SEEN_POSTS = 10000
+    # milliseconds the backfill reaches back before the last event, the server's clock may differ from ours
+    BACKFILL_MARGIN = 60000
 
-    def __init__(self, url, token, channel_name, team_name, help_text, message_handler, port=8065, scheme='https', debug=False):
+    def __init__(self, url, token, channel_name, team_name, help_text, message_handler, port=8065, scheme='https',
+                 debug=False, driver=None, workers=8, queue_size=100, user_cache_size=1000, user_cache_ttl=3600,
+                 post_rate=10, post_burst=20, coalesce_window=1.0, reconnect_min=1.0, reconnect_max=60.0,
+                 heartbeat_interval=30, heartbeat_timeout=600, backfill_page_size=100,
+                 coordinator: ReplicaCoordinator = None, takeover_delay=None, startup_cache: StartupCache = None):
+        """
+        :param coordinator: coordinates the handling of mentions with other replicas of the bot
+        :param takeover_delay: seconds after which mentions of users owned by other replicas are handled if nobody
+            claimed them, defaults to twice the coordinator's lease period
+        :param startup_cache: ids resolved by earlier starts
+        """
         self.help_text = help_text
         self.message_handler = message_handler
         self.debug = debug
 
-        self.driver = Driver({
-            'url': url,
-            'port': port,
-            'token': token,
-            'scheme': scheme,
-            'debug': debug,
-        })
-        user_result = self.driver.login()
+        if driver is None:
+            # imported only if needed, so the bot runs with another driver (e.g. a fake one) without it installed
+            from mattermostdriver import Driver
+            driver = Driver({
+                'url': url,
+                'port': port,
+                'token': token,
+                'scheme': scheme,
+                'debug': debug,
+            })
+        self.driver = driver
+
+        self.startup_cache = startup_cache
+        self._server = (url, port)
+        self._cached = dict()  # cache key -> value used without asking the server
+        self._cached_channels = dict()  # cache key -> (team name, channel name)
+
+        user_key = StartupCache.key('user', url, port, token)
+        user_result = startup_cache.get(user_key) if startup_cache else None
+        if user_result:
+            # the token is used without logging in, which just fetches the user
+            self.driver.client.token = token
+            self._cached[user_key] = user_result
+        else:
+            user_result = rest_call('login', self.driver.login)
+        self._user_key = user_key
+        self._put_cached(user_key, {'id': user_result['id'], 'username': user_result['username']})
         self.username = user_result["username"]
         self.userid = user_result["id"]
+        # like mattermost, '@bot.' and '@bot,' are mentions - '@botany' or '@bot.tom' are not
+        self._mention = re.compile(r'(?<![\w@])@{}(?!\.?[\w-])'.format(re.escape(self.username)), re.IGNORECASE)
+        self.event_decoder = EventDecoder(self.userid, accept_all=debug)
+
+        self._queue_size = queue_size
+        self._queues = None
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._worker_count = workers
+
+        self.user_cache = UserCache(
+            lambda user_ids: rest_call('get_users_by_ids', self.driver.users.get_users_by_ids, user_ids),
+            max_size=user_cache_size,
+            ttl=user_cache_ttl
+        )
+        self.post_sender = PostSender(
+            lambda options: rest_call('create_post', self.driver.posts.create_post, options),
+            rate=post_rate,
+            burst=post_burst,
+            coalesce_window=coalesce_window
+        )
+
+        # computed when metrics are exported
+        QUEUE_DEPTH.set_function(self.queue_depth, 'mentions')
+        QUEUE_DEPTH.set_function(lambda: self.post_sender.stats()['queued'], 'posts')
+        CACHE_HIT_RATE.set_function(lambda: self.user_cache.stats()['hit_rate'], 'users')
+
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backfill_page_size = backfill_page_size
+        self.coordinator = coordinator
+        self.takeover_delay = takeover_delay if takeover_delay is not None else \
+            2 * coordinator.lease_ttl if coordinator else 0
+
+        self.connected = False
+        self.reconnects = 0
+        self.backfilled = 0
+        self._stopped = False
+        self._last_event = None  # (monotonic time, epoch millis) of the last websocket event
+        self._seen_posts = OrderedDict()  # ids of recently handled mentions
+        WEBSOCKET_CONNECTED.set_function(lambda: int(self.connected))
+
+        self.loop = None
+        self._routers = dict()  # channel id -> CommandRouter
+        self.channel_id = self.add_channel(team_name, channel_name, message_handler)
+        self.router = self._routers[self.channel_id]
+
+    def add_channel(self, team_name, channel_name, message_handler) -> str:
+        """
+        Lets the bot act in a further channel.
+        :return: the channel id
+        """
+        key = StartupCache.key('channel', *self._server, team_name, channel_name)
+        self._cached_channels[key] = (team_name, channel_name)
+        channel_id = self.startup_cache.get(key) if self.startup_cache else None
+        if channel_id:
+            self._cached[key] = channel_id
+        else:
+            # get channel id for name
+            channel_id = self._get_channel_id(team_name, channel_name)
+            self._put_cached(key, channel_id)
+
+        router = CommandRouter(self.username)
+        router.register(r'help\s*', lambda m: self._show_help(m.channel_id, m.post_id))
+        message_handler.register_commands(router)
+        router.compile()
+
+        self._routers[channel_id] = router
+        return channel_id
+
+    def _get_channel_id(self, team_name, channel_name) -> str:
+        return rest_call('get_channel_by_name_and_team_name', self.driver.channels.get_channel_by_name_and_team_name,
+                         team_name, channel_name)['id']
+
+    def _put_cached(self, key, value):
+        if self.startup_cache:
+            self.startup_cache.put(key, value)
 
-        # get channel id for name
-        res = self.driver.channels.get_channel_by_name_and_team_name(team_name, channel_name)
-        self.channel_id = res['id']
+    def _validate_cached_ids(self):
+        """ Resolves the ids taken from the startup cache again and updates the cache. """
+        try:
+            user = rest_call('login', self.driver.login)
+            current = {self._user_key: {'id': user['id'], 'username': user['username']}}
+            for key, (team_name, channel_name) in self._cached_channels.items():
+                current[key] = self._get_channel_id(team_name, channel_name)
+        except Exception as e:
+            print("Validating cached ids failed: {}".format(e))
+            return
+
+        stale = [key for key, value in self._cached.items() if current[key] != value]
+        for key, value in current.items():
+            self._put_cached(key, value)
+        if stale:
+            # the bot keeps running with the outdated ids, restarting it is left to its supervisor
+            print("Cached ids of {} are outdated, they are used after a restart.".format(', '.join(stale)))
 
     def start_listening(self):
+        # event loop of the websocket, other coroutines (e.g. the scheduler) may be run on it using run_coroutine
+        self.loop = asyncio.new_event_loop()
+
         worker = threading.Thread(target=ChannelBot._start_listening_in_thread, args=(self,))
         worker.daemon = True
         worker.start()
 
+        if self._cached:
+            self._executor.submit(self._validate_cached_ids)
+
         print("Initialized bot.")
 
     def _start_listening_in_thread(self):
         # Setting event loop for thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._heartbeat())
+
+        delay = self.reconnect_min
+        while not self._stopped:
+            connected_at = time.monotonic()
+            try:
+                self.driver.init_websocket(self.websocket_handler)
+                print("Websocket connection closed.")
+            except Exception as e:
+                print("Websocket connection failed: {}".format(e))
+            self.connected = False
+            if self._stopped:
+                break
+
+            if time.monotonic() - connected_at > self.reconnect_max:
+                # the connection was up for a while, start over with short delays
+                delay = self.reconnect_min
+            wait = random.uniform(delay / 2, delay)
+            print("Reconnecting in {:.1f}s...".format(wait))
+            # the loop keeps running workers and other coroutines meanwhile
+            self.loop.run_until_complete(asyncio.sleep(wait))
+            delay = min(delay * 2, self.reconnect_max)
+            self.reconnects += 1
+            RECONNECTS.inc()
+
+    def stop_listening(self):
+        """ Closes the websocket connection without reconnecting. """
+        self._stopped = True
+        self._disconnect()
 
-        self.driver.init_websocket(self.websocket_handler)
+    def _disconnect(self):
+        try:
+            self.driver.disconnect()
+        except Exception as e:
+            print("Closing websocket failed: {}".format(e))
 
-    @asyncio.coroutine
-    def websocket_handler(self, event_json):
-        event = json.loads(event_json)
+    async def _heartbeat(self):
+        while not self._stopped:
+            await asyncio.sleep(self.heartbeat_interval)
+            age = self.health()['last_event_age']
+            if self.connected and age is not None and age > self.heartbeat_timeout:
+                print("No websocket event for {:.0f}s, reconnecting...".format(age))
+                self._disconnect()
+
+    def health(self) -> dict:
+        last_event = self._last_event
+        return {
+            'connected': self.connected,
+            'last_event_age': time.monotonic() - last_event[0] if last_event else None,
+            'reconnects': self.reconnects,
+            'backfilled': self.backfilled,
+            'queued': self.queue_depth(),
+        }
+
+    def run_coroutine(self, coroutine) -> Future:
+        """ Runs a coroutine on the websocket loop. Can be called from any thread. """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def websocket_handler(self, event_json):
+        previous_event, self._last_event = self._last_event, (time.monotonic(), int(time.time() * 1000))
+        event = self.event_decoder.decode(event_json)
+        if event is None:
+            return
 
         if self.debug:
             print("websocket_handler:" + json.dumps(event, indent=4))
 
-        if 'event' in event and event['event'] == 'posted':
+        if event.get('event') == 'hello':
+            # sent on every (re-)connect - events of live posts wait until missed posts are handled
+            self.connected = True
+            if previous_event:
+                await self._backfill(previous_event[1])
+
+        if event.get('event') == 'user_updated':
+            self.user_cache.invalidate(event['data']['user']['id'])
+
+        if event.get('event') == 'posted':
             # mentions is automatically set in direct messages
-            mentions = json.loads(event['data']['mentions']) if 'mentions' in event['data'] else []
+            mentions = event['data'].get('mentions', [])
 
-            post = json.loads(event['data']['post'])
-            post_id = post['id']
-            message = post['message']
-            channel_id = post['channel_id']
-            sender_id = post['user_id']
+            if self.userid in mentions:
+                await self._handle_post(event['data']['post'])
 
-            if self.userid in mentions: # and channel_id == self.channel_id:
-                self._handle_bot_message(channel_id, post_id, sender_id, message)
+    async def _handle_post(self, post: dict) -> bool:
+        """ Queues a mention unless it was queued before. """
+        if post['id'] in self._seen_posts:
+            return False
+        self._seen_posts[post['id']] = True
+        if len(self._seen_posts) > self.SEEN_POSTS:
+            self._seen_posts.popitem(last=False)
 
-    def _handle_bot_message(self, channel_id, post_id, sender_id, message):
-        if re.match(r'(@' + self.username + ')?\s*help\s*', message):
-            self._show_help(channel_id, post_id)
-        else:
-            res = self.driver.users.get_user(sender_id)
-            sender_name = res['username']
+        # answers are posted to the root of the thread
+        post_id = post.get('root_id') or post['id']
+        sender_id = post['user_id']
+        mention = (post['channel_id'], post_id, sender_id, post['message'], post['id'])
+        if self.coordinator and not self.coordinator.owns(sender_id):
+            # handled by the replica owning the sender - unless it fails to
+            self._enqueue_later(self.takeover_delay, sender_id, mention)
+            return True
+        await self._enqueue(sender_id, mention)
+        return True
+
+    def _enqueue_later(self, delay, sender_id, mention):
+        """ Queues a mention after a delay. Has to be called on the websocket loop. """
+        self.loop.call_later(delay, lambda: asyncio.ensure_future(self._enqueue(sender_id, mention)))
+
+    async def _backfill(self, since):
+        """
+        Handles mentions in the bot's channels posted since the last event.
+        :param since: epoch milliseconds of the last event
+        """
+        loop = asyncio.get_event_loop()
+        for channel_id in list(self._routers):
+            try:
+                posts = await loop.run_in_executor(self._executor, self._fetch_posts_since, channel_id,
+                                                   since - self.BACKFILL_MARGIN)
+            except Exception as e:
+                print("Fetching missed posts of channel {} failed: {}".format(channel_id, e))
+                continue
+
+            for post in posts:
+                if post['user_id'] != self.userid and self._mention.search(post.get('message', '')) \
+                        and await self._handle_post(post):
+                    self.backfilled += 1
+                    BACKFILLED_POSTS.inc()
+
+    def _fetch_posts_since(self, channel_id, since) -> [dict]:
+        """
+        Fetches the posts of a channel created since a time. Mattermost doesn't paginate requests with 'since', so
+        pages of the latest posts are fetched until one reaches back to the time.
+        :param since: epoch milliseconds
+        :return: posts ordered by creation time
+        """
+        posts = dict()
+        page = 0
+        while True:
+            result = rest_call('get_posts_for_channel', self.driver.posts.get_posts_for_channel, channel_id,
+                               {'page': page, 'per_page': self.backfill_page_size})
+            page_posts = [result['posts'][post_id] for post_id in result['order']]
+            # posts created meanwhile move older ones to the next page, they are fetched twice but never skipped
+            posts.update((p['id'], p) for p in page_posts if p['create_at'] >= since)
+            if len(page_posts) < self.backfill_page_size or any(p['create_at'] < since for p in page_posts):
+                break
+            page += 1
+        return sorted(posts.values(), key=lambda p: p['create_at'])
+
+    async def _enqueue(self, sender_id, mention):
+        if self._queues is None:
+            # workers are bound to the running websocket loop
+            self._queues = [asyncio.Queue(maxsize=self._queue_size) for _ in range(self._worker_count)]
+            for q in self._queues:
+                asyncio.ensure_future(self._worker(q))
+
+        # blocks the websocket loop only if the queue is full
+        await self._queues[hash(sender_id) % len(self._queues)].put(mention)
+
+    async def _worker(self, queue: asyncio.Queue):
+        loop = asyncio.get_event_loop()
+        while True:
+            mention = await queue.get()
+            try:
+                await loop.run_in_executor(self._executor, self._handle_bot_message, *mention)
+            except Exception as e:
+                print("Handling message failed: {}".format(e))
+            finally:
+                queue.task_done()
+
+    def queue_depth(self) -> int:
+        """ Returns the number of mentions waiting to be handled. """
+        return sum(q.qsize() for q in self._queues) if self._queues else 0
+
+    def _handle_bot_message(self, channel_id, post_id, sender_id, message, mention_id=None):
+        if self.coordinator and not self.coordinator.claim(mention_id):
+            # handled by another replica - which may die before completing it
+            expires_in = self.coordinator.claim_expires_in(mention_id)
+            if expires_in is not None:
+                mention = (channel_id, post_id, sender_id, message, mention_id)
+                self.loop.call_soon_threadsafe(self._enqueue_later, expires_in, sender_id, mention)
+            return
+        router = self._routers.get(channel_id, self.router)
+        in_thread = mention_id is not None and mention_id != post_id
+        router.dispatch(message, Message(self, channel_id, post_id, sender_id, message, in_thread=in_thread))
+        if self.coordinator:
+            self.coordinator.complete(mention_id)
 
-            self.message_handler.handle_message(sender_id, sender_name, message, post_id, channel_id, self)
+    def get_username(self, user_id) -> str:
+        return self.user_cache.get_username(user_id)
 
     def _show_help(self, channel_id, post_id):
-        self.driver.posts.create_post({
+        self.post_sender.send({
             'channel_id': channel_id,
             'message': self.help_text,
             'root_id': post_id,
         })
 
-    def send_message_to_channel(self, message):
+    def send_message_to_channel(self, message, channel_id=None) -> Future:
+        """
+        Posts a message to a channel of the bot.
+        :param channel_id: the channel, defaults to the first channel
+        :return: a future resolving to the created post
+        """
         post_options = {
-            'channel_id': self.channel_id,
+            'channel_id': channel_id or self.channel_id,
             'message': message,
         }
 
-        self.driver.posts.create_post(post_options)
+        return self.post_sender.send(post_options)
 
-    def answer_message_in_channel(self, channel_id, post_id, message):
+    def answer_message_in_channel(self, channel_id, post_id, message, coalesce=False) -> Future:
+        """
+        Answers a message in its thread.
+        :param coalesce: whether the answer may be merged with other coalescing answers in the same thread
+        :return: a future resolving to the created post
+        """
         post_options = {
             'channel_id': channel_id,
             'root_id': post_id,
             'message': message,
         }
 
-        self.driver.posts.create_post(post_options)
\ No newline at end of file
+        return self.post_sender.send(post_options, coalesce=coalesce)
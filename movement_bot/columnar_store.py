@@ -0,0 +1,200 @@
+"""
+Columnar on-disk format for workout history.
+
+A history is a directory containing one binary file per column plus a json file with the dictionaries:
+
+    meta.json       users, user names, exercises and difficulties (the dictionaries), row/entry counts, byte order
+    user.i32        per workout: index into users
+    time.i64        per workout: epoch microseconds
+    difficulty.i8   per workout: index into difficulties
+    offsets.i64     per workout + 1: first entry of the workout (entries of workout i are offsets[i]:offsets[i + 1])
+    exercise.i32    per entry: index into exercises
+    count.i32       per entry: repetitions or seconds
+
+Columns are memory-mapped when read and can be used as numpy arrays via numpy.frombuffer without copying.
+
+Convert a csv file with: python -m movement_bot.columnar_store workouts.csv workouts.columns
+"""
+import datetime
+import json
+import mmap
+import os
+import sys
+from array import array
+
+from movement_bot.csv_stream import ReadStats, detect_header, iter_rows
+from movement_bot.statistics_generator import DIFFICULTIES, parse_workout
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNS = {
+    'user': 'i',
+    'time': 'q',
+    'difficulty': 'b',
+    'offsets': 'q',
+    'exercise': 'i',
+    'count': 'i',
+}
+FILE_SUFFIX = {'i': '.i32', 'q': '.i64', 'b': '.i8'}
+META_FILE = 'meta.json'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _column_file(directory, column):
+    return os.path.join(directory, column + FILE_SUFFIX[COLUMNS[column]])
+
+
+class ColumnarWriter:
+    """ Collects workouts and writes them as a columnar history. """
+
+    def __init__(self):
+        self._users = dict()  # user id -> index
+        self._user_names = []
+        self._exercises = dict()  # exercise -> index
+        self._columns = {c: array(t) for c, t in COLUMNS.items()}
+        self._columns['offsets'].append(0)
+
+    def append(self, entry: dict):
+        """
+        Adds a result entry as written by the WorkoutStore.
+        :raises ValueError: if the datetime of the entry is invalid, nothing is added then
+        """
+        dt = datetime.datetime.fromisoformat(entry['datetime'])
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+        user = self._users.get(entry['user_id'])
+        if user is None:
+            user = self._users[entry['user_id']] = len(self._users)
+            self._user_names.append(entry['user_name'])
+
+        columns = self._columns
+        columns['user'].append(user)
+        columns['time'].append((dt - EPOCH) // MICROSECOND)
+        columns['difficulty'].append(DIFFICULTIES.index(entry['difficulty']) if entry['difficulty'] in DIFFICULTIES else -1)
+
+        for title, number in parse_workout(entry['workout']):
+            exercise = self._exercises.setdefault(title, len(self._exercises))
+            columns['exercise'].append(exercise)
+            columns['count'].append(number)
+        columns['offsets'].append(len(columns['exercise']))
+
+    def __len__(self):
+        return len(self._columns['user'])
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for column, values in self._columns.items():
+            with open(_column_file(directory, column), 'wb') as f:
+                values.tofile(f)
+
+        meta = {
+            'rows': len(self._columns['user']),
+            'entries': len(self._columns['exercise']),
+            'byteorder': sys.byteorder,
+            'users': list(self._users),
+            'user_names': self._user_names,
+            'exercises': list(self._exercises),
+            'difficulties': DIFFICULTIES,
+        }
+        with open(os.path.join(directory, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+def convert_csv(csv_file, directory, stats=None) -> int:
+    """
+    Converts a workout csv file to a columnar history, with or without header. Malformed rows are skipped.
+    :param stats: ReadStats counting the skipped rows
+    :return: the number of converted workouts
+    """
+    stats = stats or ReadStats()
+    fieldnames, offset = detect_header(csv_file)
+
+    writer = ColumnarWriter()
+    for _, row in iter_rows(csv_file, fieldnames, offset, stats=stats):
+        try:
+            writer.append(row)
+        except ValueError:
+            stats.malformed_rows += 1
+    writer.write(directory)
+    return len(writer)
+
+
+class ColumnarHistory:
+    """ Read access to a columnar history via memory-mapped columns. """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('history was written with byte order ' + self.meta['byteorder'])
+
+        self.users = self.meta['users']
+        self.user_names = self.meta['user_names']
+        self.exercises = self.meta['exercises']
+        self.difficulties = self.meta['difficulties']
+
+        self._maps = []
+        self._columns = {c: self._map(_column_file(directory, c), t) for c, t in COLUMNS.items()}
+
+    def _map(self, path, typecode) -> memoryview:
+        if os.path.getsize(path) == 0:
+            return memoryview(array(typecode))
+        with open(path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        base = memoryview(m)
+        view = base.cast(typecode)
+        self._maps.append((m, base, view))
+        return view
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def column(self, name: str):
+        """ Returns a column as numpy array if numpy is installed, else as memoryview. """
+        view = self._columns[name]
+        return numpy.frombuffer(view, dtype=view.format) if numpy is not None else view
+
+    def totals_per_exercise(self) -> dict:
+        """ :return: {exercise: total repetitions/seconds} over the whole history """
+        if numpy is not None:
+            totals = numpy.bincount(self.column('exercise'), weights=self.column('count'),
+                                    minlength=len(self.exercises))
+        else:
+            totals = [0] * len(self.exercises)
+            for exercise, count in zip(self._columns['exercise'], self._columns['count']):
+                totals[exercise] += count
+        return {e: int(t) for e, t in zip(self.exercises, totals)}
+
+    def workouts_per_user(self) -> dict:
+        """ :return: {user name: number of workouts} over the whole history """
+        if numpy is not None:
+            counts = numpy.bincount(self.column('user'), minlength=len(self.users))
+        else:
+            counts = [0] * len(self.users)
+            for user in self._columns['user']:
+                counts[user] += 1
+        return {n: int(c) for n, c in zip(self.user_names, counts)}
+
+    def close(self):
+        """ Unmaps all columns. Arrays returned by column() must not be used (or referenced) any more. """
+        self._columns = dict()
+        for m, base, view in self._maps:
+            view.release()
+            base.release()
+            m.close()
+        self._maps = []
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python -m movement_bot.columnar_store <csv file> <target directory>")
+        sys.exit(1)
+    read_stats = ReadStats()
+    print("Converted {} workouts, skipped {} malformed rows.".format(
+        convert_csv(sys.argv[1], sys.argv[2], read_stats), read_stats.malformed_rows))
@@ -0,0 +1,91 @@
+import re
+
+from movement_bot.metrics import COMMAND_LATENCY
+
+
+class Message:
+    """
+    A message addressed to a bot. The sender's name is looked up on first access.
+
+    post_id is the root of the thread the message was posted in, or the message's own id if it was posted top-level.
+    """
+
+    def __init__(self, bot, channel_id, post_id, sender_id, text, sender_name=None, in_thread=False):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.post_id = post_id
+        self.in_thread = in_thread
+        self.sender_id = sender_id
+        self.text = text
+        self._sender_name = sender_name
+
+    @property
+    def sender_name(self) -> str:
+        if self._sender_name is None:
+            self._sender_name = self.bot.get_username(self.sender_id)
+        return self._sender_name
+
+    def answer(self, text, coalesce=False):
+        return self.bot.answer_message_in_channel(self.channel_id, self.post_id, text, coalesce=coalesce)
+
+
+class CommandRouter:
+    """
+    Dispatches bot messages to command handlers.
+
+    Command grammars are registered once and compiled into a single regular expression, which matches the optional
+    bot mention and all commands in registration order. Dispatching a message therefore takes a single match.
+    """
+
+    def __init__(self, username):
+        self.username = username
+        self._commands = []  # [(grammar, handler, name)]
+        self._default = None
+        self._pattern = None
+
+    def register(self, grammar: str, handler, name=None):
+        """
+        Registers a command.
+        :param grammar: regular expression matching the command without the bot mention, e.g.
+            r'done (?P<diff>easy|medium|hard)\\s*$'. Named groups are passed to the handler as keyword arguments.
+        :param handler: callable taking the dispatch arguments and the named groups
+        :param name: name of the command in metrics, defaults to the literal words the grammar starts with
+        """
+        name = name or re.match(r'[\w ]*', grammar).group().strip() or grammar
+        self._commands.append((grammar, handler, name))
+        self._pattern = None
+
+    def set_default(self, handler):
+        """ Sets the handler called for messages not matching any command. """
+        self._default = handler
+
+    def compile(self):
+        alternatives = []
+        for i, (grammar, _, _) in enumerate(self._commands):
+            grammar = re.sub(r'\(\?P<(\w+)>', r'(?P<c{}_\1>'.format(i), grammar)
+            alternatives.append('(?P<c{}>{})'.format(i, grammar))
+
+        self._pattern = re.compile(r'(?:@' + re.escape(self.username) + r')?\s*(?:' + '|'.join(alternatives) + ')')
+
+    def dispatch(self, text: str, *args):
+        """
+        Calls the handler of the command matching the text with the given arguments.
+        :return: the result of the handler or None if no command matched and no default handler is set
+        """
+        if self._pattern is None:
+            self.compile()
+
+        match = self._pattern.match(text)
+        if match is None:
+            if self._default is None:
+                return None
+            with COMMAND_LATENCY.time('unknown'):
+                return self._default(*args)
+
+        # the command group encloses the grammar's groups, so it is closed last
+        command = match.lastgroup
+        prefix = command + '_'
+        groups = {k[len(prefix):]: v for k, v in match.groupdict().items() if k.startswith(prefix)}
+        _, handler, name = self._commands[int(command[1:])]
+        with COMMAND_LATENCY.time(name):
+            return handler(*args, **groups)
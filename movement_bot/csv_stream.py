@@ -0,0 +1,106 @@
+"""
+Streaming access to workout csv files.
+
+All functions are generators reading one line at a time, so memory usage does not depend on the file size. Lines
+are returned with their byte offsets, which allows seeking back to them later.
+"""
+import bisect
+import csv
+
+FIELDNAMES = ['user_id', 'user_name', 'datetime', 'difficulty', 'workout', 'session']
+# columns of files written before workout sessions were recorded, which have no header
+LEGACY_FIELDNAMES = FIELDNAMES[:5]
+
+
+class ReadStats:
+    """ Counts rows skipped while reading. """
+
+    def __init__(self):
+        self.malformed_rows = 0
+
+
+def iter_lines(f, offset=0, end=None):
+    """
+    Yields (offset, line) for all lines of a binary file starting at offset.
+    :param end: offset to stop at, e.g. the end of the file when reading started, None for the current end
+    """
+    f.seek(offset)
+    for line in iter(f.readline, b''):
+        if end is not None and offset >= end:
+            return
+        yield offset, line
+        offset += len(line)
+
+
+def parse_line(line: bytes):
+    """ Returns the fields of a csv line or None if the line can't be decoded. """
+    try:
+        return next(csv.reader([line.decode('utf-8')]), [])
+    except (UnicodeDecodeError, csv.Error):
+        return None
+
+
+def detect_header(path) -> ([str], int):
+    """
+    Checks whether a csv file starts with a header.
+    :return: (fieldnames, offset of the first data line) - LEGACY_FIELDNAMES and 0 if there is no header
+    """
+    with open(path, 'rb') as f:
+        return parse_header(f.readline())
+
+
+def parse_header(first: bytes) -> ([str], int):
+    """ Like detect_header, for the first line of a file. """
+    fields = parse_line(first) if first else None
+    if fields and 'user_id' in fields and 'datetime' in fields:
+        return fields, len(first)
+    return LEGACY_FIELDNAMES, 0
+
+
+def iter_rows(path, fieldnames, offset=0, end=None, stats=None):
+    """
+    Yields (offset, row dict) for all well-formed rows of a csv file starting at offset.
+    Rows with a wrong number of fields or an invalid datetime are skipped and counted in stats.
+    """
+    with open(path, 'rb') as f:
+        for line_offset, line in iter_lines(f, offset, end):
+            fields = parse_line(line)
+            if not fields:
+                if fields is None and stats:
+                    stats.malformed_rows += 1
+                continue
+
+            row = dict(zip(fieldnames, fields)) if len(fields) == len(fieldnames) else None
+            if row is None or len(row.get('datetime', '')) < 10 or not row['datetime'][:4].isdigit():
+                if stats:
+                    stats.malformed_rows += 1
+                continue
+            yield line_offset, row
+
+
+class SparseTimeIndex:
+    """
+    Offsets of every n-th row of a csv file, to find the rows after some point in time without reading the whole file.
+    Every offset is stored with the latest datetime of the rows before it, so rows out of order only make lookups
+    start a bit earlier.
+    """
+
+    def __init__(self, every=1000):
+        self._every = every
+        self._rows = 0
+        self._max_times = []  # latest datetime of the rows before the offset, ascending
+        self._offsets = []
+        self._max_time = ''
+        self.start = 0
+
+    def add(self, time: str, offset: int):
+        if self._rows % self._every == 0:
+            self._max_times.append(self._max_time)
+            self._offsets.append(offset)
+        self._max_time = max(self._max_time, time)
+        self._rows += 1
+
+    def offset_before(self, time: str) -> int:
+        """ Returns an offset at or before the first row at or after time. """
+        i = bisect.bisect_left(self._max_times, time)
+        return self._offsets[i - 1] if i > 0 else self.start
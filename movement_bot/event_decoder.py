@@ -0,0 +1,74 @@
+"""
+Decoding of mattermost websocket events.
+
+Bots only care about a few event types and about posts mentioning them. The event type and the mention are checked on
+the raw frame, so irrelevant frames (typing, status changes, reactions, other posts, ...) are rejected without parsing
+them. Accepted frames are parsed including their json encoded fields (e.g. data.post), using orjson if installed.
+"""
+import json
+import re
+
+from movement_bot.metrics import EVENTS
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+_EVENT_TYPE = re.compile(r'"event"\s*:\s*"(\w+)"')
+# fields of event data mattermost sends as json encoded strings
+_ENCODED_FIELDS = ('post', 'mentions', 'user')
+
+
+class EventDecoder:
+    """
+    Decodes the websocket events of some types, and of posted events only those mentioning a user.
+
+    The number of accepted and rejected frames per event type is kept in `counts` and exported as metric.
+    """
+
+    def __init__(self, user_id, event_types=('hello', 'posted', 'user_updated'), accept_all=False):
+        """
+        :param user_id: id of the bot, posted events not containing it are rejected
+        :param event_types: event types to accept
+        :param accept_all: whether to decode all frames, e.g. to print them for debugging
+        """
+        self.user_id = user_id
+        self.event_types = frozenset(event_types)
+        self.accept_all = accept_all
+        self.counts = dict()  # (event type, accepted) -> number of frames
+
+    def _count(self, event_type, accepted):
+        key = (event_type, accepted)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        EVENTS.inc(event_type, 'accepted' if accepted else 'rejected')
+
+    def decode(self, frame):
+        """
+        :param frame: the raw websocket frame (str or bytes)
+        :return: the event with decoded data fields or None if the frame is rejected
+        """
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+
+        match = _EVENT_TYPE.search(frame)
+        # replies to websocket actions (e.g. the authentication) have no event type
+        event_type = match.group(1) if match else 'none'
+
+        if not self.accept_all:
+            # a mention contains the user id (in data.mentions), so frames without it can't be one
+            if event_type not in self.event_types or (event_type == 'posted' and self.user_id not in frame):
+                self._count(event_type, False)
+                return None
+
+        event = loads(frame)
+        data = event.get('data')
+        if data:
+            for field in _ENCODED_FIELDS:
+                if isinstance(data.get(field), str):
+                    data[field] = loads(data[field])
+
+        self._count(event_type, True)
+        return event
@@ -1,19 +1,88 @@
 import itertools
 import json
+import os
 import random
-from collections import namedtuple
+import threading
+import time
+import uuid
+import weakref
+from array import array
+from collections import deque, namedtuple
 from enum import Enum
 from functools import total_ordering
 
 
+class ExercisePool:
+    """ Exercises of one difficulty and type, stored column-wise for fast workout generation. """
+
+    def __init__(self, exercises: list):
+        self.exercises = tuple(exercises)
+        self.names = tuple(e.name for e in exercises)
+        self.units = tuple(e.unit for e in exercises)
+        self.mins = array('i', (e.min for e in exercises))
+        # number of possible counts per exercise
+        self.spans = array('i', (e.max - e.min + 1 for e in exercises))
+
+    def __len__(self):
+        return len(self.exercises)
+
+
+class _FileWatcher:
+    """
+    Polls the exercise files of all watched registries from a single background thread, however many channels there
+    are. Each file is checked once per round, the registries loaded from it reload it if it changed since they did.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._registries = dict()  # path -> WeakSet of registries, dropped registries aren't polled
+        self._interval = None
+        self._thread = None
+
+    def add(self, registry, path, interval):
+        with self._lock:
+            self._registries.setdefault(os.path.abspath(path), weakref.WeakSet()).add(registry)
+            self._interval = min(interval, self._interval or interval)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='exercise-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                watched = [(path, list(registries)) for path, registries in self._registries.items()]
+            for path, registries in watched:
+                if not registries:
+                    continue
+                # the same for all registries of the path
+                state = registries[0]._stat_exercise_file()
+                for registry in registries:
+                    if state and state != registry._file_state:
+                        registry._file_state = state
+                        registry.reload()
+
+
+_watcher = _FileWatcher()
+
+
 class ExerciseRegistry:
     """
     Contains all possible exercises and can create workouts from them.
+
+    Exercises are put into pools per difficulty and type once at load time. Workout sets can be created in batches and
+    pregenerated, using a seedable random number generator.
+
+    The exercises form an immutable catalogue. If the exercise file is watched, changed files are parsed and validated
+    in a shared background thread and the new catalogue is swapped in atomically; invalid files keep the old catalogue live.
     """
     STRENGTH = 'strength'
     MOBILITY = 'mobility'
 
     Exercise = namedtuple('Exercise', 'name min max unit')
+    Catalogue = namedtuple('Catalogue', 'version exercises pools')
+    WorkoutSet = namedtuple('WorkoutSet', 'id workout')
 
     @total_ordering
     class Difficulty(Enum):
@@ -26,67 +95,181 @@ class ExerciseRegistry:
                 return self.value[0] < other.value[0]
             return NotImplemented
 
-    def __init__(self, exercise_file, strength_count, mobility_count):
+    def __init__(self, exercise_file, strength_count, mobility_count, seed=None):
+        self._exercise_file = exercise_file
         self._strength_count = strength_count
         self._mobility_count = mobility_count
+        self._rng = random.Random(seed)
 
-        self._exercises = json.loads(open(exercise_file, 'r').read())
+        self._catalogue = self._load_catalogue(1)
+        self._pregenerated = deque()
+        self._render_cache = dict()  # kind -> (key, message)
 
-        self.current_workout = dict()
+        self._current = self.WorkoutSet(None, dict())
+        self.reload_error = None
+        self._file_state = self._stat_exercise_file()
+
+    @property
+    def current_workout(self) -> dict:
+        return self._current.workout
+
+    @property
+    def current_workout_id(self) -> str:
+        return self._current.id
+
+    @property
+    def current_workout_set(self) -> WorkoutSet:
+        return self._current
+
+    def _load_catalogue(self, version: int) -> Catalogue:
+        with open(self._exercise_file, 'r') as f:
+            exercises = json.loads(f.read())
+
+        pools = dict()
+        for (diff, type) in itertools.product(self.Difficulty, [self.STRENGTH, self.MOBILITY]):
+            try:
+                pool = ExercisePool([self.Exercise(**e) for e in exercises[diff.value[1]][type]])
+            except (KeyError, TypeError) as e:
+                raise ValueError("invalid {} {} exercises: {}".format(diff.value[1], type, e))
+
+            count = self._strength_count if type == self.STRENGTH else self._mobility_count
+            if len(pool) < count:
+                raise ValueError("{} {} exercises: {} required, {} given".format(diff.value[1], type, count, len(pool)))
+            for e in pool.exercises:
+                if not (isinstance(e.min, int) and isinstance(e.max, int) and 0 <= e.min <= e.max):
+                    raise ValueError("invalid range of exercise {}: {} - {}".format(e.name, e.min, e.max))
+            pools[(diff, type)] = pool
+
+        return self.Catalogue(version, exercises, pools)
+
+    def _stat_exercise_file(self):
+        try:
+            stat = os.stat(self._exercise_file)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def reload(self) -> bool:
+        """
+        Loads the exercise file again and swaps in the new catalogue if it is valid.
+        :return: whether the catalogue was replaced
+        """
+        try:
+            catalogue = self._load_catalogue(self._catalogue.version + 1)
+        except (OSError, ValueError) as e:
+            self.reload_error = e
+            print("Reloading exercises from {} failed, keeping the current ones: {}".format(self._exercise_file, e))
+            return False
+
+        self._catalogue = catalogue
+        # pregenerated sets contain the old exercises
+        self._pregenerated = deque()
+        self.reload_error = None
+        print("Reloaded exercises from {}.".format(self._exercise_file))
+        return True
+
+    def watch(self, interval=5):
+        """ Reloads the exercise file whenever it changes, polled by a thread shared by all registries. """
+        _watcher.add(self, self._exercise_file, interval)
 
     def _get_exercises(self, difficulty: Difficulty, type: str) -> [Exercise]:
-        exercises = self._exercises[difficulty.value[1]][type]
-        return list(map(lambda e: self.Exercise(**e), exercises))
+        return list(self._catalogue.pools[(difficulty, type)].exercises)
 
-    def _choose_exercises(self, exercises: [Exercise], exercise_count: int) -> [Exercise]:
-        chosen_exercises = random.sample(exercises, k=exercise_count)
-        return chosen_exercises
+    def create_new_workout_set(self) -> WorkoutSet:
+        """ Creates new (easy, medium, hard) workout sets, taking pregenerated ones first. """
+        pregenerated = self._pregenerated
+        workout = pregenerated.popleft() if pregenerated else self.create_workout_sets(1)[0]
+        self._current = self.WorkoutSet(uuid.uuid4().hex, workout)
+        return self._current
 
-    def create_new_workout_set(self):
-        """ Creates new (easy, medium, hard) workout sets. """
-        for diff in self.Difficulty:
-            w = self._create_workout(diff)
-            self.current_workout[diff.value[1]] = w
+    def pregenerate_workout_sets(self, count: int):
+        """
+        Generates workout sets used by the following calls of create_new_workout_set, e.g. for a whole day.
+        :param count: the number of workout sets
+        """
+        self._pregenerated.extend(self.create_workout_sets(count))
 
-    def _create_workout(self, difficulty: Difficulty) -> [(str, int, str)]:
-        ex_str = self._choose_exercises(self._get_exercises(difficulty, self.STRENGTH), self._strength_count)
-        ex_mob = self._choose_exercises(self._get_exercises(difficulty, self.MOBILITY), self._mobility_count)
+    def create_workout_sets(self, count: int, rng=None) -> [dict]:
+        """
+        Creates a batch of workout sets.
+        :param count: the number of workout sets
+        :param rng: random.Random to use instead of the registry's one
+        :return: [{difficulty: [(name, count, unit)]}]
+        """
+        rng = rng or self._rng
+        sample = rng.sample
+        rand = rng.random
+        pools = self._catalogue.pools
+        parts = [
+            (diff.value[1], [(pools[(diff, self.STRENGTH)], self._strength_count),
+                             (pools[(diff, self.MOBILITY)], self._mobility_count)])
+            for diff in self.Difficulty
+        ]
 
-        res = []
-        for e in itertools.chain(ex_str, ex_mob):
-            count = int(random.randint(e.min, e.max))
-            res.append((e.name, count, e.unit))
-        return res
+        sets = []
+        for _ in range(count):
+            workout_set = dict()
+            for diff_name, pools in parts:
+                workout = []
+                for pool, k in pools:
+                    names, units, mins, spans = pool.names, pool.units, pool.mins, pool.spans
+                    for i in sample(range(len(pool)), k):
+                        workout.append((names[i], mins[i] + int(rand() * spans[i]), units[i]))
+                workout_set[diff_name] = workout
+            sets.append(workout_set)
+        return sets
+
+    def _render_cached(self, kind: str, key, render) -> str:
+        """ Returns the cached message of a kind for a key, rendering it if the key changed. """
+        cached = self._render_cache.get(kind)
+        if cached is None or cached[0] != key:
+            cached = self._render_cache[kind] = (key, render())
+        return cached[1]
 
     def create_training_message_for_current_workout_set(self) -> str:
         """
         Creates a mattermost table style message from the current workout.
         :return: the message
         """
-        result = "### Los jetzt - beweg dich!\n"
+        return self.create_training_message_for_workout_set(self._current)
 
-        result += "| {} | | {} | | {} | |\n| :---- | :---- | :---- | :---- | :---- | :---- |\n".format(*map(lambda d: d.value[1], self. Difficulty))
+    def create_training_message_for_workout_set(self, workout_set: WorkoutSet) -> str:
+        """
+        Creates a mattermost table style message from a workout set, e.g. of an older session.
+        :return: the message
+        """
+        return self._render_cached('workout', workout_set.id,
+                                   lambda: self._render_training_message(workout_set.workout))
+
+    def _render_training_message(self, workout: dict) -> str:
+        lines = [
+            "### Los jetzt - beweg dich!",
+            "| {} | | {} | | {} | |".format(*map(lambda d: d.value[1], self.Difficulty)),
+            "| :---- | :---- | :---- | :---- | :---- | :---- |",
+        ]
         for i in range(self._mobility_count + self._strength_count):
-            result += "|"
-            for diff in sorted(self.Difficulty):
-                e = self.current_workout[diff.value[1]][i]
-                result += "{} | {} {} |".format(e[0], e[1], e[2])
-            result += "\n"
+            lines.append("|" + "".join(
+                "{} | {} {} |".format(*workout[diff.value[1]][i]) for diff in sorted(self.Difficulty)
+            ))
 
-        return result
+        return "\n".join(lines) + "\n"
 
     def create_exercise_list_message(self) -> str:
         """
         Creates a mattermost table style message for all exercises.
         :return: the message
         """
-        result = "### Exercises\n\n"
+        catalogue = self._catalogue
+        return self._render_cached('list', catalogue.version, lambda: self._render_exercise_list_message(catalogue))
+
+    def _render_exercise_list_message(self, catalogue: Catalogue) -> str:
+        parts = ["### Exercises\n\n"]
 
         for (diff, type) in itertools.product(self.Difficulty, [self.STRENGTH, self.MOBILITY]):
-            result += "**{} {}**\n\n".format(diff.value[1], type)
-            result += "| Name | Time/Reps |\n| :----- | : ----- |\n"
-            for e in self._get_exercises(diff, type):
-                result += "| {} | {} - {} {}|\n".format(e.name, e.min, e.max, e.unit)
-            result += "\n\n"
+            parts.append("**{} {}**\n\n".format(diff.value[1], type))
+            parts.append("| Name | Time/Reps |\n| :----- | : ----- |\n")
+            parts.extend("| {} | {} - {} {}|\n".format(e.name, e.min, e.max, e.unit)
+                         for e in catalogue.pools[(diff, type)].exercises)
+            parts.append("\n\n")
 
-        return result
+        return "".join(parts)
@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from movement_bot.metrics import rest_call
+
+
+class DirectMessageFanOut:
+    """
+    Sends a message to many users via direct message channels.
+
+    Direct message channel ids are cached per user, so channels are only created for users not seen before. Every
+    recipient is handled by its own task (create channel if missing, then post) on a pool of `parallelism` threads.
+    """
+
+    def __init__(self, driver, bot_user_id, parallelism=16):
+        self._driver = driver
+        self._bot_user_id = bot_user_id
+        self._executor = ThreadPoolExecutor(max_workers=parallelism)
+
+        self._lock = threading.Lock()
+        self._channels = dict()  # user id -> direct message channel id
+
+    def channel_id(self, user_id: str) -> str:
+        with self._lock:
+            channel_id = self._channels.get(user_id)
+        if channel_id is None:
+            res = rest_call('create_direct_message_channel', self._driver.channels.create_direct_message_channel,
+                            [self._bot_user_id, user_id])
+            channel_id = res['id']
+            with self._lock:
+                self._channels[user_id] = channel_id
+        return channel_id
+
+    def send(self, user_id: str, message: str, root_id=None) -> dict:
+        """
+        Sends a direct message to a single user.
+        :return: the created post
+        """
+        post_options = {
+            'channel_id': self.channel_id(user_id),
+            'message': message,
+        }
+        if root_id:
+            post_options['root_id'] = root_id
+
+        try:
+            return rest_call('create_post', self._driver.posts.create_post, post_options)
+        except Exception:
+            # the channel may be gone, create it again next time
+            with self._lock:
+                self._channels.pop(user_id, None)
+            raise
+
+    def broadcast(self, user_ids: [str], message: str) -> dict:
+        """
+        Sends a direct message to all users concurrently. A failing recipient does not abort the broadcast.
+        :return: {user id: exception} for all recipients the message could not be sent to
+        """
+        futures = {u: self._executor.submit(self.send, u, message) for u in user_ids}
+
+        failures = dict()
+        for user_id, future in futures.items():
+            error = future.exception()
+            if error:
+                failures[user_id] = error
+        return failures
@@ -0,0 +1,57 @@
+"""
+Helpers for the append-only line files of the bot (workout journal, subscription log).
+
+A crash while appending can leave a partially written final line. It has to be cut off before appending again,
+otherwise the next line is glued to it.
+"""
+import os
+
+
+def truncate_partial_line(path, chunk_size=4096) -> int:
+    """
+    Cuts a partially written final line off a file.
+    :return: the number of bytes removed
+    """
+    if not os.path.exists(path):
+        return 0
+
+    with open(path, 'rb+') as f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+
+        if end < size:
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+    return size - end
+
+
+def replace_file(path, content):
+    """
+    Replaces the content of a file atomically and durably, a crash leaves either the old or the new content.
+    :param content: the text, or an iterable of bytes to stream large files
+    """
+    # several processes may replace the same file, e.g. replicas of the bot
+    tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_file, 'w' if isinstance(content, str) else 'wb') as f:
+        if isinstance(content, str):
+            f.write(content)
+        else:
+            f.writelines(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+    # the rename is only durable once the directory is synced
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
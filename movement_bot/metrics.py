@@ -0,0 +1,349 @@
+"""
+Metrics of the bot's hot paths, exported in the Prometheus text format by a MetricsServer.
+
+Values are only recorded after the registry was enabled, e.g. by starting a MetricsServer. Until then recording a value
+costs a single attribute check, so instrumentation can stay in place.
+"""
+import bisect
+import collections
+import sys
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra='') -> str:
+    labels = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name, help, labels):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = dict()  # label values -> value
+
+    def render(self) -> [str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """ Gauge set explicitly or computed by a function whenever metrics are rendered. """
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function, *labels):
+        """ :param function: callable without arguments returning the current value """
+        self.set(function, *labels)
+
+    def render(self) -> [str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            try:
+                value = value() if callable(value) else value
+            except Exception as e:
+                print("Computing metric {} failed: {}".format(self.name, e))
+                continue
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket, +Inf, sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        """ Returns a context manager observing the time spent in it. """
+        return _Timer(self, labels) if self._registry.enabled else _NULL_TIMER
+
+    def render(self) -> [str]:
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="{}"'.format(bound)
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labels, label_values, le),
+                                                     cumulative))
+            labels = _format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels, counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """ Named metrics; asking for an existing name returns the existing metric. """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()  # name -> metric
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(self, name, help, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+COMMAND_LATENCY = REGISTRY.histogram('movement_bot_command_seconds', 'Time to handle a bot command.', ['command'])
+REST_LATENCY = REGISTRY.histogram('movement_bot_rest_seconds', 'Duration of REST calls.', ['endpoint'])
+REST_ERRORS = REGISTRY.counter('movement_bot_rest_errors_total', 'Failed REST calls.', ['endpoint'])
+STORE_WRITE_LATENCY = REGISTRY.histogram('movement_bot_store_write_seconds', 'Duration of (synced) store writes.',
+                                         ['store'])
+QUEUE_DEPTH = REGISTRY.gauge('movement_bot_queue_depth', 'Items waiting in a queue.', ['queue'])
+EVENTS = REGISTRY.counter('movement_bot_events_total', 'Websocket events by type, accepted or rejected by the prefilter.',
+                          ['event', 'result'])
+WEBSOCKET_CONNECTED = REGISTRY.gauge('movement_bot_websocket_connected', 'Whether the websocket is connected.')
+RECONNECTS = REGISTRY.counter('movement_bot_websocket_reconnects_total', 'Websocket reconnects.')
+BACKFILLED_POSTS = REGISTRY.counter('movement_bot_backfilled_posts_total', 'Missed mentions fetched after reconnects.')
+CACHE_HIT_RATE = REGISTRY.gauge('movement_bot_cache_hit_rate', 'Share of cache requests answered from the cache.',
+                                ['cache'])
+
+
+def rest_call(endpoint: str, call, *args):
+    """ Calls a REST endpoint, recording its latency and errors. """
+    if not REGISTRY.enabled:
+        return call(*args)
+
+    start = time.perf_counter()
+    try:
+        return call(*args)
+    except Exception:
+        REST_ERRORS.inc(endpoint)
+        raise
+    finally:
+        REST_LATENCY.observe(time.perf_counter() - start, endpoint)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler recording the stacks of all threads every `interval` seconds while it is running.
+
+    Stacks are reported in the collapsed format ('outer;inner count' per line) understood by flame graph tools.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._samples = 0
+        self._thread = None
+        self._running = False
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._stacks.clear()
+            self._samples = 0
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            thread = self._thread
+        if thread:
+            thread.join()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while self._running:
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+
+            with self._lock:
+                self._stacks.update(stacks)
+                self._samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join("{} {}\n".format(stack, count) for stack, count in stacks)
+
+    def top(self, limit=20) -> [(str, int)]:
+        """ :return: [(function, number of samples it was running in)] """
+        with self._lock:
+            stacks = list(self._stacks.items())
+        functions = collections.Counter()
+        for stack, count in stacks:
+            # functions of recursive calls are counted once per sample
+            for function in set(stack.split(';')):
+                functions[function] += count
+        return functions.most_common(limit)
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint exposing metrics and the sampling profiler:
+
+        GET /metrics          metrics in the Prometheus text format
+        GET /profile/start    starts the profiler
+        GET /profile/stop     stops the profiler
+        GET /profile          stacks sampled since the profiler was started (collapsed format)
+
+    Metrics are recorded while the server is running.
+    """
+
+    def __init__(self, port=9100, host='127.0.0.1', registry=REGISTRY, profiler=None):
+        self.registry = registry
+        self.profiler = profiler or SamplingProfiler()
+
+        # most bots run without metrics server
+        import http.server
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._http = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._http.daemon_threads = True
+        self.port = self._http.server_address[1]
+
+    def start(self):
+        self.registry.enabled = True
+        worker = threading.Thread(target=self._http.serve_forever)
+        worker.daemon = True
+        worker.start()
+        print("Serving metrics on port {}.".format(self.port))
+
+    def stop(self):
+        self.registry.enabled = False
+        self.profiler.stop()
+        self._http.shutdown()
+        self._http.server_close()
+
+    def _handle(self, request):
+        path = request.path.split('?')[0].rstrip('/')
+        if path == '/metrics':
+            body = self.registry.render()
+        elif path == '/profile/start':
+            self.profiler.start()
+            body = "profiler started\n"
+        elif path == '/profile/stop':
+            self.profiler.stop()
+            body = "profiler stopped\n"
+        elif path == '/profile':
+            body = self.profiler.collapsed()
+        else:
+            request.send_error(404)
+            return
+
+        data = body.encode('utf-8')
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
@@ -0,0 +1,194 @@
+import queue
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+# errors of requests/urllib3 raised while connecting, before anything was sent
+_CONNECT_ERRORS = {'ConnectTimeout', 'ConnectTimeoutError', 'NewConnectionError', 'NameResolutionError'}
+
+
+class TokenBucket:
+    """ Thread-safe token bucket allowing `rate` acquisitions per second with bursts up to `capacity`. """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self._rate = rate
+        self._capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class _Coalesced:
+
+    def __init__(self, options):
+        self.options = options
+        self.messages = [options['message']]
+        self.future = Future()
+
+
+class PostSender:
+    """
+    Sends posts from a queue using a few worker threads sharing the driver's HTTP connections.
+
+    Posts are paced by a token bucket and retried with exponential backoff if the server answers with 429 or 5xx, or if
+    connecting to it failed. Other errors (e.g. read timeouts) are not retried, the post may have been created already.
+    Coalescing posts for the same thread are delayed for `coalesce_window` seconds and sent as a single post.
+    """
+    LATENCY_SAMPLES = 10000
+
+    def __init__(self, create_post, rate=10, burst=20, workers=4, max_retries=5, backoff=0.5, coalesce_window=1.0):
+        """
+        :param create_post: callable sending post options to the server, e.g. driver.posts.create_post
+        :param rate: max posts per second
+        :param burst: max posts sent at once after an idle period
+        :param workers: number of concurrently sending threads
+        :param max_retries: max retries of a post
+        :param backoff: seconds waited before the first retry, doubled on every further retry
+        :param coalesce_window: seconds coalescing posts are collected
+        """
+        self._create_post = create_post
+        self._bucket = TokenBucket(rate, burst)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._coalesce_window = coalesce_window
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._coalescing = dict()  # (channel id, root id) -> _Coalesced
+
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._latencies = deque(maxlen=self.LATENCY_SAMPLES)
+
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def send(self, options: dict, coalesce=False) -> Future:
+        """
+        Queues a post.
+        :param options: post options as expected by the mattermost API
+        :param coalesce: whether the post may be merged with other coalescing posts of the same thread
+        :return: a future resolving to the created post
+        """
+        if not coalesce:
+            future = Future()
+            self._queue.put((options, future, time.monotonic()))
+            return future
+
+        key = (options['channel_id'], options.get('root_id'))
+        with self._lock:
+            pending = self._coalescing.get(key)
+            if pending:
+                pending.messages.append(options['message'])
+                return pending.future
+
+            pending = self._coalescing[key] = _Coalesced(options)
+
+        timer = threading.Timer(self._coalesce_window, self._flush, args=(key, time.monotonic()))
+        timer.daemon = True
+        timer.start()
+        return pending.future
+
+    def _flush(self, key, queued_at):
+        with self._lock:
+            pending = self._coalescing.pop(key)
+        options = dict(pending.options, message="\n\n".join(pending.messages))
+        self._queue.put((options, pending.future, queued_at))
+
+    def _work(self):
+        while True:
+            options, future, queued_at = self._queue.get()
+            try:
+                result = self._send_with_retries(options)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print("Sending post failed: {}".format(e))
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    self.sent += 1
+                    self._latencies.append(time.monotonic() - queued_at)
+                future.set_result(result)
+
+    def _send_with_retries(self, options):
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                return self._create_post(options)
+            except Exception as e:
+                retry_after = self._retry_after(e)
+                if retry_after is None or attempt >= self._max_retries:
+                    raise
+
+                with self._lock:
+                    self.retries += 1
+                backoff = self._backoff * 2 ** attempt
+                time.sleep(max(retry_after, backoff * random.uniform(0.5, 1.5)))
+                attempt += 1
+
+    @staticmethod
+    def _retry_after(error):
+        """ Returns the seconds to wait before retrying after an error or None if the post can't be retried. """
+        response = getattr(error, 'response', None)
+        if response is None:
+            return 0 if PostSender._failed_to_connect(error) else None
+
+        status = getattr(response, 'status_code', None)
+        if status == 429 or (status is not None and status >= 500):
+            try:
+                return float(response.headers.get('Retry-After', 0))
+            except (AttributeError, ValueError):
+                return 0
+        return None
+
+    @staticmethod
+    def _failed_to_connect(error) -> bool:
+        """ Returns whether an error or one of its causes happened while connecting, before the post was sent. """
+        pending, seen = [error], set()
+        while pending:
+            e = pending.pop()
+            if not isinstance(e, BaseException) or id(e) in seen:
+                continue
+            seen.add(id(e))
+            if isinstance(e, (ConnectionRefusedError, socket.gaierror)) or \
+                    any(c.__name__ in _CONNECT_ERRORS for c in type(e).__mro__):
+                return True
+            # requests wraps urllib3's errors, which keep the reason of their last retry
+            pending.extend([getattr(e, 'reason', None), e.__cause__, e.__context__] + list(e.args))
+        return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                'queued': self._queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+            }
+
+        for p in (50, 90, 99):
+            result['p{}'.format(p)] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)] if latencies else 0.0
+        return result
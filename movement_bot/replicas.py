@@ -0,0 +1,267 @@
+"""
+Coordination of bot replicas running for the same channels, through a shared SQLite database.
+
+All replicas receive every websocket event. One of them holds the leader lease: only the leader announces workouts and
+stores completed workouts in the csv file. If the leader stops renewing its lease, another replica takes over once it
+expired, i.e. within `lease_ttl` seconds. The leader plans the next workout of a channel in the database, the schedules
+of all replicas follow that plan, so a new leader goes on with it.
+
+Mentions are sharded by a stable hash of the sender's user id over the live replicas. The owning replica handles a
+mention right away; all others wait a while and only take it over if nobody claimed it meanwhile (e.g. because the
+owner died). Every mention is claimed by its post id before it is handled and the claim is completed afterwards. A
+claim which isn't completed within `claim_timeout` seconds expires and the mention is handled by another replica, so
+every mention is handled at least once, and only once unless handling it takes longer than that.
+
+Sessions and the completed workouts of open sessions are kept in the database, so every replica credits `done` to the
+same sessions and a workout is recorded once, whichever replica handled it.
+"""
+import contextlib
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from movement_bot.exercises import ExerciseRegistry
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS replicas (id TEXT PRIMARY KEY, seen REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS claims (
+    post_id TEXT PRIMARY KEY, replica TEXT NOT NULL, claimed REAL NOT NULL, completed REAL
+);
+CREATE TABLE IF NOT EXISTS schedules (channel TEXT PRIMARY KEY, next_fire TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sessions (
+    channel TEXT NOT NULL, version INTEGER NOT NULL, workout_set_id TEXT NOT NULL, workout TEXT NOT NULL,
+    post_id TEXT, opened TEXT NOT NULL, PRIMARY KEY (channel, version)
+);
+CREATE TABLE IF NOT EXISTS workouts (
+    channel TEXT NOT NULL, session TEXT NOT NULL, user_id TEXT NOT NULL, entry TEXT NOT NULL,
+    PRIMARY KEY (channel, session, user_id)
+);
+"""
+
+# versions of a channel's open sessions are greater than this
+_OLDEST_OPEN = "(SELECT COALESCE(MAX(version), 0) FROM sessions WHERE channel = :channel) - :max_open"
+
+
+class ReplicaCoordinator:
+    """
+    Leader lease, mention sharding and shared workout state of the replicas using the same database file.
+
+    Every thread uses its own connection. The database should be on a local file system, SQLite's locking is not
+    reliable on network file systems.
+    """
+    LEASE = 'leader'
+
+    def __init__(self, db_file, replica_id=None, lease_ttl=5.0, claim_retention=86400, claim_timeout=30.0):
+        """
+        :param replica_id: unique id of this replica, defaults to host, pid and a random suffix
+        :param lease_ttl: seconds the leader lease and the membership of a replica last without renewal
+        :param claim_retention: seconds claims of handled mentions are kept to reject duplicates
+        :param claim_timeout: seconds after which a claim which wasn't completed may be taken over
+        """
+        self.db_file = db_file
+        self.replica_id = replica_id or '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.lease_ttl = lease_ttl
+        self.claim_retention = claim_retention
+        self.claim_timeout = claim_timeout
+
+        self._local = threading.local()
+        self._leader = False
+        self._lease_expires = 0.0
+        self._replicas = (self.replica_id,)
+        self._stopped = threading.Event()
+
+        self._db().executescript(_SCHEMA)
+        self.heartbeat()
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # autocommit, transactions are started explicitly
+            db = self._local.db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        # takes the write lock right away, so concurrent transactions don't fail on upgrading it
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @property
+    def is_leader(self) -> bool:
+        # a leader which couldn't renew its lease steps down before another replica may take over
+        return self._leader and time.time() < self._lease_expires
+
+    @property
+    def replicas(self) -> (str,):
+        """ Ids of the live replicas as of the last heartbeat. """
+        return self._replicas
+
+    def heartbeat(self):
+        """ Renews the membership of this replica and acquires or renews the leader lease. """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('INSERT INTO replicas (id, seen) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET seen = excluded.seen',
+                       (self.replica_id, now))
+            db.execute('INSERT INTO lease (name, holder, expires) VALUES (?, ?, ?) '
+                       'ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires '
+                       'WHERE lease.holder = excluded.holder OR lease.expires < ?',
+                       (self.LEASE, self.replica_id, now + self.lease_ttl, now))
+            holder = db.execute('SELECT holder FROM lease WHERE name = ?', (self.LEASE,)).fetchone()[0]
+            replicas = tuple(r for r, in db.execute('SELECT id FROM replicas WHERE seen >= ? ORDER BY id',
+                                                   (now - self.lease_ttl,)))
+            if holder == self.replica_id:
+                db.execute('DELETE FROM replicas WHERE seen < ?', (now - 10 * self.lease_ttl,))
+                db.execute('DELETE FROM claims WHERE claimed < ?', (now - self.claim_retention,))
+
+        leader = holder == self.replica_id
+        if leader != self._leader:
+            print("Replica {} {} leader.".format(self.replica_id, "is" if leader else "is no longer"))
+        self._leader = leader
+        self._lease_expires = now + self.lease_ttl
+        self._replicas = replicas or (self.replica_id,)
+
+    def start(self):
+        """ Sends heartbeats in a background thread, three per lease period. """
+        def beat():
+            while not self._stopped.wait(self.lease_ttl / 3):
+                try:
+                    self.heartbeat()
+                except sqlite3.Error as e:
+                    print("Replica heartbeat failed: {}".format(e))
+
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Stops the heartbeats and hands over the lease, so another replica takes over right away. """
+        self._stopped.set()
+        self._leader = False
+        with self._transaction() as db:
+            db.execute('DELETE FROM lease WHERE name = ? AND holder = ?', (self.LEASE, self.replica_id))
+            db.execute('DELETE FROM replicas WHERE id = ?', (self.replica_id,))
+
+    def owns(self, user_id) -> bool:
+        """ Returns whether mentions of a user are handled by this replica first. """
+        replicas = self._replicas
+        # the builtin hash of strings differs between processes
+        return replicas[zlib.crc32(user_id.encode('utf-8')) % len(replicas)] == self.replica_id
+
+    def claim(self, post_id) -> bool:
+        """
+        Claims the handling of a mention, complete() has to be called once it is handled.
+        :return: False if another replica claimed it before, unless its claim expired without being completed
+        """
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.execute('INSERT OR IGNORE INTO claims (post_id, replica, claimed) VALUES (?, ?, ?)',
+                                (post_id, self.replica_id, now))
+            if cursor.rowcount == 0:
+                cursor = db.execute('UPDATE claims SET replica = ?, claimed = ? '
+                                    'WHERE post_id = ? AND completed IS NULL AND claimed < ?',
+                                    (self.replica_id, now, post_id, now - self.claim_timeout))
+        return cursor.rowcount == 1
+
+    def complete(self, post_id):
+        """ Marks a claimed mention as handled. """
+        self._db().execute('UPDATE claims SET completed = ? WHERE post_id = ? AND replica = ?',
+                           (time.time(), post_id, self.replica_id))
+
+    def claim_expires_in(self, post_id):
+        """ :return: seconds until the claim of a mention may be taken over, None if it was completed """
+        row = self._db().execute('SELECT claimed FROM claims WHERE post_id = ? AND completed IS NULL',
+                                 (post_id,)).fetchone()
+        return max(0.0, row[0] + self.claim_timeout - time.time()) if row else None
+
+    def plan_fire(self, channel, when: datetime.datetime):
+        """ Stores the time the leader announces the next workout of a channel. """
+        self._db().execute('INSERT OR REPLACE INTO schedules (channel, next_fire) VALUES (?, ?)',
+                           (channel, when.isoformat()))
+
+    def follow_plan(self, channel, now: datetime.datetime):
+        """
+        Decides what to do when the schedule of a channel fires.
+        :param now: the current time, timezone aware
+        :return: None if this replica announces a workout now and plans the next one, else the time its schedule has
+            to fire next: the planned one, or after a lease period if the leader didn't plan the next workout yet
+        """
+        row = self._db().execute('SELECT next_fire FROM schedules WHERE channel = ?', (channel,)).fetchone()
+        planned = datetime.datetime.fromisoformat(row[0]) if row else None
+        if planned and planned > now:
+            return planned
+        if not self.is_leader:
+            # a missed plan of a crashed leader is announced by the new one
+            return now + datetime.timedelta(seconds=self.lease_ttl)
+        return None
+
+    def publish_session(self, channel, workout_set: ExerciseRegistry.WorkoutSet, opened: datetime.datetime) -> int:
+        """
+        Makes a session opened by the leader known to all replicas.
+        :return: the version of the session
+        """
+        with self._transaction() as db:
+            version = db.execute('SELECT COALESCE(MAX(version), 0) + 1 FROM sessions WHERE channel = ?',
+                                 (channel,)).fetchone()[0]
+            db.execute('INSERT INTO sessions (channel, version, workout_set_id, workout, opened) VALUES (?, ?, ?, ?, ?)',
+                       (channel, version, workout_set.id, json.dumps(workout_set.workout), opened.isoformat()))
+            db.execute('DELETE FROM sessions WHERE channel = ? AND version <= ?', (channel, version - 1000))
+        return version
+
+    def bind_session(self, channel, version, post_id):
+        self._db().execute('UPDATE sessions SET post_id = ? WHERE channel = ? AND version = ?',
+                           (post_id, channel, version))
+
+    def recent_sessions(self, channel, count) -> [(int, ExerciseRegistry.WorkoutSet, str, datetime.datetime)]:
+        """ :return: (version, workout set, post id, opened) of the latest sessions, oldest first """
+        rows = self._db().execute(
+            'SELECT version, workout_set_id, workout, post_id, opened FROM sessions WHERE channel = ? '
+            'ORDER BY version DESC LIMIT ?', (channel, count)).fetchall()
+        return [(version, ExerciseRegistry.WorkoutSet(workout_set_id, {
+            diff: [tuple(e) for e in exercises] for diff, exercises in json.loads(workout).items()
+        }), post_id, datetime.datetime.fromisoformat(opened)) for version, workout_set_id, workout, post_id, opened
+            in reversed(rows)]
+
+    def record_workout(self, channel, entry: dict, max_open) -> bool:
+        """
+        Records a completed workout of an open session, replacing an earlier one of the user in the same session.
+        :param max_open: number of sessions open at once
+        :return: False if the session was closed meanwhile
+        """
+        cursor = self._db().execute(
+            'INSERT OR REPLACE INTO workouts (channel, session, user_id, entry) SELECT :channel, :session, :user_id, '
+            ':entry FROM sessions WHERE channel = :channel AND workout_set_id = :session AND version > ' + _OLDEST_OPEN,
+            {'channel': channel, 'session': entry['session'], 'user_id': entry['user_id'], 'entry': json.dumps(entry),
+             'max_open': max_open})
+        return cursor.rowcount == 1
+
+    def pending_workouts(self, channel) -> [dict]:
+        """ Returns the recorded workouts which are not stored yet. """
+        return [json.loads(entry) for entry, in
+                self._db().execute('SELECT entry FROM workouts WHERE channel = ?', (channel,))]
+
+    def closed_workouts(self, channel, max_open) -> [dict]:
+        """ Returns the recorded workouts of closed sessions, which can't change anymore. """
+        return [json.loads(entry) for entry, in self._db().execute(
+            'SELECT w.entry FROM workouts w LEFT JOIN sessions s ON s.channel = w.channel AND '
+            's.workout_set_id = w.session WHERE w.channel = :channel AND '
+            '(s.version IS NULL OR s.version <= ' + _OLDEST_OPEN + ')', {'channel': channel, 'max_open': max_open})]
+
+    def remove_workouts(self, channel, entries: [dict]):
+        """ Removes recorded workouts once they are stored. """
+        with self._transaction() as db:
+            db.executemany('DELETE FROM workouts WHERE channel = ? AND session = ? AND user_id = ?',
+                           [(channel, e['session'], e['user_id']) for e in entries])
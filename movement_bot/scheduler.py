@@ -0,0 +1,210 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import random
+import threading
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # python < 3.9
+    ZoneInfo = None
+
+
+class SystemClock:
+
+    def now(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeClock:
+    """ Clock only moving on request, see tests/test_scheduler.py. """
+
+    def __init__(self, now: datetime.datetime):
+        self._now = now
+
+    def now(self) -> datetime.datetime:
+        return self._now
+
+    def advance(self, **kwargs):
+        """ Moves the clock forward, takes the arguments of datetime.timedelta. """
+        self._now += datetime.timedelta(**kwargs)
+
+
+class ActiveWindow:
+    """ Hours of the day (in a timezone) on which workouts take place, optionally excluding weekends and holidays. """
+
+    def __init__(self, active_from: int, active_to: int, on_weekend: bool, timezone=None, holidays=()):
+        """
+        :param active_from: first hour of workouts
+        :param active_to: final hour of workouts
+        :param on_weekend: whether workouts take place on saturdays and sundays
+        :param timezone: name of the timezone, e.g. 'Europe/Berlin', defaults to the local timezone
+        :param holidays: dates without workouts
+        """
+        self.active_from = active_from
+        self.active_to = active_to
+        self.on_weekend = on_weekend
+        if timezone and ZoneInfo is None:
+            raise ValueError("timezone {} requires python 3.9 or newer, remove it to use the local timezone".format(
+                timezone))
+        self.timezone = ZoneInfo(timezone) if timezone else None
+        self.holidays = set(holidays)
+
+    def local(self, dt: datetime.datetime) -> datetime.datetime:
+        return dt.astimezone(self.timezone)
+
+    def is_active_day(self, day: datetime.date) -> bool:
+        """ Returns whether workouts take place on a day, ignoring the hours. """
+        # mon = 0, ..., sat = 5, sun = 6
+        return (day.weekday() < 5 or self.on_weekend) and day not in self.holidays
+
+    def contains(self, dt: datetime.datetime) -> bool:
+        dt = self.local(dt)
+        return self.is_active_day(dt.date()) and self.active_from <= dt.hour <= self.active_to
+
+    def next_start(self, dt: datetime.datetime) -> datetime.datetime:
+        """ Returns the first point in time at or after dt within the window. """
+        if self.contains(dt):
+            return dt
+
+        dt = self.local(dt)
+        day = dt.date() if dt.hour < self.active_from else dt.date() + datetime.timedelta(days=1)
+        for _ in range(366 * 2):
+            if self.is_active_day(day):
+                start = datetime.datetime.combine(day, datetime.time(self.active_from))
+                return start.replace(tzinfo=self.timezone) if self.timezone else start.astimezone()
+            day += datetime.timedelta(days=1)
+        raise ValueError('no active day within two years')
+
+
+class WorkoutSchedule:
+    """ Fires a callback at random intervals within an active window. """
+
+    def __init__(self, name: str, window: ActiveWindow, wait_min: int, wait_max: int, callback, rng=None):
+        """
+        :param name: unique name of the schedule, e.g. the channel
+        :param wait_min: min minutes between two workouts
+        :param wait_max: max minutes between two workouts
+        :param callback: called without arguments whenever the schedule fires, may return the time to fire next
+            instead of a random one
+        :param rng: random.Random used for the intervals
+        """
+        self.name = name
+        self.window = window
+        self.wait_min = wait_min
+        self.wait_max = wait_max
+        self.callback = callback
+        self.rng = rng or random.Random()
+
+        self.next_fire = None
+
+    def following(self, fired: datetime.datetime) -> datetime.datetime:
+        wait = datetime.timedelta(minutes=self.rng.randint(self.wait_min, self.wait_max))
+        return self.window.next_start(fired + wait)
+
+
+class Scheduler:
+    """
+    Runs many WorkoutSchedules on an asyncio loop.
+
+    Due times are kept in a heap, the loop sleeps until the earliest one. Callbacks run in the loop's default executor,
+    so they may block. Every schedule exposes the time it fires next as `next_fire`.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or SystemClock()
+        self._heap = []  # [(time, sequence number, schedule)]
+        self._sequence = itertools.count()
+        self._schedules = dict()  # name -> WorkoutSchedule
+        self._lock = threading.Lock()
+
+        self._loop = None
+        self._wakeup = None
+        self._running = False
+
+    def add(self, schedule: WorkoutSchedule):
+        with self._lock:
+            self._schedules[schedule.name] = schedule
+            self._push(schedule, schedule.window.next_start(self.clock.now()))
+        self._wake()
+
+    def remove(self, name: str):
+        with self._lock:
+            schedule = self._schedules.pop(name, None)
+            if schedule:
+                # heap entries of removed schedules are skipped when popped
+                schedule.next_fire = None
+        self._wake()
+
+    def next_fire_time(self, name: str):
+        schedule = self._schedules.get(name)
+        return schedule.next_fire if schedule else None
+
+    def _push(self, schedule: WorkoutSchedule, when: datetime.datetime):
+        schedule.next_fire = when
+        heapq.heappush(self._heap, (when, next(self._sequence), schedule))
+
+    def pop_due(self) -> [WorkoutSchedule]:
+        """ Removes all due schedules from the heap and reschedules them. """
+        now = self.clock.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, _, schedule = heapq.heappop(self._heap)
+                if self._schedules.get(schedule.name) is schedule and schedule.next_fire == when:
+                    due.append((when, schedule))
+
+            for when, schedule in due:
+                # based on the planned time, so delays don't accumulate - unless the loop fell behind
+                self._push(schedule, schedule.following(max(when, now)))
+        return [schedule for _, schedule in due]
+
+    def run_pending(self):
+        """ Synchronously fires all due schedules. """
+        for schedule in self.pop_due():
+            self._fire(schedule)
+
+    def _fire(self, schedule: WorkoutSchedule):
+        try:
+            later = schedule.callback()
+        except Exception as e:
+            print("Schedule {} failed: {}".format(schedule.name, e))
+            return
+
+        if later is not None:
+            with self._lock:
+                if self._schedules.get(schedule.name) is schedule:
+                    self._push(schedule, later)
+            self._wake()
+
+    def _seconds_until_next(self):
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0.0, (self._heap[0][0] - self.clock.now()).total_seconds())
+
+    def _wake(self):
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        """ Fires schedules until stop() is called. """
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._running = True
+
+        while self._running:
+            due = self.pop_due()
+            if due:
+                await asyncio.gather(*(self._loop.run_in_executor(None, self._fire, s) for s in due))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._seconds_until_next())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def stop(self):
+        self._running = False
+        self._wake()
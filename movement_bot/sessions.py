@@ -0,0 +1,76 @@
+import datetime
+import threading
+from collections import namedtuple
+
+# an announced workout set; immutable, binding the announcement post creates a new snapshot
+Session = namedtuple('Session', 'version workout_set post_id opened')
+
+_State = namedtuple('_State', 'sessions by_post')
+
+
+class SessionBook:
+    """
+    Open workout sessions, keyed by the id of their announcement post.
+
+    The open sessions form an immutable snapshot which writers replace under a lock (copy on write). Readers just take
+    the current snapshot, so they never wait and always see a consistent set of sessions. Opening a session closes the
+    oldest one if more than `max_open` sessions would be open.
+    """
+
+    def __init__(self, max_open=3):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._version = 0
+        self._state = _State((), dict())
+
+    @property
+    def current(self) -> Session:
+        """ The most recently opened session or None. """
+        sessions = self._state.sessions
+        return sessions[-1] if sessions else None
+
+    @property
+    def open_sessions(self) -> (Session,):
+        return self._state.sessions
+
+    def get(self, post_id) -> Session:
+        """ Returns the open session announced by a post or None. """
+        return self._state.by_post.get(post_id)
+
+    def is_open(self, workout_set_id) -> bool:
+        return any(s.workout_set.id == workout_set_id for s in self._state.sessions)
+
+    def open(self, workout_set, opened=None, version=None) -> (Session, [Session]):
+        """
+        Opens a session for a workout set.
+        :param opened: time the session was opened, defaults to now
+        :param version: version of a session opened by another replica, defaults to the next one
+        :return: (the new session, sessions closed by it) - (None, []) if a session of the version was opened before
+        """
+        with self._lock:
+            if version is not None and version <= self._version:
+                return None, []
+            self._version = version or self._version + 1
+            session = Session(self._version, workout_set, None, opened or datetime.datetime.now())
+            sessions = self._state.sessions + (session,)
+            closed = sessions[:-self.max_open] if len(sessions) > self.max_open else ()
+            self._publish(sessions[len(closed):])
+        return session, list(closed)
+
+    def bind(self, session: Session, post_id) -> Session:
+        """
+        Sets the announcement post of a session.
+        :return: the bound session or None if the session is closed already
+        """
+        with self._lock:
+            sessions = self._state.sessions
+            for i, s in enumerate(sessions):
+                if s.version == session.version:
+                    bound = s._replace(post_id=post_id)
+                    self._publish(sessions[:i] + (bound,) + sessions[i + 1:])
+                    return bound
+        return None
+
+    def _publish(self, sessions):
+        # a new dict for every snapshot, published dicts are never changed
+        self._state = _State(sessions, {s.post_id: s for s in sessions if s.post_id})
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import threading
+
+from movement_bot.log_file import replace_file
+
+
+class StartupCache:
+    """
+    Ids the bot resolves on startup (its own user, its channels), kept in a json file for the next start.
+
+    A restarted bot uses the cached ids right away instead of waiting for the server; the caller validates them in the
+    background and puts the current values. The file is replaced atomically, so a crash never leaves a partial one.
+    Tokens are never written, keys only contain a hash of them.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._values = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.cache_file, 'r') as f:
+                values = json.load(f)
+            return values if isinstance(values, dict) else dict()
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def key(kind, *parts) -> str:
+        """ Returns the key of a value, e.g. key('user', url, token) - parts are hashed. """
+        return '{}:{}'.format(kind, hashlib.sha256('\0'.join(map(str, parts)).encode('utf-8')).hexdigest()[:32])
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def put(self, key, value) -> bool:
+        """
+        Stores a value, writing the file if it changed.
+        :return: whether the cached value differed
+        """
+        with self._lock:
+            if self._values.get(key) == value:
+                return False
+            self._values[key] = value
+
+            try:
+                replace_file(self.cache_file, json.dumps(self._values))
+            except OSError as e:
+                print("Writing startup cache {} failed: {}".format(self.cache_file, e))
+            return True
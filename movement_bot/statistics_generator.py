@@ -5,29 +5,376 @@ One result entry is of following form:
     'user_name': '...',
     'time': '2018-07-29 09:17:13.812189',
     'difficulty': 'easy',
-    'workout': 'title1:number1|...|titlen:numbern'
+    'workout': 'title1:number1|...|titlen:numbern',
+    'session': '...'
 }
+The session is the id of the workout set the entry belongs to, it is missing in older entries.
 """
+import datetime
+import functools
+import itertools
+import threading
 
+DIFFICULTIES = ['easy', 'medium', 'hard']
 
-def generate_stats_for_all_users(stats:[dict]) -> str:
-    # TODO: Extend this one for all users
-    count_dict = dict()
-    for l in stats:
-        user_name = l['user_name']
-        if user_name not in count_dict:
-            # initialize tuple
-            count_dict[user_name] = {'easy': 0, 'medium': 0, 'hard': 0}
-        diff = l['difficulty']
-        if diff in count_dict[user_name]:
-            count_dict[user_name][diff] += 1
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
 
-    for c in count_dict:
-        count_dict[c]['sum'] = sum(count_dict[c].values())
 
-    return str(count_dict)
+def parse_workout(workout: str) -> [(str, int)]:
+    """
+    Parses the workout field of a result entry.
+    :param workout: 'title1:number1|...|titlen:numbern'
+    :return: [(title, number)]
+    """
+    result = []
+    for e in workout.split('|') if workout else []:
+        title, _, number = e.rpartition(':')
+        try:
+            result.append((title, int(number)))
+        except ValueError:
+            pass
+    return result
 
 
-def generate_stats_for_single_user(stats:[dict], username: str) -> str:
-    # TODO: Extend this one for single users
-    return username + ": " + str(len(stats))
\ No newline at end of file
+def entry_day(entry: dict) -> datetime.date:
+    return _parse_day(entry['datetime'][:10])
+
+
+# entries of the same day are frequent, e.g. when the whole workout file is read on startup
+@functools.lru_cache(maxsize=4096)
+def _parse_day(day: str) -> datetime.date:
+    return datetime.date.fromisoformat(day)
+
+
+@functools.lru_cache(maxsize=4096)
+def period_key(period: str, day: datetime.date) -> str:
+    if period == DAY:
+        return day.isoformat()
+    elif period == WEEK:
+        year, week, _ = day.isocalendar()
+        return "{}-W{:02d}".format(year, week)
+    elif period == MONTH:
+        return day.strftime('%Y-%m')
+    raise ValueError('unknown period: ' + period)
+
+
+class StatisticsAggregator:
+    """
+    Maintains workout totals per user, difficulty, exercise, period (day/week/month) and session.
+
+    Every result entry is parsed once when it is added, all queries are answered from the totals.
+    """
+
+    def __init__(self, is_active_day=None):
+        """
+        :param is_active_day: returns whether workouts take place on a date, e.g. ActiveWindow.is_active_day - streaks
+            continue across other days, by default weekends
+        """
+        self._is_active_day = is_active_day or (lambda day: day.weekday() < 5)
+        self._lock = threading.Lock()
+
+        self._difficulties = dict()  # user name -> {difficulty: count}
+        self._exercises = dict()  # user name -> {exercise: total}
+        self._exercise_totals = dict()  # exercise -> total
+        self._periods = dict()  # (period, key) -> {user name: count}
+        self._days = dict()  # user name -> {day}
+        self._streaks = dict()  # user name -> [last day, current streak, longest streak]
+        self._sessions = dict()  # session id -> (day, {user name}), in order of opening or of the first entry
+
+    def add(self, entry: dict):
+        """
+        Adds a result entry to all totals.
+        :param entry: result entry as described above
+        """
+        user_name = entry['user_name']
+        day = entry_day(entry)
+        exercises = parse_workout(entry['workout'])
+
+        with self._lock:
+            counts = self._difficulties.setdefault(user_name, {d: 0 for d in DIFFICULTIES})
+            if entry['difficulty'] in counts:
+                counts[entry['difficulty']] += 1
+
+            user_exercises = self._exercises.setdefault(user_name, dict())
+            for title, number in exercises:
+                user_exercises[title] = user_exercises.get(title, 0) + number
+                self._exercise_totals[title] = self._exercise_totals.get(title, 0) + number
+
+            for period in (DAY, WEEK, MONTH):
+                users = self._periods.setdefault((period, period_key(period, day)), dict())
+                users[user_name] = users.get(user_name, 0) + 1
+
+            self._add_day(user_name, day)
+
+            if entry.get('session'):
+                self._sessions.setdefault(entry['session'], (day, set()))[1].add(user_name)
+
+    def add_session(self, session_id: str, day: datetime.date):
+        """
+        Adds a session when it is opened, so it is listed even if nobody works out.
+        :param session_id: id of the session's workout set
+        :param day: day the session was opened
+        """
+        with self._lock:
+            self._sessions.setdefault(session_id, (day, set()))
+
+    def _add_day(self, user_name: str, day: datetime.date):
+        days = self._days.setdefault(user_name, set())
+        if day in days:
+            return
+        days.add(day)
+
+        streak = self._streaks.get(user_name)
+        if streak is None:
+            self._streaks[user_name] = [day, 1, 1]
+        elif day > streak[0]:
+            self._extend_streak(streak, day)
+        else:
+            # entries out of order - rebuild streak from all days of the user
+            self._streaks[user_name] = self._compute_streak(days)
+
+    def _extend_streak(self, streak: list, day: datetime.date):
+        streak[1] = streak[1] + 1 if day == self._next_day(streak[0]) else 1
+        streak[0] = day
+        streak[2] = max(streak[1], streak[2])
+
+    def _next_day(self, day: datetime.date) -> datetime.date:
+        day += datetime.timedelta(days=1)
+        for _ in range(366 * 2):
+            if self._is_active_day(day):
+                break
+            day += datetime.timedelta(days=1)
+        return day
+
+    def _compute_streak(self, days: {datetime.date}) -> list:
+        last, current, longest = None, 0, 0
+        for day in sorted(days):
+            current = current + 1 if last and day == self._next_day(last) else 1
+            longest = max(longest, current)
+            last = day
+        return [last, current, longest]
+
+    def difficulty_counts(self, user_name=None, pending=()) -> dict:
+        """
+        :param user_name: a user name or None for all users
+        :param pending: result entries not added yet, which are counted as well
+        :return: {user name: {difficulty: count}}
+        """
+        with self._lock:
+            if user_name:
+                users = [user_name] if user_name in self._difficulties else []
+            else:
+                users = self._difficulties
+            counts = {u: dict(self._difficulties[u]) for u in users}
+
+        for entry in pending:
+            if user_name and entry['user_name'] != user_name:
+                continue
+            user_counts = counts.setdefault(entry['user_name'], {d: 0 for d in DIFFICULTIES})
+            if entry['difficulty'] in user_counts:
+                user_counts[entry['difficulty']] += 1
+        return counts
+
+    def workout_count(self, user_name: str, pending=()) -> int:
+        """
+        :param user_name: the user name
+        :param pending: result entries not added yet, which are counted as well
+        """
+        with self._lock:
+            count = sum(self._difficulties.get(user_name, dict()).values())
+        return count + sum(1 for e in pending if e['user_name'] == user_name)
+
+    def leaderboard(self, period=None, day=None, limit=None, pending=()) -> [(str, int)]:
+        """
+        Returns users ordered by number of workouts.
+        :param period: DAY, WEEK, MONTH or None for all time
+        :param day: a day within the period, defaults to today
+        :param limit: max number of entries
+        :param pending: result entries not added yet, which are counted as well
+        :return: [(user name, count)]
+        """
+        key = period_key(period, day or datetime.date.today()) if period else None
+        with self._lock:
+            if period:
+                counts = dict(self._periods.get((period, key), dict()))
+            else:
+                counts = {u: sum(c.values()) for u, c in self._difficulties.items()}
+
+        for entry in pending:
+            if period is None or period_key(period, entry_day(entry)) == key:
+                counts[entry['user_name']] = counts.get(entry['user_name'], 0) + 1
+
+        ranking = sorted(counts.items(), key=lambda e: (-e[1], e[0]))
+        return ranking[:limit] if limit else ranking
+
+    def streak(self, user_name: str, today=None, pending=()) -> (int, int):
+        """
+        :param user_name: the user name
+        :param today: reference day, defaults to today
+        :param pending: result entries not added yet, which are counted as well
+        :return: (current streak, longest streak) in days
+        """
+        with self._lock:
+            streak = self._streaks.get(user_name)
+            streak = list(streak) if streak else None
+        return self._current_streak(streak, [e for e in pending if e['user_name'] == user_name], today)
+
+    def streaks(self, today=None, pending=()) -> [(str, int, int)]:
+        """
+        Returns the streaks of all users, ordered by current and longest streak.
+        :param today: reference day, defaults to today
+        :param pending: result entries not added yet, which are counted as well
+        :return: [(user name, current streak, longest streak)]
+        """
+        with self._lock:
+            streaks = {u: list(s) for u, s in self._streaks.items()}
+
+        pending_by_user = dict()
+        for entry in pending:
+            pending_by_user.setdefault(entry['user_name'], []).append(entry)
+            streaks.setdefault(entry['user_name'], None)
+
+        result = [(u, *self._current_streak(s, pending_by_user.get(u, ()), today)) for u, s in streaks.items()]
+        return sorted(result, key=lambda e: (-e[1], -e[2], e[0]))
+
+    def _current_streak(self, streak, pending: [dict], today) -> (int, int):
+        for day in sorted({entry_day(e) for e in pending}):
+            if streak is None:
+                streak = [day, 1, 1]
+            elif day > streak[0]:
+                self._extend_streak(streak, day)
+        if streak is None:
+            return 0, 0
+
+        today = today or datetime.date.today()
+        last, current, longest = streak
+        # streak is still running if the user did not miss the following active day yet
+        running = last == today or self._next_day(last) >= today
+        return (current if running else 0), longest
+
+    def sessions(self, limit=10, pending=()) -> [(str, datetime.date, int, float)]:
+        """
+        Returns the participation in the most recent workout sessions. The participation rate is the share of all
+        users working out in the month of the session.
+        :param limit: max number of sessions
+        :param pending: result entries not added yet, which are counted as well
+        :return: [(session id, day, participants, participation rate)], most recent first
+        """
+        with self._lock:
+            recent = [(s, d, set(u)) for s, (d, u) in itertools.islice(reversed(self._sessions.items()), limit)]
+            months = {period_key(MONTH, d) for _, d, _ in recent}
+            month_users = {m: set(self._periods.get((MONTH, m), ())) for m in months}
+
+        for entry in pending:
+            if not entry.get('session'):
+                continue
+            day = entry_day(entry)
+            session = next((s for s in recent if s[0] == entry['session']), None)
+            if session is None:
+                # the current session is the most recent one
+                session = (entry['session'], day, set())
+                recent = [session] + recent[:limit - 1]
+            session[2].add(entry['user_name'])
+            month_users.setdefault(period_key(MONTH, day), set()).add(entry['user_name'])
+
+        return [(s, d, len(users), len(users) / len(month_users.get(period_key(MONTH, d)) or users) if users else 0.0)
+                for s, d, users in recent]
+
+    def exercise_volume(self, user_name=None) -> dict:
+        """
+        :param user_name: a user name or None for all users
+        :return: {exercise: total number (repetitions or seconds)}
+        """
+        with self._lock:
+            if user_name:
+                return dict(self._exercises.get(user_name, dict()))
+            return dict(self._exercise_totals)
+
+
+def _table(header: [str], rows: [list], align=None) -> str:
+    """
+    Creates a mattermost table.
+    :param align: 'l' or 'r' per column, defaults to left aligned text and right aligned numbers in the first row
+    """
+    align = align or ['r' if rows and isinstance(v, (int, float)) else 'l' for v in (rows[0] if rows else header)]
+    lines = [
+        "| " + " | ".join(header) + " |",
+        "| " + " | ".join(":----" if a == 'l' else "----:" for a in align) + " |",
+    ]
+    lines.extend("| " + " | ".join(map(str, row)) + " |" for row in rows)
+    return "\n".join(lines) + "\n"
+
+
+def generate_stats_for_all_users(stats: StatisticsAggregator, pending=()) -> str:
+    count_dict = stats.difficulty_counts(pending=pending)
+    if not count_dict:
+        return "No workouts yet."
+
+    rows = [[u] + [c[d] for d in DIFFICULTIES] + [sum(c.values())] for u, c in count_dict.items()]
+    rows.sort(key=lambda r: (-r[-1], r[0]))
+    return "### Workouts\n\n" + _table(['User'] + DIFFICULTIES + ['sum'], rows)
+
+
+def generate_stats_for_single_user(stats: StatisticsAggregator, username: str, pending=(), today=None) -> str:
+    counts = stats.difficulty_counts(username, pending).get(username)
+    if not counts:
+        return "No workouts of {} yet.".format(username)
+
+    today = today or datetime.date.today()
+    pending = [e for e in pending if e['user_name'] == username]
+    current, longest = stats.streak(username, today, pending)
+    rows = [
+        ['Workouts', sum(counts.values())],
+        ['This week', dict(stats.leaderboard(WEEK, today, pending=pending)).get(username, 0)],
+        ['This month', dict(stats.leaderboard(MONTH, today, pending=pending)).get(username, 0)],
+        ['Current streak', current],
+        ['Longest streak', longest],
+    ] + [[d, counts[d]] for d in DIFFICULTIES]
+
+    message = "### Workouts of {}\n\n".format(username) + _table(['', username], rows, align=['l', 'r'])
+    volume = stats.exercise_volume(username)
+    if volume:
+        message += "\n" + _exercise_table(volume)
+    return message
+
+
+def generate_leaderboard(stats: StatisticsAggregator, period: str, pending=(), today=None, limit=10) -> str:
+    """
+    :param period: WEEK or MONTH
+    """
+    today = today or datetime.date.today()
+    ranking = stats.leaderboard(period, today, limit, pending)
+    title = "### Leaderboard {}\n\n".format(period_key(period, today))
+    if not ranking:
+        return title + "No workouts yet - be the first!"
+    return title + _table(['#', 'User', 'Workouts'], [[i + 1, u, c] for i, (u, c) in enumerate(ranking)])
+
+
+def generate_streaks(stats: StatisticsAggregator, pending=(), today=None, limit=10) -> str:
+    streaks = stats.streaks(today, pending)[:limit]
+    if not streaks:
+        return "No workouts yet."
+    return "### Streaks\n\n" + _table(['User', 'Current', 'Longest'], [list(s) for s in streaks])
+
+
+def generate_session_stats(stats: StatisticsAggregator, pending=(), limit=10) -> str:
+    sessions = stats.sessions(limit, pending)
+    if not sessions:
+        return "No workout sessions yet."
+    rows = [[d.isoformat(), p, "{:.0%}".format(r)] for _, d, p, r in sessions]
+    return "### Participation in the last sessions\n\n" + _table(['Day', 'Participants', 'Rate'], rows,
+                                                                   align=['l', 'r', 'r'])
+
+
+def generate_exercise_volume(stats: StatisticsAggregator, user_name=None) -> str:
+    volume = stats.exercise_volume(user_name)
+    if not volume:
+        return "No exercises done yet."
+    return _exercise_table(volume)
+
+
+def _exercise_table(volume: dict) -> str:
+    rows = sorted(([e, v] for e, v in volume.items()), key=lambda r: (-r[1], r[0]))
+    return "### Exercises\n\n" + _table(['Exercise', 'Total reps/seconds'], rows)
@@ -7,9 +7,14 @@ Uses: https://github.com/Vaelor/python-mattermost-driver
 import asyncio
 import itertools
 import json
-import re
 import threading
-from mattermostdriver import Driver
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from movement_bot.command_router import CommandRouter, Message
+from movement_bot.event_decoder import EventDecoder
+from movement_bot.fan_out import DirectMessageFanOut
+from movement_bot.metrics import rest_call
+from movement_bot.subscription_store import SubscriptionStore
 
 
 class SubscriptionBot:
@@ -18,6 +23,7 @@ class SubscriptionBot:
     SUBSCRIBED_MESSAGE = "Hi there - thx for joining!"
     UNSUBSCRIBED_MESSAGE = "Bye then, couch potato!"
     NOT_SUBSCRIBED_MESSAGE = "Are you also trying to cancel your gym membership before even registering?"
+    NOT_SAVED_MESSAGE = "Sorry, I couldn't save that - please try again."
     UNKNOWN_COMMAND_TEXT = "I don't get it, want to join? Try 'subscribe' instead. 'help' may also be your friend."
     HELP_TEXT = """
 |Command|Description|
@@ -27,24 +33,42 @@ class SubscriptionBot:
 |help|I'm quite sure, you know what this one does.|        
 """
 
-    def __init__(self, username, password, scheme='https', debug=False):
-        self.subscriptions = set()
+    def __init__(self, username, password, scheme='https', debug=False, fan_out_parallelism=16, subscription_file=None,
+                 driver=None):
+        # subscriptions are only kept in memory if no file is given
+        self.subscriptions = SubscriptionStore(subscription_file) if subscription_file else set()
+        # confirmations waiting for their change to be durable
+        self._confirmations = ThreadPoolExecutor(max_workers=4)
 
         self.username = username
         self.debug = debug
 
-        self.driver = Driver({
-            'url': "192.168.122.254",
-            'login_id': username,
-            'password': password,
-            'scheme': scheme,
-            'debug': debug,
-        })
-        self.driver.login()
+        if driver is None:
+            # imported only if needed, like in ChannelBot
+            from mattermostdriver import Driver
+            driver = Driver({
+                'url': "192.168.122.254",
+                'login_id': username,
+                'password': password,
+                'scheme': scheme,
+                'debug': debug,
+            })
+        self.driver = driver
+        rest_call('login', self.driver.login)
 
         # get userid for username since it is not automatically set to driver.client.userid ... for reasons
-        res = self.driver.users.get_user_by_username('bot')
+        res = rest_call('get_user_by_username', self.driver.users.get_user_by_username, 'bot')
         self.userid = res['id']
+        self.event_decoder = EventDecoder(self.userid, event_types=('posted',), accept_all=debug)
+
+        self.fan_out = DirectMessageFanOut(self.driver, self.userid, parallelism=fan_out_parallelism)
+
+        self.router = CommandRouter(self.username)
+        self.router.register(r'help\s*', lambda m: self._show_help(m.channel_id, m.post_id))
+        self.router.register(r'subscribe\s*', lambda m: self._handle_subscription(m.sender_id, m.channel_id, m.post_id))
+        self.router.register(r'unsubscribe\s*', lambda m: self._handle_unsubscription(m.channel_id, m.post_id, m.sender_id))
+        self.router.set_default(lambda m: self._handle_unknown_command(m.channel_id, m.post_id))
+        self.router.compile()
 
     def start_listening(self):
         worker = threading.Thread(target=SubscriptionBot._start_listening_in_thread, args=(self,))
@@ -60,18 +84,19 @@ class SubscriptionBot:
 
         self.driver.init_websocket(self.websocket_handler)
 
-    @asyncio.coroutine
-    def websocket_handler(self, event_json):
-        event = json.loads(event_json)
+    async def websocket_handler(self, event_json):
+        event = self.event_decoder.decode(event_json)
+        if event is None:
+            return
 
         if self.debug:
             print("websocket_handler:" + json.dumps(event, indent=4))
 
         if 'event' in event and event['event'] == 'posted':
             # mentions is automatically set in direct messages
-            mentions = json.loads(event['data']['mentions']) if 'mentions' in event['data'] else []
+            mentions = event['data'].get('mentions', [])
 
-            post = json.loads(event['data']['post'])
+            post = event['data']['post']
             post_id = post['id']
             message = post['message']
             channel_id = post['channel_id']
@@ -81,71 +106,76 @@ class SubscriptionBot:
                 self.handle_bot_message(channel_id, post_id, sender_id, message)
 
     def handle_bot_message(self, channel_id, post_id, sender_id, message):
-        if re.match(r'(@' + self.username + ')?\s*help\s*', message):
-            self._show_help(channel_id, post_id)
-        elif re.match(r'(@' + self.username + ')?\s*subscribe\s*', message):
-            self._handle_subscription(sender_id, channel_id, post_id)
-        elif re.match(r'(@' + self.username + ')?\s*unsubscribe\s*', message):
-            self._handle_unsubscription(channel_id, post_id, sender_id)
-        else:
-            self._handle_unknown_command(channel_id, post_id)
+        self.router.dispatch(message, Message(self, channel_id, post_id, sender_id, message))
 
     def _show_help(self, channel_id, post_id):
-        self.driver.posts.create_post({
+        rest_call('create_post', self.driver.posts.create_post, {
             'channel_id': channel_id,
             'message': self.HELP_TEXT,
             'root_id': post_id,
         })
 
     def _handle_subscription(self, sender_id, channel_id, post_id):
-        self.subscriptions.add(sender_id)
+        committed = self.subscriptions.add(sender_id)
         if self.debug:
             print(sender_id + " subscribed.")
 
-        self.driver.posts.create_post({
-            'channel_id': channel_id,
-            'message': self.SUBSCRIBED_MESSAGE,
-            'root_id': post_id,
-        })
+        self._answer_when_committed(committed, channel_id, post_id, self.SUBSCRIBED_MESSAGE)
 
     def _handle_unsubscription(self, channel_id, post_id, sender_id):
         if sender_id in self.subscriptions:
-            self.subscriptions.discard(sender_id)
+            committed = self.subscriptions.discard(sender_id)
             if self.debug:
                 print(sender_id + " unsubscribed.")
 
-            self.driver.posts.create_post({
+            self._answer_when_committed(committed, channel_id, post_id, self.UNSUBSCRIBED_MESSAGE)
+        else:
+            rest_call('create_post', self.driver.posts.create_post, {
                 'channel_id': channel_id,
                 'message': self.UNSUBSCRIBED_MESSAGE,
                 'root_id': post_id,
             })
-        else:
-            self.driver.posts.create_post({
+
+    def _answer_when_committed(self, committed: Future, channel_id, post_id, message):
+        """
+        Answers once a change of the subscriptions is durable, so a crash can't lose a confirmed change. The websocket
+        loop doesn't wait for it.
+        :param committed: future of the change, None if subscriptions are only kept in memory
+        """
+        def answer():
+            text = message
+            if committed is not None:
+                try:
+                    committed.result()
+                except Exception:
+                    text = self.NOT_SAVED_MESSAGE
+            rest_call('create_post', self.driver.posts.create_post, {
                 'channel_id': channel_id,
-                'message': self.UNSUBSCRIBED_MESSAGE,
+                'message': text,
                 'root_id': post_id,
             })
 
+        if committed is None:
+            answer()
+        else:
+            self._confirmations.submit(answer)
+
     def _handle_unknown_command(self, channel_id, post_id):
-        self.driver.posts.create_post({
+        rest_call('create_post', self.driver.posts.create_post, {
             'channel_id': channel_id,
             'message': self.UNKNOWN_COMMAND_TEXT,
             'root_id': post_id,
         })
 
-    def send_messages_to_subscribers(self, message):
-        for subscriber in self.subscriptions:
-            self._send_direct_message(subscriber, message)
+    def send_messages_to_subscribers(self, message) -> dict:
+        """
+        Sends a message to all subscribers concurrently.
+        :return: {user id: exception} for all subscribers the message could not be sent to
+        """
+        failures = self.fan_out.broadcast(list(self.subscriptions), message)
+        for user_id, error in failures.items():
+            print("Sending message to {} failed: {}".format(user_id, error))
+        return failures
 
     def _send_direct_message(self, user_id, message, root_id=None):
-        res = self.driver.channels.create_direct_message_channel([self.userid, user_id])
-        channel_id = res['id']
-
-        post_options = {
-            'channel_id': channel_id,
-            'message': message,
-        }
-        if root_id:
-            post_options['root_id'] = root_id
-
-        self.driver.posts.create_post(post_options)
+        self.fan_out.send(user_id, message, root_id)
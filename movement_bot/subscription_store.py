@@ -0,0 +1,164 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from movement_bot.log_file import replace_file, truncate_partial_line
+from movement_bot.metrics import STORE_WRITE_LATENCY
+
+
+class SubscriptionStore:
+    """
+    Durable set of subscribed user ids.
+
+    Changes are applied in memory immediately and appended to a log file by a background thread, so callers never wait
+    for disk writes; they get a future which resolves once the change is durable, or fails if it couldn't be written.
+    Once the log holds more than `compact_after` entries it is compacted into a snapshot of the live subscriptions. On
+    startup the snapshot is read, a partially written final line is cut off the log and the (bounded) log is replayed.
+
+    A failed write is cut off the log again. Its changes stay in memory and are saved by compacting with the next
+    batch, whose futures fail as well until that succeeds.
+    """
+    ADD = '+'
+    REMOVE = '-'
+
+    def __init__(self, snapshot_file, compact_after=1000):
+        self._snapshot_file = snapshot_file
+        self._log_file = snapshot_file + '.log'
+        self._compact_after = compact_after
+
+        self._lock = threading.Lock()
+        self._members = set()
+        self._log_entries = 0
+        # changes in memory which failed to be written, they are saved by the next snapshot
+        self._unsaved = False
+        if truncate_partial_line(self._log_file):
+            print("Removed a partially written subscription from {}.".format(self._log_file))
+        self._load()
+
+        self._queue = queue.Queue()
+        self._log = open(self._log_file, 'a')
+        writer = threading.Thread(target=self._write)
+        writer.daemon = True
+        writer.start()
+
+    def _load(self):
+        if os.path.exists(self._snapshot_file):
+            with open(self._snapshot_file, 'r') as f:
+                self._members = set(line.strip() for line in f if line.strip())
+
+        if os.path.exists(self._log_file):
+            with open(self._log_file, 'r') as f:
+                for line in f:
+                    op, user_id = line[0], line[1:].strip()
+                    if op == self.ADD:
+                        self._members.add(user_id)
+                    elif op == self.REMOVE:
+                        self._members.discard(user_id)
+                    self._log_entries += 1
+
+    def add(self, user_id: str) -> Future:
+        """ :return: a future resolving once the subscription is durable """
+        with self._lock:
+            change = None if user_id in self._members else self.ADD + user_id
+            self._members.add(user_id)
+            return self._commit(change)
+
+    def discard(self, user_id: str) -> Future:
+        """ :return: a future resolving once the unsubscription is durable """
+        with self._lock:
+            change = self.REMOVE + user_id if user_id in self._members else None
+            self._members.discard(user_id)
+            return self._commit(change)
+
+    def _commit(self, change) -> Future:
+        # without change the future resolves once earlier changes - e.g. of the same user - are durable
+        committed = Future()
+        self._queue.put((change, committed))
+        return committed
+
+    def __contains__(self, user_id):
+        return user_id in self._members
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._members))
+
+    def __len__(self):
+        return len(self._members)
+
+    def flush(self):
+        """ Blocks until all changes are written. """
+        self._queue.join()
+
+    def _write(self):
+        while True:
+            entries = [self._queue.get()]
+            # group all changes queued in the meantime into one write
+            while not self._queue.empty():
+                entries.append(self._queue.get_nowait())
+
+            try:
+                self._append([change for change, _ in entries if change])
+            except Exception as e:
+                print("Writing subscriptions failed: {}".format(e))
+                for _, committed in entries:
+                    committed.set_exception(e)
+            else:
+                for _, committed in entries:
+                    committed.set_result(None)
+            finally:
+                for _ in entries:
+                    self._queue.task_done()
+
+    def _append(self, changes: [str]):
+        if changes:
+            with STORE_WRITE_LATENCY.time('subscriptions'):
+                if self._log is None:
+                    self._log = open(self._log_file, 'a')
+                size = os.fstat(self._log.fileno()).st_size
+                try:
+                    self._log.write(''.join(c + '\n' for c in changes))
+                    self._log.flush()
+                    os.fsync(self._log.fileno())
+                except BaseException:
+                    # the changes aren't acknowledged, so they must not be replayed either
+                    self._close()
+                    self._unsaved = True
+                    try:
+                        os.truncate(self._log_file, size)
+                    except OSError as e:
+                        print("Truncating subscription log failed: {}".format(e))
+                    raise
+            self._log_entries += len(changes)
+
+        if self._unsaved:
+            self._compact()
+        elif self._log_entries > self._compact_after:
+            try:
+                self._compact()
+            except OSError as e:
+                # the changes are durable in the log
+                print("Compacting subscriptions failed: {}".format(e))
+
+    def _compact(self):
+        with self._lock:
+            members = list(self._members)
+
+        replace_file(self._snapshot_file, ''.join(m + '\n' for m in members))
+        self._unsaved = False
+
+        # changes made after copying the members are still queued and end up in the new log
+        self._close()
+        # if it can't be truncated, the log is reopened for appending by the next write
+        self._log = open(self._log_file, 'w')
+        self._log_entries = 0
+
+    def _close(self):
+        log, self._log = self._log, None
+        if log is not None:
+            try:
+                log.close()
+            except OSError:
+                # buffered changes which can't be written are dropped
+                pass
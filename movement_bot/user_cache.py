@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Batch:
+
+    def __init__(self):
+        self.user_ids = set()
+        self.usernames = dict()
+        self.error = None
+        self.done = threading.Event()
+
+
+class UserCache:
+    """
+    Bounded cache mapping user ids to usernames with TTL and LRU eviction.
+
+    Misses arriving within `batch_window` seconds are collected and resolved with a single bulk user lookup.
+    """
+
+    def __init__(self, fetch_users, max_size=1000, ttl=3600, batch_window=0.02, clock=time.monotonic):
+        """
+        :param fetch_users: callable taking a list of user ids and returning the matching user dicts
+        :param max_size: max number of cached users
+        :param ttl: seconds a cached username stays valid
+        :param batch_window: seconds misses are collected before they are looked up
+        :param clock: time source in seconds
+        """
+        self._fetch_users = fetch_users
+        self._max_size = max_size
+        self._ttl = ttl
+        self._batch_window = batch_window
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user id -> (username, time added)
+        self._pending = None
+
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+
+    def get_username(self, user_id: str) -> str:
+        """
+        Returns the username for a user id, looking it up if it is not cached.
+        :raises KeyError: if the user does not exist
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and self._clock() - entry[1] < self._ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            batch.user_ids.add(user_id)
+
+        if leader:
+            self._resolve(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+        return batch.usernames[user_id]
+
+    def _resolve(self, batch: _Batch):
+        time.sleep(self._batch_window)
+        with self._lock:
+            self._pending = None
+
+        try:
+            self.lookups += 1
+            users = self._fetch_users(list(batch.user_ids))
+            batch.usernames = {u['id']: u['username'] for u in users}
+            with self._lock:
+                for user_id, username in batch.usernames.items():
+                    self._put(user_id, username)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def _put(self, user_id: str, username: str):
+        self._entries[user_id] = (username, self._clock())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'lookups': self.lookups,
+                'hit_rate': self.hits / requests if requests else 0.0,
+            }
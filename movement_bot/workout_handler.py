@@ -1,12 +1,17 @@
-import csv
 import datetime
-import os
 import random
-import re
+import threading
 
 from movement_bot.channel_bot import ChannelBot
+from movement_bot.command_router import CommandRouter, Message
 from movement_bot.exercises import ExerciseRegistry
-from movement_bot.statistics_generator import generate_stats_for_single_user, generate_stats_for_all_users
+from movement_bot.replicas import ReplicaCoordinator
+from movement_bot.sessions import Session, SessionBook
+from movement_bot.statistics_generator import generate_stats_for_single_user, generate_stats_for_all_users, \
+    generate_leaderboard, generate_streaks, generate_session_stats, generate_exercise_volume, StatisticsAggregator, \
+    WEEK, MONTH
+from movement_bot.workout_journal import WorkoutJournal
+from movement_bot.workout_store import WorkoutStore
 
 
 class WorkoutMessageHandler:
@@ -30,82 +35,275 @@ class WorkoutMessageHandler:
         "Rocky would be proud of you, NAME! :boxing_glove:",
     ]
 
-    def __init__(self, exercise_registry: ExerciseRegistry, csv_workout_file):
+    def __init__(self, exercise_registry: ExerciseRegistry, csv_workout_file, journal_file=None, open_sessions=3,
+                 coordinator: ReplicaCoordinator = None, channel=None, is_active_day=None):
+        """
+        :param open_sessions: number of recent workouts (sessions) which can still be completed
+        :param coordinator: shares sessions and completed workouts with other replicas of the bot, which makes the
+            journal unnecessary - only the leader opens sessions and stores workouts
+        :param channel: name of the channel among the channels of the coordinated replicas
+        :param is_active_day: returns whether workouts take place on a date, see StatisticsAggregator
+        """
         self.exercise_registry = exercise_registry
         self.csv_workout_file = csv_workout_file
+        self._is_active_day = is_active_day
+        self.statistics = StatisticsAggregator(is_active_day)
+        self.workout_store = WorkoutStore(csv_workout_file, listeners=[self.statistics.add])
+        self.sessions = SessionBook(open_sessions)
+        # (workout set id, user id) -> entry, completed workouts of a session are stored once it is closed
         self.completed_workouts = dict()
+        self._completed_lock = threading.Lock()
+        self._routers = dict()  # bot username -> CommandRouter
+        # WorkoutSchedule of the channel, answers the next command
+        self.schedule = None
+        self.coordinator = coordinator
+        self.channel = channel
+
+        # completed workouts are journaled until they are stored
+        self.journal = WorkoutJournal(journal_file) if journal_file and not coordinator else None
+        if self.journal:
+            self._replay_journal()
+
+    def _replay_journal(self):
+        for entry in self.journal.replay():
+            # the journal may not have been emptied after the workouts were stored
+            if not self.workout_store.contains(entry):
+                self.completed_workouts[(entry.get('session'), entry['user_id'])] = entry
+
+    def register_commands(self, router: CommandRouter):
+        """ Registers the workout commands, which are dispatched with a Message. """
+        router.register(r'list\s*$', self._handle_list)
+        router.register(r'stats\s*$', self._handle_stats)
+        router.register(r'done (?P<diff>easy|medium|hard)\s*$', self._handle_done)
+        router.register(r'stats (?P<period>week|month)\s*$', self._handle_leaderboard)
+        router.register(r'stats streaks\s*$', self._handle_streaks)
+        router.register(r'stats sessions\s*$', self._handle_sessions)
+        router.register(r'stats exercises\s*$', self._handle_exercises)
+        router.register(r'stats since (?P<since>\d{4}-\d{2}-\d{2})\s*$', self._handle_stats_since)
+        router.register(r'stats (?P<user_name>[a-zA-Z0-9]+)\s*$', self._handle_user_stats)
+        router.register(r'next\s*$', self._handle_next)
+        router.register(r'current\s*$', self._handle_current)
+        router.set_default(self._handle_unknown)
+
+    def handle_message(self, sender_id: str, sender_name: str, message: str, post_id: str, channel_id: str, bot: ChannelBot,
+                       in_thread=False):
+        router = self._routers.get(bot.username)
+        if router is None:
+            router = self._routers[bot.username] = CommandRouter(bot.username)
+            self.register_commands(router)
+            router.compile()
+
+        router.dispatch(message, Message(bot, channel_id, post_id, sender_id, message, sender_name, in_thread))
+
+    def _handle_list(self, message: Message):
+        # list exercises
+        message.answer(self.exercise_registry.create_exercise_list_message())
+
+    def _handle_stats(self, message: Message):
+        message.answer(self._create_stats())
 
-    def handle_message(self, sender_id: str, sender_name: str, message: str, post_id: str, channel_id: str, bot: ChannelBot):
-        if re.match(r'(@' + bot.username + ')?\s*list\s*$', message):
-            # list exercises
-            bot.answer_message_in_channel(channel_id, post_id, self.exercise_registry.create_exercise_list_message())
-        elif re.match(r'(@' + bot.username + ')?\s*stats\s*$', message):
-            bot.answer_message_in_channel(channel_id, post_id, self._create_stats())
+    def _session_for(self, message: Message) -> Session:
+        # answers in the thread of an announcement belong to its session, top-level mentions to the current one
+        if message.in_thread:
+            return self.sessions.get(message.post_id)
+        return self.sessions.current
+
+    @staticmethod
+    def _answer_no_session(message: Message):
+        if message.in_thread:
+            message.answer("This workout is closed already - join the current one!")
         else:
-            done_match = re.match(r'(@' + bot.username + ')?\s*done (?P<diff>easy|medium|hard)\s*$', message)
-            stats_match = re.match(r'(@' + bot.username + ')?\s*stats (?P<user_name>[a-zA-Z0-9]+)\s*$', message)
-            if done_match:
-                # store accomplished workout
-                difficulty = done_match.group('diff')
-                workout = self.exercise_registry.current_workout[difficulty] # [(str, int, str)]
-                self.completed_workouts[sender_id] = {
-                    'user_id': sender_id,
-                    'user_name': sender_name,
-                    'datetime': str(datetime.datetime.now()),
-                    'difficulty': difficulty,
-                    'workout': "|".join(map(lambda e: "{}:{}".format(e[0],e[1]), workout))
-                }
-
-                success_message = random.choice(self.CONGRATS)
-                bot.answer_message_in_channel(channel_id, post_id, success_message.replace('NAME', sender_name))
-            elif stats_match:
-                user_name = stats_match.group('user_name')
-                bot.answer_message_in_channel(channel_id, post_id, self._create_user_stats(user_name))
-            else:
-                # Unknown
-                bot.answer_message_in_channel(channel_id, post_id, "I don't get it - try 'help' instead!")
-
-    def _get_stats_from_file(self, user_name=None):
-        """
-        One result entry is of following form:
-        {
-            'user_id': '...',
-            'user_name': '...',
-            'time': '2018-07-29 09:17:13.812189',
-            'difficulty': 'easy',
-            'workout': 'title1:number1|...|titlen:numbern'
+            message.answer("No workout yet - stay tuned!")
+
+    def _sync(self):
+        """ Takes over the sessions opened and the workouts stored by the leader replica. """
+        if self.coordinator is None:
+            return
+        self.workout_store.refresh()
+        for version, workout_set, post_id, opened in self.coordinator.recent_sessions(self.channel,
+                                                                                      self.sessions.max_open):
+            session, _ = self.sessions.open(workout_set, opened, version)
+            if session is None:
+                session = next((s for s in self.sessions.open_sessions if s.version == version), None)
+            if session is not None and post_id and session.post_id != post_id:
+                self.sessions.bind(session, post_id)
+            self.statistics.add_session(workout_set.id, opened.date())
+
+    def _handle_done(self, message: Message, diff):
+        sender_name = message.sender_name
+        if self.coordinator:
+            self._handle_done_coordinated(message, diff, sender_name)
+            return
+
+        with self._completed_lock:
+            # sessions closed meanwhile are stored under the same lock, so the workout can't be stored twice
+            session = self._session_for(message)
+            if session is None:
+                self._answer_no_session(message)
+                return
+
+            # store accomplished workout
+            entry = self._workout_entry(message, sender_name, session, diff)
+            key = (session.workout_set.id, message.sender_id)
+            self.completed_workouts[key] = entry
+            committed = self.journal.record(entry) if self.journal else None
+        if committed:
+            try:
+                committed.result()
+            except Exception:
+                # not durable, so it isn't stored either
+                with self._completed_lock:
+                    if self.completed_workouts.get(key) is entry:
+                        del self.completed_workouts[key]
+                message.answer("Sorry, I couldn't save your workout - please try again.")
+                return
+
+        success_message = random.choice(self.CONGRATS)
+        message.answer(success_message.replace('NAME', message.sender_name), coalesce=True)
+
+    def _handle_done_coordinated(self, message: Message, diff, sender_name):
+        # the leader may close the session in the meantime - the workout is recorded for the session open then
+        for _ in range(3):
+            self._sync()
+            session = self._session_for(message)
+            if session is None:
+                self._answer_no_session(message)
+                return
+            entry = self._workout_entry(message, sender_name, session, diff)
+            if self.coordinator.record_workout(self.channel, entry, self.sessions.max_open):
+                break
+        else:
+            print("Could not record workout of {}, its sessions were closed.".format(sender_name))
+            return
+
+        success_message = random.choice(self.CONGRATS)
+        message.answer(success_message.replace('NAME', message.sender_name), coalesce=True)
+
+    @staticmethod
+    def _workout_entry(message: Message, sender_name, session: Session, diff) -> dict:
+        workout = session.workout_set.workout[diff] # [(str, int, str)]
+        return {
+            'user_id': message.sender_id,
+            'user_name': sender_name,
+            'datetime': str(datetime.datetime.now()),
+            'difficulty': diff,
+            'workout': "|".join(map(lambda e: "{}:{}".format(e[0],e[1]), workout)),
+            'session': session.workout_set.id
         }
-        """
-        if not os.path.exists(self.csv_workout_file):
-            raise IOError('file not found')
 
-        with open(self.csv_workout_file, 'r') as csv_file:
-            fieldnames = ['user_id', 'user_name', 'datetime', 'difficulty', 'workout']
-            reader = csv.DictReader(csv_file, fieldnames=fieldnames)
-            lines = list(reader)[1:] # ignore header
+    def _handle_leaderboard(self, message: Message, period):
+        period = WEEK if period == 'week' else MONTH
+        message.answer(generate_leaderboard(self.statistics, period, self._pending_workouts()))
+
+    def _handle_streaks(self, message: Message):
+        message.answer(generate_streaks(self.statistics, self._pending_workouts()))
+
+    def _handle_sessions(self, message: Message):
+        # sessions opened by the leader
+        self._sync()
+        message.answer(generate_session_stats(self.statistics, self._pending_workouts()))
+
+    def _handle_exercises(self, message: Message):
+        # volume of stored workouts only, pending ones are added once stored
+        message.answer(generate_exercise_volume(self.statistics))
+
+    def _handle_stats_since(self, message: Message, since):
+        message.answer(self._create_stats_since(since))
+
+    def _handle_user_stats(self, message: Message, user_name):
+        message.answer(self._create_user_stats(user_name))
+
+    def _handle_current(self, message: Message):
+        self._sync()
+        session = self._session_for(message)
+        if session is None:
+            self._answer_no_session(message)
+            return
+        message.answer(self.exercise_registry.create_training_message_for_workout_set(session.workout_set))
 
-            if user_name:
-                lines = filter(lambda l: l['user_name'] == user_name, lines)
+    def _handle_next(self, message: Message):
+        next_fire = self.schedule.next_fire if self.schedule else None
+        if next_fire is None:
+            message.answer("No workout planned - enjoy your chair while it lasts.")
+            return
 
-            return list(lines)
+        next_fire = self.schedule.window.local(next_fire)
+        if next_fire.date() == self.schedule.window.local(datetime.datetime.now().astimezone()).date():
+            message.answer("Next workout at {}.".format(next_fire.strftime('%H:%M')))
+        else:
+            message.answer("Next workout on {}.".format(next_fire.strftime('%A, %d.%m. at %H:%M')))
+
+    def _handle_unknown(self, message: Message):
+        message.answer("I don't get it - try 'help' instead!")
+
+    def _pending_workouts(self) -> [dict]:
+        if self.coordinator:
+            self._sync()
+            return self.coordinator.pending_workouts(self.channel)
+        with self._completed_lock:
+            return list(self.completed_workouts.values())
 
     def _create_user_stats(self, user_name) -> str:
-        stats = self._get_stats_from_file(user_name)
-        return generate_stats_for_single_user(stats, user_name)
+        return generate_stats_for_single_user(self.statistics, user_name, self._pending_workouts())
 
     def _create_stats(self) -> str:
-        stats = self._get_stats_from_file()
-        return generate_stats_for_all_users(stats)
+        return generate_stats_for_all_users(self.statistics, self._pending_workouts())
+
+    def _create_stats_since(self, since) -> str:
+        # only the part of the workout file after the date is read
+        statistics = StatisticsAggregator(self._is_active_day)
+        for entry in self.workout_store.iter_workouts(since):
+            statistics.add(entry)
+        pending = [e for e in self._pending_workouts() if e['datetime'] >= since]
+        return generate_stats_for_all_users(statistics, pending)
+
+    def open_session(self) -> Session:
+        """
+        Starts a new workout: creates a workout set and opens a session for it. Workouts of sessions closed by it are
+        stored. The announcement post should be bound to the session with bind_session once it is posted.
+        Of coordinated replicas, only the leader opens sessions.
+        """
+        workout_set = self.exercise_registry.create_new_workout_set()
+        if self.coordinator:
+            self._sync()
+            opened = datetime.datetime.now()
+            version = self.coordinator.publish_session(self.channel, workout_set, opened)
+            session, _ = self.sessions.open(workout_set, opened, version)
+            # unless a concurrent sync opened it already
+            session = session or next(s for s in self.sessions.open_sessions if s.version == version)
+        else:
+            session, _ = self.sessions.open(workout_set)
+        # listed in the session stats even if nobody works out
+        self.statistics.add_session(workout_set.id, session.opened.date())
+        self.store_completed_workouts()
+        return session
+
+    def bind_session(self, session: Session, post_id):
+        self.sessions.bind(session, post_id)
+        if self.coordinator:
+            self.coordinator.bind_session(self.channel, session.version, post_id)
 
     def store_completed_workouts(self):
-        file_exists = os.path.exists(self.csv_workout_file)
-        with open(self.csv_workout_file, 'a') as csv_file:
-            fieldnames = ['user_id', 'user_name', 'datetime', 'difficulty', 'workout']
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            if not file_exists:
-                writer.writeheader()
+        """ Stores the completed workouts of all closed sessions. """
+        if self.coordinator:
+            self._store_coordinated_workouts()
+            return
 
-            for w in self.completed_workouts.values():
-                writer.writerow(w)
+        with self._completed_lock:
+            closed = [k for k in self.completed_workouts if not self.sessions.is_open(k[0])]
+            if not closed:
+                return
+            self.workout_store.append([self.completed_workouts.pop(k) for k in closed])
+            if self.journal:
+                # the journal keeps the workouts of open sessions
+                self.journal.checkpoint(list(self.completed_workouts.values()))
 
-        self.completed_workouts.clear()
+    def _store_coordinated_workouts(self):
+        with self._completed_lock:
+            closed = self.coordinator.closed_workouts(self.channel, self.sessions.max_open)
+            if not closed:
+                return
+            self.workout_store.refresh()
+            # a former leader may have stored them without removing them from the database
+            self.workout_store.append([e for e in closed if not self.workout_store.contains(e)])
+            self.coordinator.remove_workouts(self.channel, closed)
@@ -0,0 +1,145 @@
+import json
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from movement_bot.log_file import replace_file, truncate_partial_line
+from movement_bot.metrics import STORE_WRITE_LATENCY
+
+
+class _JournalWriter:
+    """ Writes the journals of all channels from a single background thread, started with the first journal. """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, journal, item, future: Future):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='journal-writer')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((journal, item, future))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            by_journal = dict()  # journal -> [(item, future)] in queue order
+            for journal, item, future in batch:
+                by_journal.setdefault(journal, []).append((item, future))
+            for journal, items in by_journal.items():
+                journal._write(items)
+
+
+_writer = _JournalWriter()
+
+
+class WorkoutJournal:
+    """
+    Write-ahead journal for completed workouts which are not stored yet.
+
+    Entries are appended as json lines by a background thread shared by all journals. Records queued while a write is in progress are
+    committed together with a single fsync (group commit). A checkpoint replaces the journal by the entries which are
+    not stored elsewhere yet; the new journal is written to a temporary file first, so a crash leaves either the old or
+    the new one. Checkpoints are ordered with the records, so entries recorded after a checkpoint are kept.
+
+    A partially written final line, e.g. of a crash during an append, is cut off before appending again. If writing
+    fails, the futures of the batch fail and the journal is cut back to its size before the batch.
+    """
+    _CHECKPOINT = object()
+
+    def __init__(self, journal_file):
+        self._journal_file = journal_file
+        if truncate_partial_line(journal_file):
+            print("Removed a partially written workout from {}.".format(journal_file))
+        self._journal = open(journal_file, 'a')
+
+    def replay(self) -> [dict]:
+        """ Returns all entries of the journal in recording order. """
+        entries = []
+        with open(self._journal_file, 'r') as f:
+            for line in f:
+                # ignore a partially written final line
+                if not line.endswith('\n'):
+                    break
+                entries.append(json.loads(line))
+        return entries
+
+    def record(self, entry: dict) -> Future:
+        """
+        Queues an entry.
+        :return: a future resolving once the entry is durable, or failing if it couldn't be written
+        """
+        committed = Future()
+        _writer.put(self, json.dumps(entry) + '\n', committed)
+        return committed
+
+    def checkpoint(self, entries: [dict] = ()) -> Future:
+        """
+        Queues the replacement of all entries recorded so far.
+        :param entries: entries to keep, e.g. the ones not stored yet
+        :return: a future resolving once the journal is replaced
+        """
+        done = Future()
+        _writer.put(self, (self._CHECKPOINT, [json.dumps(e) + '\n' for e in entries]), done)
+        return done
+
+    def _write(self, batch):
+        try:
+            self._commit([item for item, _ in batch])
+        except Exception as e:
+            print("Writing workout journal {} failed: {}".format(self._journal_file, e))
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(None)
+
+    def _commit(self, items):
+        lines = []
+        checkpoint = False
+        for item in items:
+            if isinstance(item, tuple) and item[0] is self._CHECKPOINT:
+                # entries before the checkpoint don't have to be written at all
+                lines = list(item[1])
+                checkpoint = True
+            else:
+                lines.append(item)
+
+        with STORE_WRITE_LATENCY.time('journal'):
+            if checkpoint:
+                self._close()
+                # the journal is reopened by the next append, also if it couldn't be replaced
+                replace_file(self._journal_file, ''.join(lines))
+                return
+
+            if self._journal is None:
+                self._journal = open(self._journal_file, 'a')
+            size = os.fstat(self._journal.fileno()).st_size
+            try:
+                self._journal.write(''.join(lines))
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            except BaseException:
+                # none of the batch is acknowledged, so none of it may be replayed
+                self._close()
+                try:
+                    os.truncate(self._journal_file, size)
+                except OSError as e:
+                    print("Truncating workout journal failed: {}".format(e))
+                raise
+
+    def _close(self):
+        journal, self._journal = self._journal, None
+        if journal is not None:
+            try:
+                journal.close()
+            except OSError:
+                # buffered lines which can't be written are dropped
+                pass
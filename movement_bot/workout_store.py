@@ -0,0 +1,195 @@
+import csv
+import io
+import os
+import threading
+
+from movement_bot.csv_stream import FIELDNAMES, ReadStats, SparseTimeIndex, detect_header, iter_lines, iter_rows, \
+    parse_header, parse_line
+from movement_bot.log_file import replace_file
+from movement_bot.metrics import STORE_WRITE_LATENCY
+
+
+class WorkoutStore:
+    """
+    Stores accomplished workouts in a csv file.
+
+    The file is streamed once on creation, only a sparse index over the datetime column is kept, so memory usage does
+    not grow with the file. It allows reading just the rows after some point in time, other queries stream the file.
+    Listeners are called with every row loaded or appended, e.g. to maintain aggregates.
+
+    Files with or without header are read, rows are appended in the column order of an existing header. Files written
+    before sessions were recorded get a session column when they are loaded.
+
+    One row is of following form:
+    {
+        'user_id': '...',
+        'user_name': '...',
+        'datetime': '2018-07-29 09:17:13.812189',
+        'difficulty': 'easy',
+        'workout': 'title1:number1|...|titlen:numbern',
+        'session': '...'
+    }
+    """
+    FIELDNAMES = FIELDNAMES
+
+    def __init__(self, csv_file, listeners=None):
+        self.csv_file = csv_file
+        self._listeners = listeners or []
+
+        self._lock = threading.Lock()
+        self.fieldnames = self.FIELDNAMES
+        self.read_stats = ReadStats()
+        self._size = 0
+        self._rows = 0
+        self._user_names = dict()  # user name -> None, in order of the first workout
+        self._by_time = SparseTimeIndex()
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.csv_file):
+            return
+
+        if self._add_session_column():
+            print("Added the session column to {}.".format(self.csv_file))
+        self._size = os.path.getsize(self.csv_file)
+        self.fieldnames, self._by_time.start = detect_header(self.csv_file)
+        for offset, row in iter_rows(self.csv_file, self.fieldnames, self._by_time.start, self._size, self.read_stats):
+            self._index(offset, row)
+
+        if self.read_stats.malformed_rows:
+            print("Skipped {} malformed rows in {}.".format(self.read_stats.malformed_rows, self.csv_file))
+
+    def _add_session_column(self) -> bool:
+        """
+        Rewrites a file without session column (with or without header) with the current header, the session of its
+        rows stays empty. Malformed rows are kept as they are.
+        :return: whether the file was rewritten
+        """
+        with open(self.csv_file, 'rb') as f:
+            first = f.readline()
+            fieldnames, offset = parse_header(first)
+            if not first or 'session' in fieldnames:
+                return False
+
+            self.fieldnames = self.FIELDNAMES
+
+            def lines():
+                yield self._format_row(dict(zip(self.fieldnames, self.fieldnames)))
+                for _, line in iter_lines(f, offset):
+                    fields = parse_line(line)
+                    if fields and len(fields) == len(fieldnames):
+                        line = self._format_row(dict(zip(fieldnames, fields)))
+                    yield line
+
+            replace_file(self.csv_file, lines())
+        return True
+
+    def refresh(self):
+        """ Indexes rows appended to the file by another process, e.g. the leader of several bot replicas. """
+        with self._lock:
+            size = os.path.getsize(self.csv_file) if os.path.exists(self.csv_file) else 0
+            known = None
+            if self._size and size and detect_header(self.csv_file)[0] != self.fieldnames:
+                # another replica added the session column, the rows are the same but moved
+                known, self._rows, self._size = self._rows, 0, 0
+                self._by_time = SparseTimeIndex()
+            if size <= self._size:
+                return
+
+            if self._size == 0:
+                self.fieldnames, self._by_time.start = detect_header(self.csv_file)
+            start = max(self._size, self._by_time.start)
+            with open(self.csv_file, 'rb') as f:
+                f.seek(start)
+                tail = f.read(size - start)
+            # a partially written final row is indexed by a later refresh
+            end = start + tail.rfind(b'\n') + 1
+            for offset, row in iter_rows(self.csv_file, self.fieldnames, start, end, self.read_stats):
+                # listeners already got the rows indexed before the file was rewritten
+                self._index(offset, row, known is None or self._rows >= known)
+            self._size = max(end, self._size)
+
+    def _index(self, offset: int, row: dict, notify=True):
+        self._rows += 1
+        self._user_names[row['user_name']] = None
+        self._by_time.add(row['datetime'], offset)
+        if notify:
+            for listener in self._listeners:
+                listener(row)
+
+    def _iter_rows(self, offset=None):
+        """ Streams the indexed rows starting at offset, by default at the first row. """
+        with self._lock:
+            start, end = self._by_time.start if offset is None else offset, self._size
+        if not os.path.exists(self.csv_file):
+            return
+
+        for _, row in iter_rows(self.csv_file, self.fieldnames, start, end):
+            yield row
+
+    def append(self, rows: [dict]):
+        """
+        Appends workouts to the csv file and the indexes, and syncs the file to disk.
+        :param rows: workouts in the form described above
+        """
+        with self._lock, STORE_WRITE_LATENCY.time('workouts'):
+            with open(self.csv_file, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    self.fieldnames = self.FIELDNAMES
+                    f.write(self._format_row(dict(zip(self.fieldnames, self.fieldnames))))
+                    self._by_time.start = f.tell()
+
+                for row in rows:
+                    offset = f.tell()
+                    f.write(self._format_row(row))
+                    self._index(offset, row)
+                # durable before the journal drops them
+                f.flush()
+                os.fsync(f.fileno())
+                self._size = f.tell()
+
+    def _format_row(self, row: dict) -> bytes:
+        buffer = io.StringIO()
+        csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore').writerow(row)
+        return buffer.getvalue().encode('utf-8')
+
+    def get_workouts(self, user_name=None) -> [dict]:
+        """
+        Returns all stored workouts, optionally restricted to a single user.
+        :param user_name: the user name or None for all users
+        :return: the workouts
+        """
+        return [row for row in self._iter_rows() if not user_name or row['user_name'] == user_name]
+
+    def iter_workouts(self, since: str):
+        """
+        Streams all workouts at or after a point in time, reading only the tail of the file if it is sorted.
+        :param since: datetime in the format of the file, e.g. '2018-07-29' or '2018-07-29 09:17:13'
+        """
+        with self._lock:
+            offset = self._by_time.offset_before(since)
+        for row in self._iter_rows(offset):
+            if row['datetime'] >= since:
+                yield row
+
+    def get_workouts_for_day(self, day: str) -> [dict]:
+        """
+        Returns all workouts of a day.
+        :param day: the day in 'YYYY-MM-DD' format
+        :return: the workouts
+        """
+        return [row for row in self.iter_workouts(day) if row['datetime'][:10] == day]
+
+    def contains(self, row: dict) -> bool:
+        """ Returns whether a workout of the same user at the same time is already stored. """
+        return any(r['user_id'] == row['user_id'] and r['datetime'] == row['datetime']
+                   for r in self.iter_workouts(row['datetime']))
+
+    def user_names(self) -> [str]:
+        with self._lock:
+            return list(self._user_names)
+
+    def __len__(self):
+        return self._rows
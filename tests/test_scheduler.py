@@ -0,0 +1,211 @@
+import datetime
+import random
+import unittest
+from unittest import mock
+
+from movement_bot import scheduler
+from movement_bot.scheduler import ActiveWindow, FakeClock, Scheduler, WorkoutSchedule
+
+BERLIN = 'Europe/Berlin'
+
+
+def berlin(*args) -> datetime.datetime:
+    return datetime.datetime(*args, tzinfo=scheduler.ZoneInfo(BERLIN))
+
+
+class ActiveWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        # mon - fri, 9:00 - 17:59
+        self.window = ActiveWindow(9, 17, False, BERLIN)
+
+    def test_contains_edges(self):
+        # 2026-10-19 is a monday
+        self.assertFalse(self.window.contains(berlin(2026, 10, 19, 8, 59)))
+        self.assertTrue(self.window.contains(berlin(2026, 10, 19, 9, 0)))
+        self.assertTrue(self.window.contains(berlin(2026, 10, 19, 17, 59)))
+        self.assertFalse(self.window.contains(berlin(2026, 10, 19, 18, 0)))
+
+    def test_contains_converts_to_timezone(self):
+        # 7:30 utc is 9:30 in berlin during summer time
+        self.assertTrue(self.window.contains(datetime.datetime(2026, 7, 6, 7, 30, tzinfo=datetime.timezone.utc)))
+        self.assertFalse(self.window.contains(datetime.datetime(2026, 7, 6, 6, 30, tzinfo=datetime.timezone.utc)))
+
+    def test_next_start_within_window(self):
+        dt = berlin(2026, 10, 19, 12, 0)
+        self.assertEqual(dt, self.window.next_start(dt))
+
+    def test_next_start_before_window(self):
+        self.assertEqual(berlin(2026, 10, 19, 9), self.window.next_start(berlin(2026, 10, 19, 6, 0)))
+
+    def test_next_start_after_window(self):
+        self.assertEqual(berlin(2026, 10, 20, 9), self.window.next_start(berlin(2026, 10, 19, 18, 0)))
+
+    def test_next_start_skips_weekend(self):
+        # friday evening -> monday morning
+        self.assertEqual(berlin(2026, 10, 26, 9), self.window.next_start(berlin(2026, 10, 23, 18, 0)))
+
+    def test_weekend(self):
+        window = ActiveWindow(9, 17, True, BERLIN)
+        self.assertTrue(window.contains(berlin(2026, 10, 24, 10, 0)))
+        self.assertEqual(berlin(2026, 10, 24, 9), window.next_start(berlin(2026, 10, 23, 18, 0)))
+
+    def test_holidays(self):
+        window = ActiveWindow(9, 17, False, BERLIN, [datetime.date(2026, 12, 24), datetime.date(2026, 12, 25)])
+        self.assertFalse(window.contains(berlin(2026, 12, 24, 10, 0)))
+        # thu 24th and fri 25th are holidays, 26th/27th weekend
+        self.assertEqual(berlin(2026, 12, 28, 9), window.next_start(berlin(2026, 12, 23, 18, 0)))
+
+    def test_no_active_day(self):
+        window = ActiveWindow(9, 17, False, BERLIN, [datetime.date(2026, 10, 19) + datetime.timedelta(days=d)
+                                                    for d in range(3 * 366)])
+        with self.assertRaises(ValueError):
+            window.next_start(berlin(2026, 10, 19, 18, 0))
+
+    def test_next_start_across_dst_change(self):
+        # summer time ends on sunday, 2026-10-25: 9:00 is 7:00 utc before and 8:00 utc after the change
+        window = ActiveWindow(9, 17, True, BERLIN)
+        start = window.next_start(berlin(2026, 10, 24, 18, 0))
+        self.assertEqual(berlin(2026, 10, 25, 9), start)
+        self.assertEqual(datetime.datetime(2026, 10, 25, 8, tzinfo=datetime.timezone.utc), start)
+        self.assertEqual(datetime.datetime(2026, 10, 24, 7, tzinfo=datetime.timezone.utc),
+                         window.next_start(berlin(2026, 10, 23, 18, 0)))
+
+    def test_window_across_dst_change(self):
+        # summer time starts on sunday, 2026-03-29 at 2:00
+        window = ActiveWindow(1, 3, True, BERLIN)
+        utc = datetime.timezone.utc
+        self.assertTrue(window.contains(datetime.datetime(2026, 3, 29, 0, 30, tzinfo=utc)))  # 1:30 cet
+        self.assertTrue(window.contains(datetime.datetime(2026, 3, 29, 1, 30, tzinfo=utc)))  # 3:30 cest
+        self.assertFalse(window.contains(datetime.datetime(2026, 3, 29, 2, 0, tzinfo=utc)))  # 4:00 cest
+
+    def test_timezone_without_zoneinfo(self):
+        with mock.patch.object(scheduler, 'ZoneInfo', None):
+            with self.assertRaisesRegex(ValueError, BERLIN):
+                ActiveWindow(9, 17, False, BERLIN)
+            # the local timezone still works
+            self.assertIsNone(ActiveWindow(9, 17, False).timezone)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # monday, 8:00
+        self.clock = FakeClock(berlin(2026, 10, 19, 8, 0))
+        self.scheduler = Scheduler(self.clock)
+        self.fired = []
+
+    def add(self, name, window=None, wait_min=30, wait_max=30, seed=0) -> WorkoutSchedule:
+        schedule = WorkoutSchedule(name, window or ActiveWindow(9, 17, False, BERLIN), wait_min, wait_max,
+                                   lambda: self.fired.append((name, self.clock.now())), random.Random(seed))
+        self.scheduler.add(schedule)
+        return schedule
+
+    def advance_to(self, dt: datetime.datetime):
+        """ Moves the clock minute by minute, firing due schedules like the loop would. """
+        while self.clock.now() < dt:
+            self.clock.advance(minutes=1)
+            self.scheduler.run_pending()
+
+    def test_first_fire_at_window_start(self):
+        schedule = self.add('a')
+        self.assertEqual(berlin(2026, 10, 19, 9), schedule.next_fire)
+
+        self.advance_to(berlin(2026, 10, 19, 8, 59))
+        self.assertEqual([], self.fired)
+        self.advance_to(berlin(2026, 10, 19, 9, 0))
+        self.assertEqual([('a', berlin(2026, 10, 19, 9))], self.fired)
+        self.assertEqual(berlin(2026, 10, 19, 9, 30), schedule.next_fire)
+
+    def test_fires_only_within_window(self):
+        self.add('a')
+        self.advance_to(berlin(2026, 10, 20, 9, 0))
+
+        times = [t for _, t in self.fired]
+        # 9:00, 9:30, ..., 17:30 on monday, then tuesday 9:00
+        self.assertEqual(19, len(times))
+        self.assertEqual(berlin(2026, 10, 19, 17, 30), times[-2])
+        self.assertEqual(berlin(2026, 10, 20, 9, 0), times[-1])
+        self.assertTrue(all(ActiveWindow(9, 17, False, BERLIN).contains(t) for t in times))
+
+    def test_skips_weekend_and_holidays(self):
+        # friday, 17:00, monday is a holiday
+        self.clock = self.scheduler.clock = FakeClock(berlin(2026, 10, 23, 17, 0))
+        schedule = self.add('a', ActiveWindow(9, 17, False, BERLIN, [datetime.date(2026, 10, 26)]), 600, 600)
+
+        self.scheduler.run_pending()
+        self.assertEqual([('a', berlin(2026, 10, 23, 17))], self.fired)
+        self.assertEqual(berlin(2026, 10, 27, 9), schedule.next_fire)
+
+    def test_multiple_schedules(self):
+        a = self.add('a', wait_min=20, wait_max=20)
+        b = self.add('b', ActiveWindow(10, 11, False, BERLIN), wait_min=45, wait_max=45)
+        self.advance_to(berlin(2026, 10, 19, 12, 0))
+
+        fired_a = [t for name, t in self.fired if name == 'a']
+        fired_b = [t for name, t in self.fired if name == 'b']
+        self.assertEqual([berlin(2026, 10, 19, 9) + datetime.timedelta(minutes=20 * i) for i in range(10)], fired_a)
+        self.assertEqual([berlin(2026, 10, 19, 10, 0), berlin(2026, 10, 19, 10, 45), berlin(2026, 10, 19, 11, 30)],
+                         fired_b)
+        self.assertEqual(berlin(2026, 10, 19, 12, 20), a.next_fire)
+        self.assertEqual(berlin(2026, 10, 20, 10), b.next_fire)
+
+    def test_removed_schedule_does_not_fire(self):
+        self.add('a')
+        self.add('b')
+        self.scheduler.remove('a')
+        self.advance_to(berlin(2026, 10, 19, 9, 0))
+
+        self.assertEqual([('b', berlin(2026, 10, 19, 9))], self.fired)
+        self.assertIsNone(self.scheduler.next_fire_time('a'))
+
+    def test_replaced_schedule_fires_once(self):
+        self.add('a')
+        self.add('a', seed=1)
+        self.advance_to(berlin(2026, 10, 19, 9, 0))
+
+        self.assertEqual([('a', berlin(2026, 10, 19, 9))], self.fired)
+
+    def test_late_loop_does_not_catch_up(self):
+        schedule = self.add('a')
+        # the loop was blocked from 8:00 until 10:10
+        self.clock.advance(minutes=130)
+        self.scheduler.run_pending()
+
+        self.assertEqual(1, len(self.fired))
+        self.assertEqual(berlin(2026, 10, 19, 10, 40), schedule.next_fire)
+
+    def test_failing_callback_keeps_schedule(self):
+        schedule = WorkoutSchedule('a', ActiveWindow(9, 17, False, BERLIN), 30, 30, lambda: 1 / 0)
+        self.scheduler.add(schedule)
+        self.clock.advance(hours=1)
+        self.scheduler.run_pending()
+
+        self.assertEqual(berlin(2026, 10, 19, 9, 30), schedule.next_fire)
+
+    def test_callback_sets_next_fire(self):
+        later = berlin(2026, 10, 19, 11, 5)
+        schedule = WorkoutSchedule('a', ActiveWindow(9, 17, False, BERLIN), 30, 30,
+                                   lambda: self.fired.append(('a', self.clock.now())) or later)
+        self.scheduler.add(schedule)
+        self.advance_to(berlin(2026, 10, 19, 9, 0))
+        self.assertEqual(later, schedule.next_fire)
+
+        schedule.callback = lambda: self.fired.append(('a', self.clock.now()))
+        self.advance_to(berlin(2026, 10, 19, 11, 5))
+        self.assertEqual([berlin(2026, 10, 19, 9, 0), later], [t for _, t in self.fired])
+        self.assertEqual(berlin(2026, 10, 19, 11, 35), schedule.next_fire)
+
+    def test_random_wait_within_bounds(self):
+        schedule = self.add('a', wait_min=10, wait_max=50, seed=42)
+        previous = None
+        for _ in range(50):
+            self.advance_to(schedule.next_fire)
+            fired = self.fired[-1][1]
+            if previous and fired.date() == previous.date():
+                self.assertTrue(datetime.timedelta(minutes=10) <= fired - previous <= datetime.timedelta(minutes=50))
+            previous = fired
+
+
+if __name__ == '__main__':
+    unittest.main()
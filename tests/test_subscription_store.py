@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from movement_bot import subscription_store
+from movement_bot.subscription_store import SubscriptionStore
+
+TIMEOUT = 5
+
+
+class SubscriptionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.directory, 'subscriptions.txt')
+        self.log_file = self.snapshot_file + '.log'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopened(self) -> set:
+        return set(SubscriptionStore(self.snapshot_file))
+
+    def read(self, path) -> str:
+        with open(path, 'r') as f:
+            return f.read()
+
+    def test_changes_are_replayed(self):
+        store = SubscriptionStore(self.snapshot_file)
+        store.add('a').result(TIMEOUT)
+        store.add('b').result(TIMEOUT)
+        store.discard('a').result(TIMEOUT)
+        self.assertEqual({'b'}, self.reopened())
+
+    def test_torn_tail_is_cut_off(self):
+        with open(self.log_file, 'w') as f:
+            f.write('+a\n+b\n-')
+        store = SubscriptionStore(self.snapshot_file)
+        self.assertEqual({'a', 'b'}, set(store))
+
+        store.discard('b').result(TIMEOUT)
+        store.add('c').result(TIMEOUT)
+        self.assertEqual('+a\n+b\n-b\n+c\n', self.read(self.log_file))
+        self.assertEqual({'a', 'c'}, self.reopened())
+
+    def test_compaction(self):
+        store = SubscriptionStore(self.snapshot_file, compact_after=3)
+        for user_id in 'abcd':
+            store.add(user_id)
+        store.discard('b')
+        store.flush()
+
+        self.assertEqual({'a', 'c', 'd'}, set(self.read(self.snapshot_file).split()))
+        self.assertLessEqual(len(self.read(self.log_file).splitlines()), 3)
+        self.assertEqual({'a', 'c', 'd'}, self.reopened())
+
+        # the new log is appended to
+        store.add('e').result(TIMEOUT)
+        self.assertEqual({'a', 'c', 'd', 'e'}, self.reopened())
+
+    def test_failed_compaction_keeps_log(self):
+        store = SubscriptionStore(self.snapshot_file, compact_after=1)
+        with mock.patch.object(subscription_store, 'replace_file', side_effect=OSError(28, 'No space left on device')):
+            # the changes are durable in the log
+            store.add('a').result(TIMEOUT)
+            store.add('b').result(TIMEOUT)
+        self.assertEqual({'a', 'b'}, self.reopened())
+
+        store.add('c').result(TIMEOUT)
+        self.assertEqual({'a', 'b', 'c'}, set(self.read(self.snapshot_file).split()))
+        self.assertEqual({'a', 'b', 'c'}, self.reopened())
+
+    def test_failed_write_is_not_acknowledged(self):
+        store = SubscriptionStore(self.snapshot_file)
+        store.add('a').result(TIMEOUT)
+        with mock.patch.object(subscription_store.os, 'fsync', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                store.add('b').result(TIMEOUT)
+        self.assertEqual('+a\n', self.read(self.log_file))
+
+        # subscribing again waits until the subscription is saved
+        store.add('b').result(TIMEOUT)
+        self.assertEqual({'a', 'b'}, self.reopened())
+
+    def test_unexpected_error_keeps_writer_alive(self):
+        store = SubscriptionStore(self.snapshot_file)
+        with mock.patch.object(store, '_append', side_effect=ValueError('I/O operation on closed file')):
+            with self.assertRaises(ValueError):
+                store.add('a').result(TIMEOUT)
+        store.add('b').result(TIMEOUT)
+        store.flush()
+        self.assertIn('b', self.reopened())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from movement_bot import workout_journal
+from movement_bot.workout_journal import WorkoutJournal
+
+TIMEOUT = 5
+
+
+def entry(user_id) -> dict:
+    return {'user_id': user_id, 'session': 's1', 'difficulty': 'easy'}
+
+
+class WorkoutJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.directory, 'workouts.journal')
+        self.journal = WorkoutJournal(self.journal_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replayed(self) -> [str]:
+        return [e['user_id'] for e in self.journal.replay()]
+
+    def test_record_and_replay(self):
+        self.journal.record(entry('a')).result(TIMEOUT)
+        self.journal.record(entry('b')).result(TIMEOUT)
+        self.assertEqual(['a', 'b'], self.replayed())
+
+    def test_checkpoint_keeps_entries(self):
+        self.journal.record(entry('a')).result(TIMEOUT)
+        self.journal.record(entry('b')).result(TIMEOUT)
+        self.journal.checkpoint([entry('b')]).result(TIMEOUT)
+        self.journal.record(entry('c')).result(TIMEOUT)
+        self.assertEqual(['b', 'c'], self.replayed())
+
+    def test_partial_line_is_cut_before_appending(self):
+        with open(self.journal_file, 'a') as f:
+            f.write('{"user_id": "a"}\n{"user_id": "b", "sess')
+        journal = WorkoutJournal(self.journal_file)
+        journal.record(entry('c')).result(TIMEOUT)
+        self.assertEqual(['a', 'c'], [e['user_id'] for e in journal.replay()])
+
+    def test_failed_checkpoint(self):
+        self.journal.record(entry('a')).result(TIMEOUT)
+        with mock.patch.object(workout_journal, 'replace_file', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                self.journal.checkpoint([]).result(TIMEOUT)
+
+        # the old journal is kept and appended to
+        self.journal.record(entry('b')).result(TIMEOUT)
+        self.assertEqual(['a', 'b'], self.replayed())
+
+    def test_failed_write_is_not_acknowledged(self):
+        self.journal.record(entry('a')).result(TIMEOUT)
+        with mock.patch.object(workout_journal.os, 'fsync', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                self.journal.record(entry('b')).result(TIMEOUT)
+
+        # the failed entry is not replayed, later ones are written
+        self.assertEqual(['a'], self.replayed())
+        self.journal.record(entry('c')).result(TIMEOUT)
+        self.assertEqual(['a', 'c'], self.replayed())
+
+    def test_unexpected_error_keeps_writer_alive(self):
+        with mock.patch.object(self.journal, '_commit', side_effect=ValueError('I/O operation on closed file')):
+            with self.assertRaises(ValueError):
+                self.journal.record(entry('a')).result(TIMEOUT)
+        self.journal.record(entry('b')).result(TIMEOUT)
+        self.assertEqual(['b'], self.replayed())
+
+
+if __name__ == '__main__':
+    unittest.main()